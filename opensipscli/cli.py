@@ -333,7 +333,9 @@ class OpenSIPSCLIShell(cmd.Cmd, object):
             logger.error("module '{}' expects the following commands: {}".
                    format(module, ", ".join(mod[1])))
             return -1
-        elif cmd and not cmd in mod[1]:
+        elif cmd and not (cmd.partition('=')[0] if cmd.startswith('-')
+                else cmd) in mod[1]:
+            # options are also accepted as --name=value
             logger.error("no command '{}' in module '{}'".
                     format(cmd, module))
             return -1
@@ -26,7 +26,7 @@ from opensipscli.communication import jsonrpc_helper
 
 REPLY_FIFO_FILE_TEMPLATE='opensips_fifo_reply_{}'
 
-def execute(method, params):
+def execute(method, params, fifo_file=None):
     jsoncmd = jsonrpc_helper.get_command(method, params)
     reply_fifo_file_name = REPLY_FIFO_FILE_TEMPLATE.format(random.randrange(32767))
     reply_fifo_file = "/tmp/{}".format(reply_fifo_file_name)
@@ -49,7 +49,7 @@ def execute(method, params):
                 "cannot create reply file {}: {}!".
                 format(reply_fifo_file, ex))
 
-    opensips_fifo = cfg.get('fifo_file')
+    opensips_fifo = fifo_file or cfg.get('fifo_file')
     if not os.path.exists(opensips_fifo):
         raise jsonrpc_helper.JSONRPCException(
                 "fifo file {} does not exist!".
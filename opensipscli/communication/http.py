@@ -23,13 +23,18 @@ import urllib.request
 from opensipscli.config import cfg
 from opensipscli.communication import jsonrpc_helper
 
-def execute(method, params):
-    url = cfg.get('url')
+def execute(method, params, url=None, timeout=None):
+    if url is None:
+        url = cfg.get('url')
     jsoncmd = jsonrpc_helper.get_command(method, params)
     headers = { 'Content-Type': 'application/json' }
     request = urllib.request.Request(url,
             jsoncmd.encode(), headers)
-    replycmd = urllib.request.urlopen(request).read().decode()
+    if timeout is None:
+        replycmd = urllib.request.urlopen(request).read().decode()
+    else:
+        replycmd = urllib.request.urlopen(request,
+                timeout=timeout).read().decode()
     return jsonrpc_helper.get_reply(replycmd)
 
 def valid():
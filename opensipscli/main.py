@@ -70,8 +70,11 @@ parser.add_argument('command',
 
 def main():
 
-    # Parse all arguments
-    args = parser.parse_args()
+    # Parse all arguments; the unknown options are the command's own
+    args, options = parser.parse_known_args()
+    if options and not args.command:
+        parser.error("unrecognized arguments: {}".format(" ".join(options)))
+    args.command += options
 
     # Open the CLI
     shell = cli.OpenSIPSCLIShell(args)
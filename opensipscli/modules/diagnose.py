@@ -21,38 +21,227 @@ from opensipscli.module import Module
 from opensipscli.logger import logger
 from opensipscli.config import cfg
 from opensipscli import comm
+from opensipscli.communication import jsonrpc_helper, fifo, http
+from opensipscli.sketch import TopK, SpaceSaving, LogHistogram, \
+        SlidingHistogram, SlidingRegression
+from opensipscli.screen import Screen
+from opensipscli.sockets import SocketSampler, decode_address, \
+        get_socket_inodes
+from opensipscli.procstat import ProcessSampler
+from opensipscli.units import human_size
+from collections import OrderedDict
+from contextlib import redirect_stdout
 from threading import Thread
 import socket
+import selectors
 import subprocess
 import shutil
 import time
-import os
 import re
 import time
 import threading
-import bisect
 import random
-
-try:
-    import psutil
-    have_psutil = True
-except:
-    have_psutil = False
+import io
 
 import json
-from json.decoder import WHITESPACE
 
 JSONRPC_RCV_HOST = '127.0.0.1'
 JSONRPC_RCV_PORT = 8888
 
+# initial size of the buffer events are received in; it only grows if a
+# single event does not fit in it
+JSONRPC_RCV_BUFFER_SIZE = 65536
+# maximum size of an event, after which pending data is considered garbage
+JSONRPC_MAX_EVENT_SIZE = 4 * 1024 * 1024
+# used to frame an event when counting its braces was not enough, i.e. if
+# it has braces in its strings: skips to the next brace outside strings; if
+# none follows, the match stops at the end of the data or at the opening
+# quote of a string not received completely, resumed with JSONRPC_STRING_TAIL
+JSONRPC_FRAME_TOKENS = re.compile(
+        rb'(?:[^{}"]+|"[^"\\]*(?:\\.[^"\\]*)*")*(?:(\{)|(\}))?', re.DOTALL)
+JSONRPC_STRING_TAIL = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*(")?', re.DOTALL)
+
 DNS_THR_EVENTS = ['dns']
 SQL_THR_EVENTS = ['mysql', 'pgsql']
 NOSQL_THR_EVENTS = ['Cassandra', 'cachedb_local', 'MongoDB',
                     'cachedb_memcached', 'cachedb_couchbase']
 SIP_THR_EVENTS = ['msg processing']
 
-thr_summary = {}
-thr_slowest = []
+# default number of slowest and most frequent events shown
+THR_TOP_EVENTS = 3
+# default number of distinct events counted for finding the most frequent
+THR_SUMMARY_SIZE = 1000
+# number of raw queries whose fingerprint is remembered
+THR_FINGERPRINT_CACHE_SIZE = 4096
+# default windows, in seconds, the event times of each source are shown for
+THR_TIME_WINDOWS = "10,60"
+# maximum number of distinct event sources whose times are kept
+THR_MAX_SOURCES = 64
+
+# default interval, in seconds, the views are refreshed at
+DIAG_REFRESH = 1
+# shortest refresh interval accepted, in seconds
+DIAG_MIN_REFRESH = 0.05
+# default window, in seconds, the private memory usage of each process is
+# followed over, in order to spot leaks
+MEM_TREND_WINDOW = 300
+# a process is leaking when its memory usage grows steadily, i.e. it fits
+# a growing line well enough, over enough samples...
+MEM_TREND_MIN_SAMPLES = 10
+MEM_TREND_MIN_R2 = 0.9
+# ... and by at least this share of its memory, during the window
+MEM_TREND_MIN_GROWTH = 0.01
+# default time, in seconds, each node of the cluster view is waited for
+DIAG_CLUSTER_TIMEOUT = 1
+# columns the cluster view can be sorted by, besides its checks
+CLUSTER_SORT_KEYS = ['status', 'name', 'rtt']
+CLUSTER_CHECKS = ['load', 'shmem', 'pkmem', 'sip', 'dns', 'sql', 'nosql']
+CLUSTER_TITLES = {'load': "LOAD", 'shmem': "SHM", 'pkmem': "PKG",
+        'sip': "SIP", 'dns': "DNS", 'sql': "SQL", 'nosql': "NOSQL"}
+# short form of the severities, fitting the cells of the cluster view
+SEVERITY_LABELS = {"OK": "OK", "NOTICE": "NOTE", "WARNING": "WARN",
+        "UNKNOWN": "UNKN", "CRITICAL": "CRIT"}
+
+# default window, in seconds, rates are measured over when running once
+DIAG_ONCE_WINDOW = 1
+DIAG_ONCE_FORMATS = ['text', 'json']
+# options of running once, which may also be given in place of a view
+DIAG_ONCE_OPTIONS = ['--once', '--format', '--window']
+
+SEVERITIES = ["OK", "NOTICE", "WARNING", "UNKNOWN", "CRITICAL"]
+# exit codes of the severities, as for Nagios plugins
+NAGIOS_CODES = {"OK": 0, "NOTICE": 0, "WARNING": 1, "CRITICAL": 2,
+        "UNKNOWN": 3}
+
+# check: (slow statistic, total statistics)
+SLOW_CHECKS = OrderedDict([
+    ('sip', ('core:slow_messages', ['core:rcv_requests', 'core:rcv_replies'])),
+    ('dns', ('dns:dns_slow_queries', ['dns:dns_total_queries'])),
+    ('sql', ('sql:sql_slow_queries', ['sql:sql_total_queries'])),
+    ('nosql', ('cdb:cdb_slow_queries', ['cdb:cdb_total_queries'])),
+    ])
+
+# check: (title in the overview, view to run for more info)
+SUMMARY_CHECKS = {
+    'load': ("Worker Capacity:", 'load'),
+    'shmem': ("Shared Memory:", 'memory'),
+    'pkmem': ("Private Memory:", 'memory'),
+    'sip': ("SIP Processing:", 'sip'),
+    'dns': ("DNS Queries:", 'dns'),
+    'sql': ("SQL queries:", 'sql'),
+    'nosql': ("NoSQL Queries:", 'nosql'),
+    }
+
+# statistics the overview is built out of
+SUMMARY_STATISTICS = [
+    'load', 'load1m', 'load10m', 'total_size', 'real_used_size',
+    'max_used_size',  'rcv_requests', 'rcv_replies', 'processes_number',
+    'slow_messages', 'pkmem:', 'dns:', 'sql:', 'cdb:'
+    ]
+
+WORKERS_WINDOWS = [
+    "{}% avg. currently used worker capacity!!",
+    "{}% avg. used worker capacity over the last 1 minute!",
+    "{}% avg. used worker capacity over the last 10 minutes!",
+    ]
+
+SQL_COMMENTS = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+# OpenSIPS quotes all values with single quotes
+SQL_STRINGS = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+# numbers not part of identifiers; the lookbehind follows the first digit,
+# so that the regex engine can quickly skip to the digits
+SQL_NUMBERS = re.compile(
+        r"\d(?<![\w.]\d)(?:(?<=0)x[0-9a-f]+|\d*(?:\.\d+)?(?:e[-+]?\d+)?)\b",
+        re.I)
+SQL_OPERATORS = ["=", "<", ">", "!", ","]
+# the sign of a negative number, once the spaces around operators are gone;
+# a minus following an operand is a subtraction, and is kept
+SQL_NEGATIVES = re.compile(r"(?<=[=<>!,(])-\?")
+# IN lists and rows of values
+SQL_LISTS = re.compile(r"\(\?(?:,\?)*\)")
+SQL_ROWS = re.compile(r"\(\?\+\)(?:,\(\?\+\))+")
+
+def get_windows():
+    """returns the windows the event times are shown for, in seconds"""
+    windows = cfg.get('diagnose_windows') \
+            if cfg.exists('diagnose_windows') else THR_TIME_WINDOWS
+    try:
+        windows = [int(w) for w in str(windows).split(",")]
+        if windows and all(w > 0 for w in windows):
+            return windows
+    except ValueError:
+        pass
+    logger.warning("invalid diagnose_windows, using {}".format(
+        THR_TIME_WINDOWS))
+    return [int(w) for w in THR_TIME_WINDOWS.split(",")]
+
+def get_option(name, default):
+    """returns an integer setting of the module, from the config file"""
+    try:
+        return int(cfg.get(name)) if cfg.exists(name) else default
+    except ValueError:
+        logger.warning("invalid value of {}, using {}".format(name, default))
+        return default
+
+def get_refresh():
+    """returns the interval the views are refreshed at, in seconds"""
+    try:
+        refresh = float(cfg.get('diagnose_refresh')) \
+                if cfg.exists('diagnose_refresh') else DIAG_REFRESH
+    except ValueError:
+        logger.warning("invalid value of diagnose_refresh, using {}".format(
+            DIAG_REFRESH))
+        return DIAG_REFRESH
+    return max(refresh, DIAG_MIN_REFRESH)
+
+def worst_severity(severities):
+    return max(severities, key=SEVERITIES.index, default="OK")
+
+def capacity_severity(l1, l2, l3):
+    """severity of the worker capacity, out of its three load averages"""
+    if l1 > 20 or l2 > 20 or l3 > 20:
+        if l1 > 40 or l2 > 40 or l3 > 40:
+            if l1 > 66 or l2 > 66 or l3 > 66:
+                return "CRITICAL"
+            return "WARNING"
+        return "NOTICE"
+    return "OK"
+
+def workers_severity(l1, l2, l3):
+    """
+    severity of the load of a group of workers, along with the index of the
+    load average it is due to, if any
+    """
+    for window, load in enumerate((l1, l2, l3)):
+        if load > 50:
+            return ("CRITICAL" if load > 80 else "WARNING"), window
+    return "OK", None
+
+def memory_severity(usage_perc, max_usage_perc):
+    """severity of a memory pool, out of its current and peak usage"""
+    if usage_perc <= 70 and max_usage_perc <= 80:
+        return "OK"
+    if usage_perc <= 85 and max_usage_perc <= 90:
+        return "WARNING"
+    return "CRITICAL"
+
+def slow_severity(slow, total):
+    """
+    severity of the share of slow operations (messages, queries), returned
+    along with the share
+    """
+    try:
+        slow_perc = round(slow / total * 100)
+    except ZeroDivisionError:
+        slow_perc = 0
+
+    if 0 <= slow_perc <= 1:
+        return "OK", slow_perc
+    elif 2 <= slow_perc <= 5:
+        return "NOTICE", slow_perc
+    elif 6 <= slow_perc <= 50:
+        return "WARNING", slow_perc
+    return "CRITICAL", slow_perc
 
 """ cheers to Philippe: https://stackoverflow.com/a/325528/2054305 """
 class StoppableThread(threading.Thread):
@@ -66,6 +255,191 @@ class StoppableThread(threading.Thread):
     def stopped(self):
         return self._stop_event.is_set()
 
+def sql_fingerprint(query):
+    """
+    normalizes a SQL query, so that all the queries differing only in their
+    literal values (i.e. WHERE username='alice' vs 'bob') look the same
+    """
+    if "/*" in query or "--" in query:
+        query = SQL_COMMENTS.sub(" ", query)
+    query = SQL_NUMBERS.sub("?", SQL_STRINGS.sub("?", query))
+    query = " ".join(query.split()).lower()
+    for op in SQL_OPERATORS:
+        if op in query:
+            query = query.replace(" " + op, op).replace(op + " ", op)
+    query = query.replace("( ", "(").replace(" )", ")")
+    if "-?" in query:
+        query = SQL_NEGATIVES.sub("?", query)
+    if "(?" in query:
+        query = SQL_ROWS.sub("(?+)", SQL_LISTS.sub("(?+)", query))
+    return query
+
+class QueryFingerprinter(object):
+    """
+    Memoizes the fingerprints of the most recently seen raw queries, since
+    the same queries are usually reported over and over
+    """
+
+    def __init__(self, size=THR_FINGERPRINT_CACHE_SIZE):
+        self.size = size
+        self.cache = OrderedDict()
+
+    def get(self, query):
+        fingerprint = self.cache.get(query)
+        if fingerprint is not None:
+            self.cache.move_to_end(query)
+            return fingerprint
+        fingerprint = sql_fingerprint(query)
+        self.cache[query] = fingerprint
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return fingerprint
+
+class ThresholdStats(object):
+    """
+    The aggregated threshold events: the slowest ones, and an approximation
+    of the most frequent ones, within bounded memory. SQL queries are counted
+    by their fingerprint, and the time distribution of each counted query is
+    kept as well. The collector thread updates them, while the views read
+    them, so all accesses are locked
+    """
+
+    def __init__(self, top=THR_TOP_EVENTS, summary_size=THR_SUMMARY_SIZE,
+            skip_summ=False, windows=(10, 60)):
+        self.lock = threading.Lock()
+        self.top = top
+        self.windows = windows
+        self.sources = {}
+        self.slowest = TopK(top)
+        self.summary = None if skip_summ else SpaceSaving(summary_size)
+        self.times = {}
+        self.fingerprinter = QueryFingerprinter()
+
+    def add(self, duration, extra, source, now):
+        """adds an event; the lock has to be held by the caller"""
+        self.slowest.push(duration, (extra, source))
+        times = self.sources.get(source)
+        if times is None and len(self.sources) < THR_MAX_SOURCES:
+            times = self.sources[source] = SlidingHistogram(max(self.windows))
+        if times is not None:
+            times.add(duration, now)
+        if self.summary is None:
+            return
+        if source.startswith(tuple(SQL_THR_EVENTS)):
+            extra = self.fingerprinter.get(extra)
+        key = (extra, source)
+        replaced = self.summary.add(key)
+        if replaced is not None:
+            del self.times[replaced]
+        times = self.times.get(key)
+        if times is None:
+            times = self.times[key] = LogHistogram()
+        times.add(duration)
+
+    def get_slowest(self):
+        """returns the slowest (time, extra, source) events"""
+        with self.lock:
+            return [(duration, extra, source) for duration, (extra, source)
+                    in self.slowest.items()]
+
+    def get_frequent(self):
+        """
+        returns the most frequent events, as (count, extra, source, total
+        time, p50, p99) tuples
+        """
+        if self.summary is None:
+            return []
+        frequent = []
+        with self.lock:
+            for count, _, key in self.summary.top(self.top):
+                times = self.times[key]
+                frequent.append((count, key[0], key[1], times.total) +
+                        tuple(times.quantiles([0.5, 0.99])))
+        return frequent
+
+    def get_times(self):
+        """
+        returns the distribution of the event times of each source, as
+        (source, window, count, p50, p90, p99, max) tuples
+        """
+        now = time.time()
+        times = []
+        with self.lock:
+            for source in sorted(self.sources):
+                for window in self.windows:
+                    merged = self.sources[source].window(window, now)
+                    times.append((source, window, merged.count) +
+                            tuple(merged.quantiles([0.5, 0.9, 0.99])) +
+                            (merged.max,))
+        return times
+
+    def empty(self):
+        with self.lock:
+            return len(self.slowest) == 0
+
+class ThresholdStream(object):
+    """
+    The receive buffer of a connection delivering events: events are framed
+    directly in it, and it is only compacted once the consumed data takes
+    more than half of it
+    """
+
+    def __init__(self):
+        self.buf = bytearray(JSONRPC_RCV_BUFFER_SIZE)
+        self.start = 0
+        self.end = 0
+        self.reset_scan()
+
+    def reset_scan(self):
+        # where framing resumes, along with the state it was left in, so
+        # that each byte is only scanned once
+        self.scan = self.start
+        self.depth = 0
+        self.exact = False
+        self.in_string = False
+
+    def compact(self):
+        buf = self.buf
+        buf[:self.end - self.start] = buf[self.start:self.end]
+        self.scan -= self.start
+        self.start, self.end = 0, self.end - self.start
+
+    def receive(self, conn, collector, events):
+        """
+        reads the available data of conn and processes the complete events;
+        returns the number of bytes read, 0 if the connection was closed, or
+        None if there was nothing to read
+        """
+        if self.end == len(self.buf):
+            if self.start == 0:
+                self.buf.extend(bytes(len(self.buf)))
+            else:
+                self.compact()
+
+        try:
+            new = conn.recv_into(memoryview(self.buf)[self.end:])
+        except (socket.timeout, BlockingIOError, InterruptedError):
+            return None
+        except OSError:
+            return 0
+        if not new:
+            return 0
+
+        collector.bytes += new
+        self.end += new
+        collector.parse_events(self, events)
+        if self.start == self.end:
+            self.start = self.end = 0
+            self.reset_scan()
+        elif self.start > len(self.buf) // 2:
+            self.compact()
+        elif self.end - self.start > JSONRPC_MAX_EVENT_SIZE:
+            logger.warning("dropping {} bytes of an unterminated event".format(
+                self.end - self.start))
+            self.start = self.end = 0
+            self.reset_scan()
+        return new
+
 class ThresholdCollector(StoppableThread):
     def __init__(self, *args, **kwargs):
         kwargs['target'] = self.collect_events
@@ -80,6 +454,16 @@ class ThresholdCollector(StoppableThread):
 
         super().__init__(*args, **kwargs)
         self.last_subscribe_ts = 0
+        self.decoder = json.JSONDecoder()
+        self.events = 0
+        self.bytes = 0
+        self.connections = 0
+        self.rates_ts = time.time()
+        self.rates_events = 0
+        self.rates_bytes = 0
+        self.stats = ThresholdStats(get_option('diagnose_top', THR_TOP_EVENTS),
+                get_option('diagnose_summary_size', THR_SUMMARY_SIZE),
+                self.skip_summ, get_windows())
 
     def mi_refresh_sub(self):
         now = int(time.time())
@@ -104,95 +488,270 @@ class ThresholdCollector(StoppableThread):
                 }, silent=True)
 
     def collect_events(self, events=None):
-        global thr_summary, thr_slowest
-
-        thr_summary = {}
-        thr_slowest = []
-
+        # OpenSIPS may deliver the events over several connections (i.e. one
+        # for each worker), and reconnects after errors, so accept them all
+        sel = selectors.DefaultSelector()
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind((JSONRPC_RCV_HOST, JSONRPC_RCV_PORT))
-            s.settimeout(0.1)
+            s.setblocking(False)
             s.listen()
-
-            while True:
-                self.mi_refresh_sub()
-
-                try:
-                    conn, addr = s.accept()
-                    conn.settimeout(0.1)
-                    break
-                except socket.timeout:
-                    pass
-
-                if threading.current_thread().stopped():
-                    self.mi_unsub()
-                    return
-
-            with conn:
-                self.collect_loop(conn, events)
-
-    def collect_loop(self, conn, events):
-        global thr_summary, thr_slowest
-
-        string = ""
-        while True:
-            self.mi_refresh_sub()
+            sel.register(s, selectors.EVENT_READ, None)
 
             try:
-                new = conn.recv(1024).decode('utf-8')
-            except socket.timeout:
-                new = ""
+                while not self.stopped():
+                    self.mi_refresh_sub()
+
+                    for key, _ in sel.select(0.1):
+                        if key.data is None:
+                            try:
+                                conn, addr = s.accept()
+                            except (BlockingIOError, InterruptedError):
+                                continue
+                            conn.setblocking(False)
+                            sel.register(conn, selectors.EVENT_READ,
+                                    ThresholdStream())
+                            self.connections += 1
+                            continue
+
+                        if key.data.receive(key.fileobj, self, events) == 0:
+                            sel.unregister(key.fileobj)
+                            key.fileobj.close()
+                            self.connections -= 1
 
-            if threading.current_thread().stopped():
                 self.mi_unsub()
+            finally:
+                for key in list(sel.get_map().values()):
+                    if key.data is not None:
+                        key.fileobj.close()
+                sel.close()
+
+    def collect_loop(self, conn, events):
+        """collects the events of a single connection, until it is closed"""
+        stream = ThresholdStream()
+        while not self.stopped():
+            if stream.receive(conn, self, events) == 0:
                 break
 
-            if not new:
-                continue
+    def get_rates(self):
+        """returns the events and bytes received each second since the
+        previous call"""
+        now = time.time()
+        elapsed = max(now - self.rates_ts, 1e-6)
+        rates = ((self.events - self.rates_events) / elapsed,
+                (self.bytes - self.rates_bytes) / elapsed)
+        self.rates_ts = now
+        self.rates_events = self.events
+        self.rates_bytes = self.bytes
+        return rates
+
+    def parse_events(self, stream, events):
+        """
+        frames the JSON objects received in the buffer of stream, only
+        scanning the bytes not scanned before, and decodes the complete
+        ones; the stream's start is moved past the consumed data
+
+        An event is first framed by counting its braces, which is done at
+        the speed of memchr, and is only framed again, this time skipping
+        its strings, if the result is not valid JSON
+        """
+        buf, end = stream.buf, stream.end
+        start, pos, depth = stream.start, stream.scan, stream.depth
+        exact, in_string = stream.exact, stream.in_string
+        now = time.time()
+        # the views are only locked out once for all the events received
+        with self.stats.lock:
+            while pos < end:
+                if depth == 0:
+                    # anything between the events is skipped
+                    start = buf.find(b'{', pos, end)
+                    if start < 0:
+                        pos = end
+                        break
+                    pos, depth, exact = start + 1, 1, False
 
-            string += new
+                if not exact:
+                    close = buf.find(b'}', pos, end)
+                    if close < 0:
+                        depth += buf.count(b'{', pos, end)
+                        pos = end
+                        break
+                    depth += buf.count(b'{', pos, close) - 1
+                    pos = close + 1
+                    if depth > 0:
+                        if pos == end:
+                            # the data ends with a brace: if the event
+                            # ended there, its strings had braces too
+                            pos, depth, exact, in_string = start + 1, 1, \
+                                    True, False
+                        continue
+                    try:
+                        obj = self.decode_event(buf[start:pos])
+                    except ValueError:
+                        # frame it again, properly
+                        pos, depth, exact, in_string = start + 1, 1, True, \
+                                False
+                        continue
+                    self.process_event(obj, events, now)
+                    continue
 
-            decoder = json.JSONDecoder()
-            idx = WHITESPACE.match(string, 0).end()
-            while idx < len(string):
-                try:
-                    obj, end = decoder.raw_decode(string, idx)
-                except json.decoder.JSONDecodeError:
-                    # partial JSON -- just let it accumulate
+                if in_string:
+                    m = JSONRPC_STRING_TAIL.match(buf, pos, end)
+                    pos = m.end()
+                    in_string = m.group(1) is None
+                    if in_string:
+                        break
+                m = JSONRPC_FRAME_TOKENS.match(buf, pos, end)
+                pos = m.end()
+                if m.lastindex is None:
+                    if pos < end:
+                        # the quote of a string not received completely
+                        in_string = True
+                        pos += 1
                     break
-
-                if 'params' not in obj:
-                    string = string[end:]
+                if m.lastindex == 1:
+                    depth += 1
                     continue
+                depth -= 1
+                if depth > 0:
+                    continue
+                try:
+                    obj = self.decode_event(buf[start:pos])
+                except ValueError as e:
+                    logger.warning("dropping an invalid event of {} bytes: "
+                            "{}".format(pos - start, e))
+                    continue
+                self.process_event(obj, events, now)
+
+        if depth == 0:
+            # no event in progress
+            start = pos
+        stream.start, stream.scan, stream.depth = start, pos, depth
+        stream.exact, stream.in_string = exact, in_string
+
+    def decode_event(self, frame):
+        text = str(frame, 'utf-8', 'surrogateescape')
+        obj, idx = self.decoder.raw_decode(text)
+        if idx != len(text):
+            raise ValueError("Extra data at char {}".format(idx))
+        return obj
+
+    def process_event(self, obj, events, now):
+        if not isinstance(obj, dict) or 'params' not in obj:
+            return
 
-                params = obj['params']
-
-                # only process threshold events we're interested in
-                if events is None or \
-                        any(params['source'].startswith(e) for e in events):
-                    if 'extra' not in params:
-                        params['extra'] = "<unknown>"
-
-                    if not self.skip_summ:
-                        try:
-                            thr_summary[(params['extra'],
-                                        params['source'])] += 1
-                        except:
-                            thr_summary[(params['extra'],
-                                        params['source'])] = 1
-
-                    bisect.insort(thr_slowest, (-params['time'],
-                                    params['extra'], params['source']))
-                    thr_slowest = thr_slowest[:3]
+        params = obj['params']
+        self.events += 1
+
+        # only process threshold events we're interested in
+        if events is None or \
+                any(params['source'].startswith(e) for e in events):
+            if 'extra' not in params:
+                params['extra'] = "<unknown>"
+
+            self.stats.add(params['time'], params['extra'], params['source'],
+                    now)
+
+class MemoryTrends(object):
+    """
+    Follows the private memory usage of each process over a sliding window,
+    in order to spot the ones steadily leaking memory long before they run
+    out of it; a process restarted meanwhile (i.e. with a different PID) is
+    followed from scratch
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # process ID -> (PID, regression of its used memory)
+        self.trends = {}
+
+    def update(self, now, ps, stats):
+        seen = set()
+        for proc in ps['Processes']:
+            used = stats.get("pkmem:{}-real_used_size".format(proc['ID']))
+            if used is None:
+                continue
+            trend = self.trends.get(proc['ID'])
+            if trend is None or trend[0] != proc['PID']:
+                trend = (proc['PID'], SlidingRegression(self.window))
+                self.trends[proc['ID']] = trend
+            trend[1].add(now, int(used))
+            seen.add(proc['ID'])
+        for proc_id in list(self.trends.keys()):
+            if proc_id not in seen:
+                del self.trends[proc_id]
+
+    def get_leak(self, proc_id, used, total):
+        """
+        returns how fast a process is leaking memory, in bytes per second,
+        along with the seconds left until it runs out of it, or None if its
+        memory usage does not grow steadily
+        """
+        trend = self.trends.get(proc_id)
+        if trend is None or len(trend[1]) < MEM_TREND_MIN_SAMPLES:
+            return None
+        fit = trend[1].fit()
+        if fit is None:
+            return None
+        slope, r2 = fit
+        if slope <= 0 or r2 < MEM_TREND_MIN_R2 or \
+                slope * trend[1].span() < MEM_TREND_MIN_GROWTH * total:
+            return None
+        return slope, max(total - used, 0) / slope
+
+class ClusterNode(object):
+    """
+    An OpenSIPS instance of the cluster view, polled in a thread of its own:
+    a node that stalls is only waited for until its timeout, and it is not
+    polled again until its pending request completes
+    """
+
+    def __init__(self, name, comm_type, address):
+        self.name = name
+        self.comm_type = comm_type
+        self.address = address
+        self.thread = None
+        self.started = None
+        # (statistics or None, error or None, round trip time), as set by
+        # the polling thread in one go
+        self.result = None
+
+    def execute(self, cmd, params, timeout):
+        if self.comm_type == 'http':
+            return http.execute(cmd, params, url=self.address,
+                    timeout=timeout)
+        # reading a FIFO cannot time out - a stuck one only ties its thread
+        return fifo.execute(cmd, params, fifo_file=self.address)
+
+    def poll(self, timeout):
+        start = time.monotonic()
+        try:
+            stats = self.execute('get_statistics',
+                    {'statistics': SUMMARY_STATISTICS}, timeout)
+            error = None
+        except jsonrpc_helper.JSONRPCError as ex:
+            stats, error = None, str(ex)
+        except (jsonrpc_helper.JSONRPCException, OSError) as ex:
+            stats, error = None, str(ex) or "cannot communicate"
+        self.result = (stats, error, time.monotonic() - start)
+
+    def start(self, timeout):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.started = time.monotonic()
+        self.thread = Thread(target=self.poll, args=(timeout,), daemon=True)
+        self.thread.start()
 
-                string = string[end:]
-                idx = WHITESPACE.match(string, 0).end()
+    def wait(self, deadline):
+        """waits for the node until deadline, returning False if it stalls"""
+        self.thread.join(max(deadline - time.monotonic(), 0))
+        return not self.thread.is_alive()
 
 class diagnose(Module):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.t = None
+        self.mem_trends = None
 
     def startThresholdCollector(self, events, skip_summ=False):
         # subscribe for, then collect "query threshold exceeded" events
@@ -220,12 +779,76 @@ class diagnose(Module):
         self.stopThresholdCollector()
         return self.startThresholdCollector(events, skip_summ)
 
+    def print_times(self, title):
+        times = self.t.stats.get_times()
+        if not times:
+            return
+        print("        * {} (p50 / p90 / p99 / max):".format(title))
+        width = max(len(t[0]) for t in times)
+        for source, window, count, p50, p90, p99, max_time in times:
+            if not count:
+                print("            {:<{}} last {:>3}s: -".format(source,
+                    width, window))
+                continue
+            print("            {:<{}} last {:>3}s: {} / {} / {} / {} "
+                    "({} events)".format(source, width, window,
+                        human_time(p50), human_time(p90), human_time(p99),
+                        human_time(max_time), count))
+
+    def print_collector_stats(self):
+        if not self.t:
+            return
+        events, received = self.t.get_rates()
+        print("        * {:.0f} events/s ({}/s) received over {} "
+                "connection(s)".format(events, human_size(received),
+                    self.t.connections))
+
+    def execute(self, cmd, params=[]):
+        """
+        runs an MI command on behalf of the views; replaced when the views
+        are fed recorded statistics instead
+        """
+        return comm.execute(cmd, params)
+
+    def clock(self):
+        """returns the time the statistics of the views are sampled at"""
+        return time.time()
+
     def print_diag_footer(self):
         print("\n{}(press Ctrl-c to exit)".format('\t' * 5))
 
+    def run_view(self, loop):
+        """
+        refreshes a view until interrupted, or until its loop function fails:
+        each frame is captured from the loop's output and then drawn over the
+        previous one, so only what changed gets redrawn
+        """
+        screen = Screen()
+        refresh = get_refresh()
+        next_frame = time.monotonic()
+        try:
+            while True:
+                frame = io.StringIO()
+                with redirect_stdout(frame):
+                    ok = loop()
+                screen.render(frame.getvalue())
+                if not ok:
+                    break
+                next_frame += refresh
+                delay = next_frame - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # too slow to keep up - do not try to catch up
+                    next_frame = time.monotonic()
+        except KeyboardInterrupt:
+            print('^C')
+        finally:
+            screen.close()
+
     def diagnose_dns(self):
         # quickly ensure opensips is running
-        ans = comm.execute('get_statistics', {
+        ans = self.execute('get_statistics', {
                 'statistics': ['dns_total_queries', 'dns_slow_queries']
                 })
         if ans is None:
@@ -241,36 +864,29 @@ class diagnose(Module):
         if not self.startThresholdCollector(DNS_THR_EVENTS):
             return
 
-        sec = 0
+        start = time.time()
         try:
-            while True:
-                if not self.diagnose_dns_loop(sec, stats):
-                    break
-                time.sleep(1)
-                sec += 1
-        except KeyboardInterrupt:
-            print('^C')
+            self.run_view(lambda: self.diagnose_dns_loop(
+                int(time.time() - start), stats))
         finally:
             self.stopThresholdCollector()
 
     def diagnose_dns_loop(self, sec, stats):
-        global thr_summary, thr_slowest
-
-        os.system("clear")
         print("In the last {} seconds...".format(sec))
-        if not thr_summary:
+        if self.t.stats.empty():
             print("    DNS Queries [OK]".format(sec))
         else:
             print("    DNS Queries [WARNING]".format(sec))
             print("        * Slowest queries:")
-            for q in thr_slowest:
-                print("            {} ({} us)".format(q[1], -q[0]))
+            for q in self.t.stats.get_slowest():
+                print("            {} ({} us)".format(q[1], q[0]))
             print("        * Constantly slow queries")
-            for q in sorted([(v, k) for k, v in thr_summary.items()], reverse=True)[:3]:
-                print("            {} ({} times exceeded threshold)".format(
-                        q[1][0], q[0]))
+            for q in self.t.stats.get_frequent():
+                print("            {} ({} times exceeded threshold, {})".format(
+                        q[1], q[0], desc_times(q)))
+            self.print_times("Slow query times")
 
-        ans = comm.execute('get_statistics', {
+        ans = self.execute('get_statistics', {
                 'statistics': ['dns_total_queries', 'dns_slow_queries']
                 })
         if not ans:
@@ -280,8 +896,6 @@ class diagnose(Module):
         if int(ans['dns:dns_total_queries']) < stats['total']:
             stats['ini_total'] = int(ans['dns:dns_total_queries'])
             stats['ini_slow'] = int(ans['dns:dns_slow_queries'])
-            thr_summary = {}
-            thr_slowest = []
             sec = 1
             if not self.restartThresholdCollector(DNS_THR_EVENTS):
                 return
@@ -293,6 +907,7 @@ class diagnose(Module):
             stats['slow'], stats['total'],
             int((stats['slow'] / stats['total']) * 100) \
                     if stats['total'] > 0 else 0))
+        self.print_collector_stats()
         self.print_diag_footer()
 
         return True
@@ -305,7 +920,7 @@ class diagnose(Module):
 
     def diagnose_db(self, dbtype, events):
         # quickly ensure opensips is running
-        ans = comm.execute('get_statistics', {
+        ans = self.execute('get_statistics', {
                 'statistics': ['{}_total_queries'.format(dbtype[0]),
                                 '{}_slow_queries'.format(dbtype[0])]
                 })
@@ -322,39 +937,32 @@ class diagnose(Module):
         if not self.startThresholdCollector(events):
             return
 
-        sec = 0
+        start = time.time()
         try:
-            while True:
-                if not self.diagnose_db_loop(sec, stats, dbtype, events):
-                    break
-                time.sleep(1)
-                sec += 1
-        except KeyboardInterrupt:
-            print('^C')
+            self.run_view(lambda: self.diagnose_db_loop(
+                int(time.time() - start), stats, dbtype, events))
         finally:
             self.stopThresholdCollector()
 
     def diagnose_db_loop(self, sec, stats, dbtype, events):
-        global thr_summary, thr_slowest
-
         total_stat = '{}_total_queries'.format(dbtype[0])
         slow_stat = '{}_slow_queries'.format(dbtype[0])
 
-        os.system("clear")
         print("In the last {} seconds...".format(sec))
-        if not thr_summary:
+        if self.t.stats.empty():
             print("    {} Queries [OK]".format(dbtype[1]))
         else:
             print("    {} Queries [WARNING]".format(dbtype[1]))
             print("        * Slowest queries:")
-            for q in thr_slowest:
-                print("            {}: {} ({} us)".format(q[2], q[1], -q[0]))
+            for q in self.t.stats.get_slowest():
+                print("            {}: {} ({} us)".format(q[2], q[1], q[0]))
             print("        * Constantly slow queries")
-            for q in sorted([(v, k) for k, v in thr_summary.items()], reverse=True)[:3]:
-                print("            {}: {} ({} times exceeded threshold)".format(
-                        q[1][1], q[1][0], q[0]))
+            for q in self.t.stats.get_frequent():
+                print("            {}: {} ({} times exceeded threshold, "
+                        "{})".format(q[2], q[1], q[0], desc_times(q)))
+            self.print_times("Slow query times")
 
-        ans = comm.execute('get_statistics',
+        ans = self.execute('get_statistics',
                     {'statistics': [total_stat, slow_stat]
             })
         if not ans:
@@ -364,8 +972,6 @@ class diagnose(Module):
         if int(ans["{}:{}".format(dbtype[0], total_stat)]) < stats['total']:
             stats['ini_total'] = int(ans["{}:{}".format(dbtype[0], total_stat)])
             stats['ini_slow'] = int(ans["{}:{}".format(dbtype[0], slow_stat)])
-            thr_summary = {}
-            thr_slowest = []
             sec = 1
             if not self.restartThresholdCollector(events):
                 return
@@ -379,13 +985,14 @@ class diagnose(Module):
             stats['slow'], stats['total'],
             int((stats['slow'] / stats['total']) * 100) \
                     if stats['total'] > 0 else 0))
+        self.print_collector_stats()
         self.print_diag_footer()
 
         return True
 
     def diagnose_sip(self):
         # quickly ensure opensips is running
-        ans = comm.execute('get_statistics', {
+        ans = self.execute('get_statistics', {
                 'statistics': ['rcv_requests', 'rcv_replies', 'slow_messages']
                 })
         if ans is None:
@@ -401,32 +1008,25 @@ class diagnose(Module):
         if not self.startThresholdCollector(SIP_THR_EVENTS, skip_summ=True):
             return
 
-        sec = 0
+        start = time.time()
         try:
-            while True:
-                if not self.diagnose_sip_loop(sec, stats):
-                    break
-                time.sleep(1)
-                sec += 1
-        except KeyboardInterrupt:
-            print('^C')
+            self.run_view(lambda: self.diagnose_sip_loop(
+                int(time.time() - start), stats))
         finally:
             self.stopThresholdCollector()
 
     def diagnose_sip_loop(self, sec, stats):
-        global thr_slowest
-
-        os.system("clear")
         print("In the last {} seconds...".format(sec))
-        if not thr_slowest:
+        if self.t.stats.empty():
             print("    SIP Processing [OK]")
         else:
             print("    SIP Processing [WARNING]")
             print("        * Slowest SIP messages:")
-            for q in thr_slowest:
-                print("            {} ({} us)".format(desc_sip_msg(q[1]), -q[0]))
+            for q in self.t.stats.get_slowest():
+                print("            {} ({} us)".format(desc_sip_msg(q[1]), q[0]))
+            self.print_times("Slow message processing times")
 
-        ans = comm.execute('get_statistics', {'statistics':
+        ans = self.execute('get_statistics', {'statistics':
                             ['rcv_requests', 'rcv_replies', 'slow_messages']})
         if not ans:
             return False
@@ -439,7 +1039,6 @@ class diagnose(Module):
         if rcv_req + rcv_rpl < stats['total']:
             stats['ini_total'] = rcv_req + rcv_rpl
             stats['ini_slow'] = slow_msgs
-            thr_slowest = []
             sec = 1
             if not self.restartThresholdCollector(SIP_THR_EVENTS, skip_summ=True):
                 return
@@ -451,27 +1050,81 @@ class diagnose(Module):
             stats['slow'], stats['total'],
             int((stats['slow'] / stats['total']) * 100) \
                     if stats['total'] > 0 else 0))
+        self.print_collector_stats()
         self.print_diag_footer()
 
         return True
 
-    def diagnose_mem(self):
+    def diagnose_replay(self, params):
+        """
+        feeds a recorded burst of E_CORE_THRESHOLD events through the
+        collector, in order to inspect it and measure the collector's speed
+        """
+        if not params:
+            logger.error("no events file to replay!")
+            return False
+        replay_events = {
+            'dns': DNS_THR_EVENTS,
+            'sql': SQL_THR_EVENTS,
+            'nosql': NOSQL_THR_EVENTS,
+            'sip': SIP_THR_EVENTS,
+            }
+        if len(params) > 1 and params[1] not in replay_events:
+            logger.error("unknown events type '{}'!".format(params[1]))
+            return False
+        events = replay_events[params[1]] if len(params) > 1 else None
+
         try:
-            while True:
-                if not self.diagnose_mem_loop():
-                    break
-                time.sleep(1)
+            with open(params[0], 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            logger.error("cannot read events file {}: {}".format(params[0], e))
+            return False
+
+        collector = ThresholdCollector(events=events, skip_summ=False)
+        rcv, snd = socket.socketpair()
+        writer = Thread(target=lambda: (snd.sendall(data), snd.close()))
+        writer.daemon = True
+        start = time.perf_counter()
+        writer.start()
+        try:
+            with rcv:
+                collector.collect_loop(rcv, events)
         except KeyboardInterrupt:
             print('^C')
+        elapsed = max(time.perf_counter() - start, 1e-6)
+
+        print("Slowest events:")
+        for q in collector.stats.get_slowest():
+            print("    {}: {} ({} us)".format(q[2], q[1], q[0]))
+        print("Most frequent events:")
+        for q in collector.stats.get_frequent():
+            print("    {}: {} ({} times exceeded threshold, {})".format(
+                    q[2], q[1], q[0], desc_times(q)))
+        print("Replayed {} events ({:.1f} MB) in {:.3f} seconds: "
+                "{:.0f} events/s, {:.1f} MB/s".format(collector.events,
+                    collector.bytes / 1048576, elapsed,
+                    collector.events / elapsed,
+                    collector.bytes / 1048576 / elapsed))
+        return True
+
+    def diagnose_mem(self):
+        self.mem_trends = MemoryTrends(get_option('diagnose_leak_window',
+            MEM_TREND_WINDOW))
+        self.run_view(self.diagnose_mem_loop)
 
     def diagnose_mem_loop(self):
-        os.system("clear")
-        ans = comm.execute('get_statistics', {
+        ans = self.execute('get_statistics', {
                                 'statistics': ['shmem:', 'pkmem:']})
-        ps = comm.execute('ps')
+        ps = self.execute('ps')
         if ans is None or ps is None:
             return False
 
+        if self.mem_trends is None:
+            self.mem_trends = MemoryTrends(get_option('diagnose_leak_window',
+                MEM_TREND_WINDOW))
+        self.mem_trends.update(self.clock(), ps, ans)
+
         try:
             self.diagnose_shm_stats(ans)
             print()
@@ -489,13 +1142,7 @@ class diagnose(Module):
 
         usage_perc = int(shm_used / shm_total * 100)
         max_usage_perc = int(shm_max_used / shm_total * 100)
-
-        if usage_perc <= 70 and max_usage_perc <= 80:
-            shm_status = "OK"
-        elif usage_perc <= 85 and max_usage_perc <= 90:
-            shm_status = "WARNING"
-        else:
-            shm_status = "CRITICAL"
+        shm_status = memory_severity(usage_perc, max_usage_perc)
 
         print("Shared Memory Status")
         print("--------------------")
@@ -564,19 +1211,21 @@ class diagnose(Module):
 
             usage_perc = int(pk_used / pk_total * 100)
             max_usage_perc = int(pk_max_used / pk_total * 100)
-
-            if usage_perc <= 70 and max_usage_perc <= 80:
-                pk_status = "OK"
-            elif usage_perc <= 85 and max_usage_perc <= 90:
-                pk_status = "WARNING"
-                issues_found = True
-            else:
-                pk_status = "CRITICAL"
+            pk_status = memory_severity(usage_perc, max_usage_perc)
+            if pk_status != "OK":
                 issues_found = True
 
             print("    Process {:>2}: {:>2}% usage, {:>2}% peak usage ({})".format(
                     proc['ID'], usage_perc, max_usage_perc, proc['Type']))
 
+            leak = self.mem_trends.get_leak(proc['ID'], pk_used, pk_total) \
+                    if self.mem_trends else None
+            if leak:
+                issues_found = True
+                print("        LEAK: usage steadily growing by {}/min, "
+                        "exhausted in ~{}".format(human_size(leak[0] * 60),
+                            human_duration(leak[1])))
+
             if pk_status == "WARNING":
                 print("""        {}: {} private memory usage > {}%, please
                  increase the "-M" command line parameter!""".format(pk_status,
@@ -597,23 +1246,20 @@ class diagnose(Module):
         if pgroups is None:
             return False
         ppgroups = [pgroups]
+        self.sockets = SocketSampler()
+        self.cpu = ProcessSampler()
+        # begin the cycle count
+        self.cpu.sample(self.get_pgroups_pids(pgroups, transports))
 
-        try:
-            while True:
-                if not self.diagnose_load_loop(ppgroups, transports):
-                    break
-                time.sleep(1)
-        except KeyboardInterrupt:
-            print('^C')
+        self.run_view(lambda: self.diagnose_load_loop(ppgroups, transports))
 
     def diagnose_load_loop(self, ppgroups, transports):
         pgroups = ppgroups[0]
-        os.system("clear")
 
         print("{}OpenSIPS Processing Status".format(25 * " "))
         print()
 
-        load = comm.execute('get_statistics', {
+        load = self.execute('get_statistics', {
                                 'statistics': ['load:', 'timestamp']})
         if not load:
             return False
@@ -626,19 +1272,15 @@ class diagnose(Module):
         else:
             pgroups['ts'] = int(load['core:timestamp'])
 
-        # fetch the network waiting queues
-        if 'udp' in transports and pgroups['udp']:
-            with open('/proc/net/udp') as f:
-                udp_wait = [line.split() for line in f.readlines()[1:]]
-            self.diagnose_transport_load('udp', pgroups, load, udp_wait)
-
-        if 'tcp' in transports and pgroups['tcp']:
-            self.diagnose_transport_load('tcp', pgroups, load, None)
+        # fetch the queues of all the listeners and the CPU usage of all
+        # the processes at once
+        self.sockets.sample()
+        usage = self.cpu.sample(self.get_pgroups_pids(pgroups, transports))
 
-        if 'hep' in transports and pgroups['hep']:
-            with open('/proc/net/udp') as f:
-                udp_wait = [line.split() for line in f.readlines()[1:]]
-            self.diagnose_transport_load('hep', pgroups, load, udp_wait)
+        for transport in ['udp', 'tcp', 'hep']:
+            if transport in transports and pgroups[transport]:
+                self.diagnose_transport_load(transport, pgroups, load,
+                        self.sockets, usage)
 
         print()
         print("Info: the load percentages represent the amount of time spent by an")
@@ -649,16 +1291,33 @@ class diagnose(Module):
 
         return True
 
-    def diagnose_transport_load(self, transport, pgroups, load, net_wait):
+    def diagnose_transport_load(self, transport, pgroups, load, sockets,
+            usage):
         for i, (iface, procs) in enumerate(pgroups[transport].items()):
             # TODO: add SCTP support
             if iface != 'TCP' and not iface.startswith('{}'.format(transport)):
                 continue
 
             recvq = None
+            new_drops = None
+            pending = 0
 
             if iface == 'TCP':
                 print("TCP Processing")
+                listeners = None if pgroups.get('tcp_inodes') is None \
+                        else sockets.get_inodes('tcp', pgroups['tcp_inodes'])
+                if not listeners:
+                    print("    Accept Queue: ???")
+                for key, queue in sorted(listeners or []):
+                    print("    Accept Queue: {} connections pending ({})".format(
+                        queue.recv_queue, decode_address(key)))
+                    pending += queue.recv_queue
+                drops, new_listen_drops = sockets.listen_drops
+                if drops is not None:
+                    print("    Connections dropped by all the listeners: "
+                            "{}{}".format(drops, "" if new_listen_drops is None
+                                else " ({} since the last refresh)".format(
+                                    new_listen_drops)))
             else:
                 print("{} UDP Interface #{} ({})".format(
                         'HEP' if transport == 'hep' else 'SIP',
@@ -666,22 +1325,19 @@ class diagnose(Module):
                 if iface.startswith("hep_"):
                     iface = iface[4:]
 
-                try:
-                    # 127.0.0.1:5060 -> 0100007F, 13C4
-                    ip = "{:02X}{:02X}{:02X}{:02X}".format(*reversed(list(
-                                map(int, iface[4:].split(':')[0].split('.')))))
-                    port = hex(int(iface[4:].split(':')[1]))[2:].upper()
-                    for line in net_wait:
-                        if line[1] == "{}:{}".format(ip, port):
-                            recvq = int("0x" + line[4].split(':')[1], 0)
-                            break
-                except:
-                    pass
-
-                print("    Receive Queue: {}".format(
-                        "???" if recvq is None else human_size(recvq)))
-
-            tot_cpu = 0.0
+                queue = sockets.get_listener(iface)
+                if queue is None:
+                    print("    Receive Queue: ???")
+                else:
+                    recvq = queue.recv_queue
+                    new_drops = queue.new_drops
+                    print("    Receive Queue: {}, {} datagrams dropped{}".format(
+                        human_size(recvq), queue.drops,
+                        "" if new_drops is None else
+                        " ({} since the last refresh)".format(new_drops)))
+
+            cpu_usage = [usage[proc['PID']] for proc in procs
+                    if usage.get(proc['PID']) is not None]
             tot_l1 = 0
             tot_l2 = 0
             tot_l3 = 0
@@ -709,14 +1365,25 @@ class diagnose(Module):
                     "    Process {:>2} load: {:>2}%, {:>2}%, {:>2}% ({})".format(
                     proc['ID'], l1, l2, l3, proc['Type']))
 
-                if have_psutil:
-                    try:
-                        tot_cpu += proc['cpumon'].cpu_percent(interval=None)
-                    except psutil._exceptions.NoSuchProcess:
-                        """opensips may be restarted in the meantime!"""
-
-            avg_cpu = round(tot_cpu / len(procs))
-            print("    Avg. CPU usage: {}% (last 1 sec)".format(avg_cpu))
+            if cpu_usage:
+                avg_cpu = round(sum(u.cpu for u in cpu_usage) / len(cpu_usage))
+                print("    Avg. CPU usage: {}% ({}% user, {}% system, "
+                        "since the last refresh)".format(avg_cpu,
+                            round(sum(u.user for u in cpu_usage) /
+                                len(cpu_usage)),
+                            round(sum(u.system for u in cpu_usage) /
+                                len(cpu_usage))))
+                switches = [u for u in cpu_usage if u.voluntary is not None]
+                if switches:
+                    print("    Avg. context switches: {}/s voluntary "
+                            "(blocking), {}/s involuntary (preempted)".format(
+                                round(sum(u.voluntary for u in switches) /
+                                    len(switches)),
+                                round(sum(u.involuntary for u in switches) /
+                                    len(switches))))
+            else:
+                avg_cpu = None
+                print("    Avg. CPU usage: ???")
             print()
 
             for proc_line in proc_lines:
@@ -725,35 +1392,26 @@ class diagnose(Module):
 
             if recvq:
                 print("    WARNING: the receive queue is NOT empty, SIP signaling may be slower!")
+            if new_drops:
+                print("    CRITICAL: the receive queue overflowed, SIP packets were dropped!")
+            if pending:
+                print("    WARNING: connections are NOT accepted right away, TCP connects may be slower!")
 
             tot_l1 = round(tot_l1 / len(procs))
             tot_l2 = round(tot_l2 / len(procs))
             tot_l3 = round(tot_l3 / len(procs))
 
-            severity = "WARNING"
-
-            if tot_l1 > 50:
-                if tot_l1 > 80:
-                    severity = "CRITICAL"
-                print("    {}: {}% avg. currently used worker capacity!!".format(
-                            severity, tot_l1))
-            elif tot_l2 > 50:
-                if tot_l2 > 80:
-                    severity = "CRITICAL"
-                print("    {}: {}% avg. used worker capacity over the last 1 minute!".format(
-                            severity, tot_l2))
-            elif tot_l3 > 50:
-                if tot_l3 > 80:
-                    severity = "CRITICAL"
-                print("    {}: {}% avg. used worker capacity over the last 10 minutes!".format(
-                            severity, tot_l3))
+            severity, window = workers_severity(tot_l1, tot_l2, tot_l3)
+            if window is not None:
+                print("    {}: {}".format(severity, WORKERS_WINDOWS[window].format(
+                            (tot_l1, tot_l2, tot_l3)[window])))
             else:
-                if not recvq:
+                if not recvq and not new_drops and not pending:
                     print("    OK: no issues detected.")
                 print("-" * 70)
                 continue
 
-            if not have_psutil:
+            if avg_cpu is None:
                 print("""\n    Suggestion: see the DNS/SQL/NoSQL diagnosis for any slow query
                 reports, otherwise increase 'use_workers' or '{}_workers'!""".format(
                     "tcp" if transport == "tcp" else "udp"))
@@ -777,8 +1435,13 @@ class diagnose(Module):
 
             print("-" * 70)
 
+    def get_pgroups_pids(self, pgroups, transports):
+        return [proc['PID'] for transport in transports
+                for procs in pgroups.get(transport, {}).values()
+                for proc in procs]
+
     def get_opensips_pgroups(self):
-        ps = comm.execute('ps')
+        ps = self.execute('ps')
         if ps is None:
             return None
 
@@ -788,10 +1451,6 @@ class diagnose(Module):
             'hep': {},
             }
         for proc in ps['Processes']:
-            if have_psutil:
-                proc['cpumon'] = psutil.Process(proc['PID'])
-                proc['cpumon'].cpu_percent(interval=None) # begin cyle count
-
             if proc['Type'].startswith("TCP "):
                 """ OpenSIPS TCP is simplified, but normalize the format"""
                 try:
@@ -812,48 +1471,26 @@ class diagnose(Module):
                 except:
                     pgroups['udp'][proc['Type'][13:]] = [proc]
 
+        # the TCP listeners are the sockets the TCP main process accepts on
+        tcp_main = [proc['PID'] for proc in ps['Processes']
+                if proc['Type'] == "TCP main"]
+        pgroups['tcp_inodes'] = get_socket_inodes(tcp_main[0]) \
+                if tcp_main else None
         return pgroups
 
-    def diagnosis_summary(self):
-        try:
-            while True:
-                if not self.diagnosis_summary_loop():
-                    break
-                time.sleep(1)
-        except KeyboardInterrupt:
-            print('^C')
-
-    def diagnosis_summary_loop(self):
-        stats = comm.execute('get_statistics', {
-            'statistics': [
-                'load', 'load1m', 'load10m', 'total_size', 'real_used_size',
-                'max_used_size',  'rcv_requests', 'rcv_replies', 'processes_number',
-                'slow_messages', 'pkmem:', 'dns:', 'sql:', 'cdb:'
-                ]})
-        if not stats:
-            return False
-
-        os.system("clear")
-        print("{}OpenSIPS Overview".format(" " * 25))
-        print("{}-----------------".format(" " * 25))
-
+    def summary_checks(self, stats):
+        """
+        checks the health of OpenSIPS out of its statistics, returning the
+        results of the checks that could be run
+        """
+        checks = []
         if 'load:load' in stats:
             l1 = int(stats['load:load'])
             l2 = int(stats['load:load1m'])
             l3 = int(stats['load:load10m'])
-            if l1 > 20 or l2 > 20 or l3 > 20:
-                if l1 > 40 or l2 > 40 or l3 > 40:
-                    if l1 > 66 or l2 > 66 or l3 > 66:
-                        severity = "CRITICAL"
-                    else:
-                        severity = "WARNING"
-                else:
-                    severity = "NOTICE"
-            else:
-                severity = "OK"
-
-            print("Worker Capacity: {}{}".format(severity, "" if severity == "OK" else \
-                " (run 'diagnose load' for more info)"))
+            checks.append({'check': 'load',
+                'severity': capacity_severity(l1, l2, l3),
+                'load': l1, 'load1m': l2, 'load10m': l3})
 
         if 'shmem:total_size' in stats:
             used = int(stats['shmem:real_used_size'])
@@ -862,23 +1499,14 @@ class diagnose(Module):
 
             used_perc = round(used / total * 100)
             max_used_perc = round(max_used / total * 100)
-            if used_perc > 70 or max_used_perc > 80:
-                if used_perc > 85 or max_used_perc > 90:
-                    severity = "CRITICAL"
-                else:
-                    severity = "WARNING"
-            else:
-                severity = "OK"
-
-            print("{:<16} {}{}".format("Shared Memory:", severity,
-                "" if severity == "OK" else \
-                " (run 'diagnose memory' for more info)"))
+            checks.append({'check': 'shmem',
+                'severity': memory_severity(used_perc, max_used_perc),
+                'usage': used_perc, 'max_usage': max_used_perc})
 
         if 'load:processes_number' in stats:
             procs = int(stats['load:processes_number'])
 
             severity = "OK"
-
             for proc in range(1, procs):
                 try:
                     used = int(stats['pkmem:{}-real_used_size'.format(proc)])
@@ -892,110 +1520,424 @@ class diagnose(Module):
 
                 used_perc = round(used / total * 100)
                 max_used_perc = round(max_used / total * 100)
+                severity = worst_severity([severity,
+                    memory_severity(used_perc, max_used_perc)])
+            checks.append({'check': 'pkmem', 'severity': severity})
 
-                if used_perc > 70 or max_used_perc > 80:
-                    if used_perc > 85 or max_used_perc > 90:
-                        severity = "CRITICAL"
-                        break
-                    else:
-                        severity = "WARNING"
+        for check, (slow_stat, total_stats) in SLOW_CHECKS.items():
+            if slow_stat not in stats:
+                continue
+            slow = int(stats[slow_stat])
+            total = sum(int(stats[stat]) for stat in total_stats)
+            severity, slow_perc = slow_severity(slow, total)
+            checks.append({'check': check, 'severity': severity,
+                'slow': slow, 'total': total, 'slow_perc': slow_perc})
+
+        return checks
 
-            print("{:<16} {}{}".format("Private Memory:", severity,
-                "" if severity == "OK" else \
-                " (run 'diagnose memory' for more info)"))
+    def once_summary(self):
+        stats = self.execute('get_statistics', {
+            'statistics': SUMMARY_STATISTICS})
+        if not stats:
+            return None
+        return self.summary_checks(stats)
+
+    def once_slow(self, check, window):
+        """
+        measures the share of slow operations over a short window, out of
+        two samples of their statistics
+        """
+        slow_stat, total_stats = SLOW_CHECKS[check]
+        names = [stat.split(':', 1)[1] for stat in [slow_stat] + total_stats]
+        before = self.execute('get_statistics', {'statistics': names})
+        if not before:
+            return None
+        time.sleep(window)
+        after = self.execute('get_statistics', {'statistics': names})
+        if not after:
+            return None
+        if slow_stat not in after:
+            logger.error("no {} statistics found".format(slow_stat))
+            return None
 
-        if 'core:slow_messages' in stats:
-            slow = int(stats['core:slow_messages'])
-            total = int(stats['core:rcv_requests']) + int(stats['core:rcv_replies'])
+        slow = int(after[slow_stat])
+        total = sum(int(after[stat]) for stat in total_stats)
+        prev_total = sum(int(before.get(stat, 0)) for stat in total_stats)
+        # if OpenSIPS was restarted in the meantime, count from the restart
+        if total >= prev_total:
+            slow -= int(before.get(slow_stat, 0))
+            total -= prev_total
+        severity, slow_perc = slow_severity(slow, total)
+        return [{'check': check, 'severity': severity, 'window': window,
+            'slow': slow, 'total': total, 'slow_perc': slow_perc}]
+
+    def once_memory(self):
+        ans = self.execute('get_statistics', {
+                                'statistics': ['shmem:', 'pkmem:']})
+        ps = self.execute('ps')
+        if ans is None or ps is None:
+            return None
 
+        checks = []
+        try:
+            total = int(ans['shmem:total_size'])
+            usage = int(int(ans['shmem:real_used_size']) / total * 100)
+            max_usage = int(int(ans['shmem:max_used_size']) / total * 100)
+            checks.append({'check': 'shmem',
+                'severity': memory_severity(usage, max_usage),
+                'usage': usage, 'max_usage': max_usage})
+        except (KeyError, ValueError, ZeroDivisionError):
+            pass
+
+        for proc in ps['Processes']:
             try:
-                slow_perc = round(slow / total * 100)
-            except:
-                slow_perc = 0
-
-            if 0 <= slow_perc <= 1:
-                severity = "OK"
-            elif 2 <= slow_perc <= 5:
-                severity = "NOTICE"
-            elif 6 <= slow_perc <= 50:
-                severity = "WARNING"
-            else:
-                severity = "CRITICAL"
+                used = int(ans["pkmem:{}-real_used_size".format(proc['ID'])])
+                total = used + int(ans["pkmem:{}-free_size".format(proc['ID'])])
+                max_used = int(ans["pkmem:{}-max_used_size".format(proc['ID'])])
+                usage = int(used / total * 100)
+                max_usage = int(max_used / total * 100)
+            except (KeyError, ValueError, ZeroDivisionError):
+                continue
+            checks.append({'check': 'pkmem', 'process': proc['ID'],
+                'type': proc['Type'],
+                'severity': memory_severity(usage, max_usage),
+                'usage': usage, 'max_usage': max_usage})
+        return checks
 
-            print("{:<16} {}{}".format("SIP Processing:", severity,
-                "" if severity == "OK" else \
-                " (run 'diagnose sip' for more info)"))
+    def once_load(self, transports):
+        pgroups = self.get_opensips_pgroups()
+        if pgroups is None:
+            return None
+        load = self.execute('get_statistics', {'statistics': ['load:']})
+        if not load:
+            return None
 
-        if 'dns:dns_slow_queries' in stats:
-            slow = int(stats['dns:dns_slow_queries'])
-            total = int(stats['dns:dns_total_queries'])
+        checks = []
+        sockets = SocketSampler()
+        sockets.sample()
+        for transport in transports:
+            for iface, procs in pgroups.get(transport, {}).items():
+                if iface != 'TCP' and not iface.startswith(transport):
+                    continue
+                loads = []
+                for name in ['load', 'load1m', 'load10m']:
+                    values = [int(load[stat]) for stat in
+                            ['load:{}-proc-{}'.format(name, proc['ID'])
+                                for proc in procs] if stat in load]
+                    loads.append(round(sum(values) / len(values))
+                            if values else 0)
+                severity, _ = workers_severity(*loads)
+                check = {'check': 'load', 'transport': transport,
+                        'interface': iface, 'severity': severity,
+                        'load': loads[0], 'load1m': loads[1],
+                        'load10m': loads[2]}
+                if iface != 'TCP':
+                    queue = sockets.get_listener(iface[4:] if
+                            iface.startswith("hep_") else iface)
+                    check['recv_queue'] = None if queue is None \
+                            else queue.recv_queue
+                    check['drops'] = None if queue is None else queue.drops
+                    if queue is not None and queue.recv_queue:
+                        check['severity'] = worst_severity([severity,
+                            "WARNING"])
+                elif pgroups.get('tcp_inodes') is not None:
+                    listeners = sockets.get_inodes('tcp', pgroups['tcp_inodes'])
+                    check['accept_queue'] = sum(q.recv_queue
+                            for _, q in listeners)
+                    check['listen_drops'] = sockets.listen_drops[0]
+                    if check['accept_queue']:
+                        check['severity'] = worst_severity([severity,
+                            "WARNING"])
+                checks.append(check)
+        return checks
+
+    def diagnose_once(self, cmd, params, output_format, window):
+        """
+        runs the checks of a view only once, printing their results and
+        returning the exit code of their worst severity
+        """
+        if cmd is None:
+            checks = self.once_summary()
+        elif cmd in SLOW_CHECKS:
+            checks = self.once_slow(cmd, window)
+        elif cmd == 'memory':
+            checks = self.once_memory()
+        elif cmd == 'load':
+            checks = self.once_load(params or ['udp', 'tcp', 'hep'])
+        elif cmd == 'cluster':
+            checks = self.once_cluster()
+        else:
+            logger.error("'diagnose {}' cannot be run once".format(cmd))
+            checks = None
 
-            try:
-                slow_perc = round(slow / total * 100)
-            except:
-                slow_perc = 0
-
-            if 0 <= slow_perc <= 1:
-                severity = "OK"
-            elif 2 <= slow_perc <= 5:
-                severity = "NOTICE"
-            elif 6 <= slow_perc <= 50:
-                severity = "WARNING"
-            else:
-                severity = "CRITICAL"
+        if checks is None:
+            status = "UNKNOWN"
+            checks = []
+        else:
+            status = worst_severity(c['severity'] for c in checks)
 
-            print("{:<16} {}{}".format("DNS Queries:", severity,
-                "" if severity == "OK" else \
-                " (run 'diagnose dns' for more info)"))
+        if output_format == 'json':
+            print(json.dumps({'status': status, 'checks': checks}))
+        else:
+            print("OpenSIPS {}".format(status))
+            for check in checks:
+                details = ", ".join("{}={}".format(k, v) for k, v in
+                        check.items() if k not in ['check', 'severity'])
+                print("    {}: {}{}".format(check['check'], check['severity'],
+                    " ({})".format(details) if details else ""))
+        return NAGIOS_CODES[status]
 
-        if 'sql:sql_slow_queries' in stats:
-            slow = int(stats['sql:sql_slow_queries'])
-            total = int(stats['sql:sql_total_queries'])
+    def diagnosis_summary(self):
+        self.run_view(self.diagnosis_summary_loop)
 
-            try:
-                slow_perc = round(slow / total * 100)
-            except:
-                slow_perc = 0
-
-            if 0 <= slow_perc <= 1:
-                severity = "OK"
-            elif 2 <= slow_perc <= 5:
-                severity = "NOTICE"
-            elif 6 <= slow_perc <= 50:
-                severity = "WARNING"
-            else:
-                severity = "CRITICAL"
+    def diagnosis_summary_loop(self):
+        stats = self.execute('get_statistics', {
+            'statistics': SUMMARY_STATISTICS})
+        if not stats:
+            return False
 
-            print("{:<16} {}{}".format("SQL queries:", severity,
-                "" if severity == "OK" else \
-                " (run 'diagnose sql' for more info)"))
+        print("{}OpenSIPS Overview".format(" " * 25))
+        print("{}-----------------".format(" " * 25))
 
-        if 'cdb:cdb_slow_queries' in stats:
-            slow = int(stats['cdb:cdb_slow_queries'])
-            total = int(stats['cdb:cdb_total_queries'])
+        for check in self.summary_checks(stats):
+            title, view = SUMMARY_CHECKS[check['check']]
+            print("{:<16} {}{}".format(title, check['severity'],
+                "" if check['severity'] == "OK" else \
+                " (run 'diagnose {}' for more info)".format(view)))
 
-            try:
-                slow_perc = round(slow / total * 100)
-            except:
-                slow_perc = 0
-
-            if 0 <= slow_perc <= 1:
-                severity = "OK"
-            elif 2 <= slow_perc <= 5:
-                severity = "NOTICE"
-            elif 6 <= slow_perc <= 50:
-                severity = "WARNING"
-            else:
-                severity = "CRITICAL"
+        self.print_diag_footer()
+        return True
 
-            print("{:<16} {}{}".format("NoSQL Queries:", severity,
-                "" if severity == "OK" else \
-                " (run 'diagnose nosql' for more info)"))
+    def get_cluster_nodes(self):
+        """
+        returns the nodes of the cluster view: the instances listed by the
+        diagnose_cluster setting, or all the configured ones
+        """
+        if cfg.exists('diagnose_cluster'):
+            names = [n.strip() for n in
+                    cfg.get('diagnose_cluster').split(',') if n.strip()]
+        else:
+            names = cfg.config.sections()
+            default_section = cfg.get_default_instance()
+            if default_section not in names:
+                names.insert(0, default_section)
+
+        nodes = []
+        for name in names:
+            if not cfg.has_instance(name):
+                logger.error("unknown instance '{}' in diagnose_cluster".format(
+                    name))
+                return None
+            section = cfg.config[name]
+            comm_type = section.get('communication_type')
+            if comm_type == 'http':
+                address = section.get('url')
+            elif comm_type == 'fifo':
+                address = section.get('fifo_file')
+            else:
+                logger.error("cannot poll instance '{}' over {}".format(name,
+                    comm_type))
+                return None
+            nodes.append(ClusterNode(name, comm_type, address))
+        return nodes
 
+    def get_cluster_timeout(self):
+        try:
+            return float(cfg.get('diagnose_cluster_timeout')) \
+                    if cfg.exists('diagnose_cluster_timeout') \
+                    else DIAG_CLUSTER_TIMEOUT
+        except ValueError:
+            logger.warning("invalid value of diagnose_cluster_timeout, "
+                    "using {}".format(DIAG_CLUSTER_TIMEOUT))
+            return DIAG_CLUSTER_TIMEOUT
+
+    def cluster_checks(self, nodes, timeout):
+        """
+        polls all the nodes at once, waiting at most timeout for them, and
+        returns the status of each of them, along with its checks
+        """
+        for node in nodes:
+            node.start(timeout)
+        deadline = time.monotonic() + timeout
+
+        results = []
+        for node in nodes:
+            result = {'node': node.name}
+            if not node.wait(deadline):
+                result['severity'] = "UNKNOWN"
+                result['error'] = "no reply for {:.1f}s".format(
+                        time.monotonic() - node.started)
+                results.append(result)
+                continue
+            stats, error, rtt = node.result
+            result['rtt'] = round(rtt * 1000, 1)
+            if stats is None:
+                result['severity'] = "UNKNOWN"
+                result['error'] = error
+            else:
+                checks = self.summary_checks(stats)
+                result['severity'] = worst_severity(
+                        c['severity'] for c in checks)
+                result['checks'] = checks
+            results.append(result)
+        return results
+
+    def sort_cluster(self, results, key):
+        if key == 'name':
+            results.sort(key=lambda r: r['node'])
+        elif key == 'rtt':
+            # the stalled nodes last
+            results.sort(key=lambda r: (r.get('rtt') is None,
+                r.get('rtt', 0), r['node']))
+        else:
+            def rank(result):
+                if key == 'status':
+                    severity = result['severity']
+                else:
+                    severity = next((c['severity'] for c in
+                        result.get('checks', []) if c['check'] == key), "OK")
+                return -SEVERITIES.index(severity), result['node']
+            results.sort(key=rank)
+        return results
+
+    def print_cluster(self, results):
+        width = max([len(r['node']) for r in results] + [4])
+        print("{:<{}} {:<8} {} {:>8}".format("NODE", width, "STATUS",
+            " ".join("{:<9}".format(CLUSTER_TITLES[c])
+                for c in CLUSTER_CHECKS), "RTT"))
+        for result in results:
+            if 'checks' not in result:
+                print("{:<{}} {:<8} {}".format(result['node'], width,
+                    result['severity'], result['error']))
+                continue
+            cells = []
+            checks = {c['check']: c for c in result['checks']}
+            for name in CLUSTER_CHECKS:
+                check = checks.get(name)
+                if check is None:
+                    cells.append("{:<9}".format("-"))
+                    continue
+                value = check.get('load', check.get('usage',
+                    check.get('slow_perc')))
+                cells.append("{:<9}".format("{}{}".format(
+                    SEVERITY_LABELS[check['severity']],
+                    "" if value is None else " {}%".format(value))))
+            print("{:<{}} {:<8} {} {:>8}".format(result['node'], width,
+                result['severity'], " ".join(cells),
+                "{}ms".format(result['rtt'])))
+
+    def diagnose_cluster(self, params):
+        if params:
+            sort_key = params[0]
+        elif cfg.exists('diagnose_cluster_sort'):
+            sort_key = cfg.get('diagnose_cluster_sort')
+        else:
+            sort_key = 'status'
+        if sort_key not in CLUSTER_SORT_KEYS + CLUSTER_CHECKS:
+            logger.error("cannot sort by '{}', use one of: {}".format(sort_key,
+                ", ".join(CLUSTER_SORT_KEYS + CLUSTER_CHECKS)))
+            return -1
+
+        nodes = self.get_cluster_nodes()
+        if not nodes:
+            return -1
+        timeout = self.get_cluster_timeout()
+        self.run_view(lambda: self.diagnose_cluster_loop(nodes, timeout,
+            sort_key))
+
+    def diagnose_cluster_loop(self, nodes, timeout, sort_key):
+        results = self.sort_cluster(self.cluster_checks(nodes, timeout),
+                sort_key)
+
+        print("{}OpenSIPS Cluster Overview".format(" " * 21))
+        print("{}-------------------------".format(" " * 21))
+        counts = OrderedDict((s, 0) for s in reversed(SEVERITIES))
+        for result in results:
+            counts[result['severity']] += 1
+        print("{} nodes: {}\n".format(len(results), ", ".join(
+            "{} {}".format(count, severity)
+            for severity, count in counts.items() if count)))
+        self.print_cluster(results)
+
+        print("\n(sorted by {}; run 'diagnose cluster <{}>' to change)".format(
+            sort_key, "|".join(CLUSTER_SORT_KEYS + CLUSTER_CHECKS)))
         self.print_diag_footer()
         return True
 
+    def once_cluster(self):
+        nodes = self.get_cluster_nodes()
+        if not nodes:
+            return None
+        checks = []
+        for result in self.cluster_checks(nodes, self.get_cluster_timeout()):
+            check = {'check': 'node', 'node': result['node'],
+                    'severity': result['severity']}
+            if 'rtt' in result:
+                check['rtt'] = result['rtt']
+            if 'error' in result:
+                check['error'] = result['error']
+            else:
+                problems = [c['check'] for c in result['checks']
+                        if c['severity'] != "OK"]
+                if problems:
+                    check['problems'] = ",".join(problems)
+            checks.append(check)
+        return checks
+
+    def parse_once_options(self, params):
+        """
+        extracts the options of running once out of the params, returning
+        them (once, format, window) along with the params left, or None if
+        they are invalid
+        """
+        once = False
+        output_format = 'text'
+        window = DIAG_ONCE_WINDOW
+        left = []
+        params = iter(params or [])
+        for param in params:
+            name, _, value = param.partition('=')
+            if name == '--once':
+                once = True
+            elif name in ['--format', '--window']:
+                if not value:
+                    value = next(params, None)
+                if name == '--format':
+                    if value not in DIAG_ONCE_FORMATS:
+                        logger.error("invalid --format, use one of: {}".format(
+                            ", ".join(DIAG_ONCE_FORMATS)))
+                        return None
+                    output_format = value
+                else:
+                    try:
+                        window = float(value)
+                    except (TypeError, ValueError):
+                        logger.error("invalid --window: {}".format(value))
+                        return None
+                # a format is only used when running once
+                once = True
+            else:
+                left.append(param)
+        return once, output_format, window, left
+
     def __invoke__(self, cmd, params=None):
+        if cmd is not None and cmd.startswith('-'):
+            # options first - the view, if any, follows them
+            params = [cmd] + (params or [])
+            cmd = None
+        options = self.parse_once_options(params)
+        if options is None:
+            return NAGIOS_CODES["UNKNOWN"]
+        once, output_format, window, params = options
+        if cmd is None and params:
+            if params[0] not in self.__get_methods__():
+                logger.error("no command '{}' in module 'diagnose'".format(
+                    params[0]))
+                return -1
+            cmd = params.pop(0)
+        if once:
+            return self.diagnose_once(cmd, params, output_format, window)
+
         if cmd is None:
             return self.diagnosis_summary()
         if cmd == 'dns':
@@ -1012,20 +1954,28 @@ class diagnose(Module):
             if not params:
                 params = ['udp', 'tcp', 'hep']
             return self.diagnose_load(params)
+        if cmd == 'replay':
+            return self.diagnose_replay(params)
+        if cmd == 'cluster':
+            return self.diagnose_cluster(params)
 
     def __complete__(self, command, text, line, begidx, endidx):
-        if command != 'load':
+        if command == 'load':
+            choices = ['udp', 'tcp', 'hep']
+        elif command == 'cluster':
+            choices = CLUSTER_SORT_KEYS + CLUSTER_CHECKS
+        else:
             return ['']
 
-        transports = ['udp', 'tcp', 'hep']
         if not text:
-            return transports
+            return choices
 
-        ret = [t for t in transports if t.startswith(text)]
+        ret = [t for t in choices if t.startswith(text)]
         return ret if ret else ['']
 
     def __get_methods__(self):
-        return ['', 'sip', 'dns', 'sql', 'nosql', 'memory', 'load', 'brief', 'full']
+        return ['', 'sip', 'dns', 'sql', 'nosql', 'memory', 'load', 'replay',
+                'cluster', 'brief', 'full'] + DIAG_ONCE_OPTIONS
 
 def desc_sip_msg(sip_msg):
     """summarizes a SIP message into a useful one-liner"""
@@ -1053,7 +2003,26 @@ def desc_sip_msg(sip_msg):
 
     return "{}{}{}".format(desc, ", " if desc and callid else "", callid)
 
-def human_size(bytes, units=[' bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB']):
-    """ Returns a human readable string reprentation of bytes"""
-    return "{:.1f}".format(bytes) + units[0] \
-            if bytes < 1024 else human_size(bytes / 1024, units[1:])
+def human_time(usec):
+    """returns a human readable representation of a duration"""
+    if usec < 1000:
+        return "{} us".format(int(usec))
+    if usec < 1000000:
+        return "{:.1f} ms".format(usec / 1000)
+    return "{:.2f} s".format(usec / 1000000)
+
+def human_duration(sec):
+    """returns a human readable representation of a number of seconds"""
+    sec = int(sec)
+    for unit, next_unit, size in [('d', 'h', 86400), ('h', 'm', 3600),
+            ('m', 's', 60)]:
+        if sec >= size:
+            rest = sec % size // (size // (24 if unit == 'd' else 60))
+            return "{}{} {}{}".format(sec // size, unit, rest, next_unit)
+    return "{}s".format(sec)
+
+def desc_times(event):
+    """summarizes the times of a (count, extra, source, total, p50, p99)
+    frequent event"""
+    return "total {}, p50 {}, p99 {}".format(human_time(event[3]),
+            human_time(event[4]), human_time(event[5]))
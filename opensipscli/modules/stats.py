@@ -0,0 +1,846 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+from opensipscli.module import Module
+from opensipscli.logger import logger
+from opensipscli.config import cfg
+from opensipscli import comm
+from opensipscli.series import SeriesFile
+from opensipscli.rules import RulesPlan, AlertOutputs, RuleError
+from opensipscli.units import parse_size, human_size
+from opensipscli.modules.diagnose import diagnose
+from datetime import datetime
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import heapq
+import socket
+import math
+import time
+import os
+import re
+
+STATS_FILE = "/tmp/opensips_stats.series"
+STATS_GROUPS = "load:,shmem:,pkmem:,core:,dns:,sql:"
+STATS_INTERVAL = 1
+STATS_RETENTION = "64M"
+
+STATS_EXPORTER_HOST = "0.0.0.0"
+STATS_EXPORTER_PORT = 9434
+STATS_EXPORTER_GROUPS = "all"
+# for how long, in seconds, a scrape answer is served again to other scrapes
+STATS_EXPORTER_TTL = 1
+
+STATS_PUSH_PROTOCOL = "statsd"
+STATS_PUSH_TRANSPORT = "udp"
+STATS_PUSH_PORTS = {"statsd": 8125, "graphite": 2003}
+STATS_PUSH_INTERVAL = 10
+STATS_PUSH_PREFIX = "opensips"
+# largest UDP payload that fits, with IPv6 headers, in a 1500 bytes MTU
+STATS_PUSH_MTU = 1432
+STATS_PUSH_TIMEOUT = 5
+STATS_PUSH_INVALID_CHARS = re.compile(r"[^a-zA-Z0-9_-]")
+
+STATS_ALERT_INTERVAL = 1
+STATS_ALERT_OUTPUTS = "stdout"
+# the thresholds the diagnose views use, when no rules are configured
+STATS_ALERT_RULES = """
+worker_capacity_notice: load:load > 20 or load:load1m > 20 or load:load10m > 20 severity notice
+worker_capacity: load:load > 40 or load:load1m > 40 or load:load10m > 40
+worker_capacity_critical: load:load > 66 or load:load1m > 66 or load:load10m > 66 severity critical
+shmem_usage: shmem:real_used_size / shmem:total_size > 0.7 or shmem:max_used_size / shmem:total_size > 0.8
+shmem_usage_critical: shmem:real_used_size / shmem:total_size > 0.85 or shmem:max_used_size / shmem:total_size > 0.9 severity critical
+slow_messages: rate(core:slow_messages, 30s) / (rate(core:rcv_requests, 30s) + rate(core:rcv_replies, 30s)) > 0.05 for 30s
+slow_messages_critical: rate(core:slow_messages, 30s) / (rate(core:rcv_requests, 30s) + rate(core:rcv_replies, 30s)) > 0.5 for 30s severity critical
+slow_dns_queries: rate(dns:dns_slow_queries, 30s) / rate(dns:dns_total_queries, 30s) > 0.05 for 30s
+slow_sql_queries: rate(sql:sql_slow_queries, 30s) / rate(sql:sql_total_queries, 30s) > 0.05 for 30s
+slow_nosql_queries: rate(cdb:cdb_slow_queries, 30s) / rate(cdb:cdb_total_queries, 30s) > 0.05 for 30s
+"""
+
+STATS_TOP_COUNT = 20
+STATS_TOP_GROUPS = "all"
+# rank by the absolute change per second, or by the change relative to the
+# previous value
+STATS_TOP_ORDERS = ["abs", "rel"]
+
+PROMETHEUS_PREFIX = "opensips_"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = \
+        "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_INVALID_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+# per process statistics: load:load-proc-N and pkmem:N-name
+PROMETHEUS_PROC_LOAD = re.compile(r"^(.*)-proc-(\d+)$")
+PROMETHEUS_PROC_PKMEM = re.compile(r"^(\d+)-(.*)$")
+
+def get_option(name, default):
+    return cfg.get(name) if cfg.exists(name) else default
+
+def format_time(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+def parse_time(value):
+    """parses a time given either as a UNIX timestamp, or in ISO format"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    return datetime.fromisoformat(value).timestamp()
+
+class StatsReplay(object):
+    """
+    Answers the MI commands of the diagnose views out of a recording, with
+    the values of its current row
+    """
+
+    def __init__(self, series, start, end):
+        self.series = series
+        self.row = start
+        self.end = end
+        # the columns matched by each list of statistics requested
+        self.columns = {}
+
+    def next(self):
+        """moves to the next row, if any is left"""
+        if self.row + 1 >= self.end:
+            return False
+        self.row += 1
+        return True
+
+    def get_columns(self, statistics):
+        key = tuple(statistics)
+        columns = self.columns.get(key)
+        if columns is None:
+            groups = tuple(s for s in statistics if s.endswith(':'))
+            names = set(s for s in statistics if not s.endswith(':'))
+            columns = [col for col, name in enumerate(self.series.names)
+                    if name.startswith(groups) or name in names or
+                        name.split(':', 1)[-1] in names]
+            self.columns[key] = columns
+        return columns
+
+    def execute(self, cmd, params=[]):
+        if cmd == 'ps':
+            return {'Processes': self.series.processes}
+        if cmd == 'get_statistics':
+            row = self.series.row(self.row,
+                    self.get_columns(params['statistics']))
+            return {name: int(value) if value.is_integer() else value
+                    for name, value in row.items()}
+        logger.error("command '{}' cannot be replayed!".format(cmd))
+        return None
+
+def get_types(groups):
+    """returns the counter or gauge type of each statistic"""
+    ans = comm.execute('list_statistics', {'statistics': groups}, silent=True)
+    if not isinstance(ans, dict):
+        return {}
+    return {name: "counter" if str(kind) == "incremental" else "gauge"
+            for name, kind in ans.items()}
+
+def metric_name(name):
+    return PROMETHEUS_PREFIX + PROMETHEUS_INVALID_CHARS.sub("_", name)
+
+def metric_value(value):
+    if isinstance(value, int):
+        return str(value)
+    try:
+        return str(int(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return repr(float(value))
+    except (TypeError, ValueError):
+        return None
+
+class StatsExporter(object):
+    """
+    Builds the Prometheus and OpenMetrics expositions of the statistics of
+    OpenSIPS.  Concurrent scrapes are served out of a single get_statistics
+    answer, fetched at most once per TTL; the metric names and labels of the
+    statistics are only computed when the set of statistics changes.
+    """
+
+    def __init__(self, groups, ttl):
+        self.groups = groups
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.fetched = None
+        self.stats = None
+        self.bodies = {}
+        self.keys = None
+        self.layout = None
+
+    def build_layout(self, keys):
+        """
+        groups the statistics into metric families, returning for each of
+        them its OpenMetrics and Prometheus TYPE lines, along with the
+        (sample prefix, statistic) tuples of its samples
+        """
+        types = get_types(self.groups)
+        families = {}
+        for key in keys:
+            group, _, name = key.partition(":")
+            if not name:
+                group, name = "", key
+            labels = ['group="{}"'.format(group)]
+            match = None
+            if group == "load":
+                match = PROMETHEUS_PROC_LOAD.match(name)
+                if match:
+                    name = match.group(1) + "_proc"
+                    labels.append('process="{}"'.format(match.group(2)))
+            elif group == "pkmem":
+                match = PROMETHEUS_PROC_PKMEM.match(name)
+                if match:
+                    name = "pkmem_" + match.group(2)
+                    labels.append('process="{}"'.format(match.group(1)))
+            kind = types.get(key, "unknown")
+            families.setdefault((name, kind), []).append(
+                    ("{" + ",".join(labels) + "}", key))
+
+        # a family only has one type: the statistics of different groups
+        # sharing a name, but not a type, are named after their group too
+        kinds = {}
+        for name, kind in families:
+            kinds[name] = kinds.get(name, 0) + 1
+        named = {}
+        for (name, kind), samples in families.items():
+            for labels, key in samples:
+                family = name if kinds[name] == 1 else \
+                        key.partition(":")[0] + "_" + name
+                named.setdefault(metric_name(family), (kind, []))[1].append(
+                        (labels, key))
+        families = named
+
+        layout = []
+        for family, (kind, samples) in families.items():
+            sample = family + "_total" if kind == "counter" else family
+            layout.append(("# TYPE {} {}\n".format(family, kind),
+                "# TYPE {} {}\n".format(sample,
+                    "untyped" if kind == "unknown" else kind),
+                [(sample + labels + " ", key) for labels, key in samples]))
+        return layout
+
+    def render(self, openmetrics):
+        """renders the statistics fetched last, in one of the formats"""
+        up = self.stats is not None
+        lines = ["# TYPE opensips_up gauge\n",
+                "opensips_up {}\n".format(1 if up else 0)]
+        if up:
+            stats = self.stats
+            for om_type, prom_type, samples in self.layout:
+                lines.append(om_type if openmetrics else prom_type)
+                for prefix, key in samples:
+                    value = metric_value(stats.get(key))
+                    if value is not None:
+                        lines.append(prefix + value + "\n")
+        if openmetrics:
+            lines.append("# EOF\n")
+        return "".join(lines).encode()
+
+    def scrape(self, openmetrics=False):
+        with self.lock:
+            now = time.monotonic()
+            if self.fetched is None or now - self.fetched >= self.ttl:
+                ans = comm.execute('get_statistics',
+                        {'statistics': self.groups}, silent=True)
+                self.fetched = time.monotonic()
+                self.bodies = {}
+                if isinstance(ans, dict):
+                    keys = tuple(ans.keys())
+                    if keys != self.keys:
+                        self.layout = self.build_layout(keys)
+                        self.keys = keys
+                    self.stats = ans
+                else:
+                    self.stats = None
+            body = self.bodies.get(openmetrics)
+            if body is None:
+                body = self.render(openmetrics)
+                self.bodies[openmetrics] = body
+            return body
+
+class StatsExporterHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        openmetrics = "application/openmetrics-text" in \
+                self.headers.get("Accept", "")
+        body = self.server.exporter.scrape(openmetrics)
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE
+                if openmetrics else PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("{}: {}".format(self.address_string(), format % args))
+
+class StatsExporterServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # scrapes may come in bursts, from several Prometheus servers
+    request_queue_size = 128
+
+class StatsPusher(object):
+    """
+    Pushes statistics to StatsD or Graphite: counters are sent as the
+    difference from their previous value, gauges as they are.  The lines of
+    a push are packed in as few writes as possible - for UDP, in datagrams
+    of at most mtu bytes.
+    """
+
+    def __init__(self, protocol, transport, address, prefix, groups, mtu):
+        self.protocol = protocol
+        self.transport = transport
+        self.address = address
+        self.prefix = prefix
+        self.groups = groups
+        self.mtu = mtu
+        self.sock = None
+        self.keys = None
+        # statistic -> (metric name, whether it is a counter)
+        self.metrics = {}
+        self.last = {}
+        self.failed = False
+
+    def connect(self):
+        family = socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM
+                if self.transport == "udp" else socket.SOCK_STREAM)
+        sock.settimeout(STATS_PUSH_TIMEOUT)
+        self.sock = sock
+        sock.connect(self.address)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def build_metrics(self, keys):
+        types = get_types(self.groups)
+        metrics = {}
+        for key in keys:
+            name = ".".join(STATS_PUSH_INVALID_CHARS.sub("_", part)
+                    for part in key.split(":", 1))
+            if self.prefix:
+                name = self.prefix + "." + name
+            metrics[key] = (name, types.get(key) == "counter")
+        return metrics
+
+    def build_lines(self, ts, stats):
+        keys = tuple(stats.keys())
+        if keys != self.keys:
+            self.metrics = self.build_metrics(keys)
+            self.keys = keys
+        statsd = self.protocol == "statsd"
+        ts = " {}\n".format(int(ts))
+        lines = []
+        last = self.last
+        for key, value in stats.items():
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+            name, counter = self.metrics[key]
+            if counter:
+                prev = last.get(key)
+                last[key] = value
+                if prev is None:
+                    continue
+                # a counter going back means OpenSIPS was restarted
+                value = value - prev if value >= prev else value
+                if statsd:
+                    lines.append("{}:{}|c".format(name, value))
+                else:
+                    lines.append(name + " " + str(value) + ts)
+            elif statsd:
+                if value < 0:
+                    # signed gauges are relative - reset them first
+                    lines.append("{}:0|g".format(name))
+                lines.append("{}:{}|g".format(name, value))
+            else:
+                lines.append(name + " " + str(value) + ts)
+        return lines
+
+    def batches(self, lines):
+        """packs the lines in payloads, each fitting in a datagram"""
+        sep = "\n" if self.protocol == "statsd" else ""
+        batch = []
+        size = 0
+        for line in lines:
+            length = len(line) + len(sep)
+            if batch and size + length > self.mtu:
+                yield sep.join(batch).encode()
+                batch = []
+                size = 0
+            batch.append(line)
+            size += length
+        if batch:
+            yield sep.join(batch).encode()
+
+    def push(self, ts, stats):
+        """pushes the statistics, returning the number of bytes sent"""
+        lines = self.build_lines(ts, stats)
+        if not lines:
+            return 0
+        sent = 0
+        try:
+            if self.sock is None:
+                self.connect()
+            if self.transport == "udp":
+                for payload in self.batches(lines):
+                    try:
+                        sent += self.sock.send(payload)
+                    except ConnectionRefusedError:
+                        # nobody listening (yet) - the datagram is lost
+                        pass
+            else:
+                payload = ("\n".join(lines) + "\n" if self.protocol ==
+                        "statsd" else "".join(lines)).encode()
+                self.sock.sendall(payload)
+                sent = len(payload)
+        except OSError as e:
+            if not self.failed:
+                logger.warning("cannot push statistics to {}:{}: {}".format(
+                    self.address[0], self.address[1], e))
+                self.failed = True
+            self.close()
+            return 0
+        if self.failed:
+            logger.info("pushing statistics to {}:{} again".format(
+                self.address[0], self.address[1]))
+            self.failed = False
+        return sent
+
+class StatsTop(object):
+    """
+    Ranks the statistics by how fast they change: the values of each sample
+    are stored in an array, indexed through a table of statistic names that
+    only grows, so the changes of all the statistics are computed in a
+    single pass over the arrays of two samples
+    """
+
+    def __init__(self, types):
+        self.types = types
+        self.names = []
+        self.index = {}
+        # the names of the last sample, in the order they were received in,
+        # and their slots in the arrays
+        self.keys = None
+        self.slots = None
+        self.prev = array('d')
+        self.prev_time = None
+        self.values = array('d')
+        self.rates = None
+
+    def update(self, now, stats):
+        keys = list(stats.keys())
+        if keys != self.keys:
+            # OpenSIPS usually answers with the same statistics, in the same
+            # order, so this is only needed when some of them show up
+            for name in keys:
+                if name not in self.index:
+                    self.index[name] = len(self.names)
+                    self.names.append(name)
+            self.keys = keys
+            self.slots = [self.index[name] for name in keys]
+        values = array('d', [math.nan]) * len(self.names)
+        for slot, value in zip(self.slots, stats.values()):
+            try:
+                values[slot] = float(value)
+            except (TypeError, ValueError):
+                continue
+
+        prev = self.values
+        if len(prev) < len(values):
+            prev.extend([math.nan] * (len(values) - len(prev)))
+        if self.prev_time is not None and now > self.prev_time:
+            elapsed = now - self.prev_time
+            self.rates = [(value - old) / elapsed
+                    for value, old in zip(values, prev)]
+        self.prev, self.values, self.prev_time = prev, values, now
+
+    def top(self, count, order):
+        """returns the slots of the count statistics changing the most"""
+        if self.rates is None:
+            return []
+        rates = self.rates
+        # NaN (missing) and zero rates are left out
+        slots = [slot for slot, rate in enumerate(rates)
+                if rate and rate == rate]
+        if order == "rel":
+            prev = self.prev
+            key = lambda slot: abs(rates[slot]) / max(abs(prev[slot]), 1)
+        else:
+            key = lambda slot: abs(rates[slot])
+        return heapq.nlargest(count, slots, key=key)
+
+class stats(Module):
+    """
+    records the statistics of OpenSIPS, to be inspected later on
+    """
+
+    def get_file(self, params):
+        return params[0] if params else get_option('stats_file', STATS_FILE)
+
+    def do_record(self, params):
+        params = params or []
+        path = self.get_file(params)
+        groups = params[1:] if len(params) > 1 else \
+                [g.strip() for g in str(get_option('stats_groups',
+                    STATS_GROUPS)).split(',') if g.strip()]
+        try:
+            interval = float(get_option('stats_interval', STATS_INTERVAL))
+            retention = parse_size(get_option('stats_retention',
+                STATS_RETENTION))
+        except ValueError as e:
+            logger.error("invalid stats option: {}".format(e))
+            return -1
+        if interval <= 0:
+            logger.error("invalid stats_interval {}".format(interval))
+            return -1
+
+        ps = comm.execute('ps')
+        if ps is None:
+            return -1
+        ts = time.time()
+        ans = comm.execute('get_statistics', {'statistics': groups})
+        if ans is None:
+            return -1
+
+        if os.path.exists(path):
+            series = SeriesFile.open(path, writable=True)
+            if series is not None:
+                series.interval = interval
+                series.set_processes(ps.get('Processes', []))
+        else:
+            series = SeriesFile.create(path, list(ans.keys()), interval,
+                    retention, ps.get('Processes', []))
+        if series is None:
+            return -1
+
+        logger.info("recording {} statistics every {}s in {}, keeping the "
+                "last {} samples".format(len(ans), interval, path,
+                    series.capacity))
+        samples = 0
+        dropped = set()
+        failed = False
+        next_tick = time.monotonic()
+        try:
+            while True:
+                if ans is not None:
+                    if failed:
+                        logger.info("OpenSIPS is back, recording again")
+                        failed = False
+                    values = {}
+                    for name, value in ans.items():
+                        try:
+                            values[name] = float(value)
+                        except (TypeError, ValueError):
+                            continue
+                    for name in series.append(ts, values):
+                        if name not in dropped:
+                            logger.warning("no room left for {}, not "
+                                    "recording it".format(name))
+                            dropped.add(name)
+                    samples += 1
+                elif not failed:
+                    logger.warning("cannot fetch statistics, skipping "
+                            "samples until OpenSIPS answers again")
+                    failed = True
+
+                next_tick += interval
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_tick = time.monotonic()
+                ts = time.time()
+                ans = comm.execute('get_statistics', {'statistics': groups},
+                        silent=True)
+        except KeyboardInterrupt:
+            print('^C')
+        finally:
+            series.close()
+        logger.info("recorded {} samples in {}".format(samples, path))
+
+    def do_export(self, params):
+        params = params or []
+        host = get_option('stats_exporter_host', STATS_EXPORTER_HOST)
+        try:
+            port = int(params[0] if params else
+                    get_option('stats_exporter_port', STATS_EXPORTER_PORT))
+            ttl = float(get_option('stats_exporter_ttl', STATS_EXPORTER_TTL))
+        except ValueError as e:
+            logger.error("invalid exporter option: {}".format(e))
+            return -1
+        groups = params[1:] if len(params) > 1 else \
+                [g.strip() for g in str(get_option('stats_exporter_groups',
+                    STATS_EXPORTER_GROUPS)).split(',') if g.strip()]
+
+        try:
+            server = StatsExporterServer((host, port), StatsExporterHandler)
+        except OSError as e:
+            logger.error("cannot listen on {}:{}: {}".format(host, port, e))
+            return -1
+        server.exporter = StatsExporter(groups, ttl)
+        logger.info("serving metrics on http://{}:{}/metrics".format(
+            host, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('^C')
+        finally:
+            server.server_close()
+
+    def do_push(self, params):
+        params = params or []
+        protocol = get_option('stats_push_protocol', STATS_PUSH_PROTOCOL)
+        transport = get_option('stats_push_transport', STATS_PUSH_TRANSPORT)
+        if protocol not in STATS_PUSH_PORTS:
+            logger.error("unknown push protocol '{}'!".format(protocol))
+            return -1
+        if transport not in ["udp", "tcp"]:
+            logger.error("unknown push transport '{}'!".format(transport))
+            return -1
+        target = params[0] if params else \
+                get_option('stats_push_target', '127.0.0.1')
+        host, _, port = target.rpartition(':')
+        if not host or not port.isdigit():
+            host, port = target, STATS_PUSH_PORTS[protocol]
+        host = host.strip('[]')
+        try:
+            interval = float(get_option('stats_push_interval',
+                STATS_PUSH_INTERVAL))
+            mtu = int(get_option('stats_push_mtu', STATS_PUSH_MTU))
+            address = socket.getaddrinfo(host, int(port), 0,
+                    socket.SOCK_DGRAM if transport == "udp" else
+                    socket.SOCK_STREAM)[0][4][:2]
+        except (ValueError, OSError) as e:
+            logger.error("invalid push option: {}".format(e))
+            return -1
+        if interval <= 0:
+            logger.error("invalid stats_push_interval {}".format(interval))
+            return -1
+        groups = params[1:] if len(params) > 1 else \
+                [g.strip() for g in str(get_option('stats_push_groups',
+                    STATS_GROUPS)).split(',') if g.strip()]
+
+        pusher = StatsPusher(protocol, transport, address,
+                get_option('stats_push_prefix', STATS_PUSH_PREFIX),
+                groups, mtu)
+        logger.info("pushing statistics to {} {}:{} over {} every {}s".format(
+            protocol, address[0], address[1], transport.upper(), interval))
+        failed = False
+        next_tick = time.monotonic()
+        try:
+            while True:
+                ts = time.time()
+                ans = comm.execute('get_statistics', {'statistics': groups},
+                        silent=True)
+                if isinstance(ans, dict):
+                    failed = False
+                    pusher.push(ts, ans)
+                elif not failed:
+                    logger.warning("cannot fetch statistics, skipping "
+                            "pushes until OpenSIPS answers again")
+                    failed = True
+                # the schedule does not depend on how long the MI command
+                # and the push took
+                next_tick += interval
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_tick = time.monotonic()
+        except KeyboardInterrupt:
+            print('^C')
+        finally:
+            pusher.close()
+
+    def do_alert(self, params):
+        try:
+            interval = float(get_option('stats_alert_interval',
+                STATS_ALERT_INTERVAL))
+            if interval <= 0:
+                raise RuleError("invalid stats_alert_interval {}".format(
+                    interval))
+            plan = RulesPlan(get_option('stats_alert_rules',
+                STATS_ALERT_RULES), interval)
+            outputs = AlertOutputs([o.strip() for o in
+                str(get_option('stats_alert_outputs',
+                    STATS_ALERT_OUTPUTS)).split(',') if o.strip()])
+        except (RuleError, OSError) as e:
+            logger.error("cannot set up alerts: {}".format(e))
+            return -1
+
+        fetched = plan.get_fetched()
+        logger.info("evaluating {} rules over {} statistics every {}s".format(
+            len(plan.rules), len(plan.statistics), interval))
+        failed = False
+        next_tick = time.monotonic()
+        try:
+            while True:
+                ts = time.time()
+                ans = comm.execute('get_statistics', {'statistics': fetched},
+                        silent=True)
+                if isinstance(ans, dict):
+                    failed = False
+                    for alert in plan.evaluate(ts, ans):
+                        outputs.send(alert)
+                elif not failed:
+                    logger.warning("cannot fetch statistics, skipping "
+                            "rules until OpenSIPS answers again")
+                    failed = True
+                next_tick += interval
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_tick = time.monotonic()
+        except KeyboardInterrupt:
+            print('^C')
+        finally:
+            outputs.close()
+
+    def do_top(self, params):
+        count = None
+        order = STATS_TOP_ORDERS[0]
+        groups = []
+        for param in params or []:
+            if param.isdigit():
+                count = int(param)
+            elif param in STATS_TOP_ORDERS:
+                order = param
+            else:
+                groups.append(param)
+        try:
+            if count is None:
+                count = int(get_option('stats_top_count', STATS_TOP_COUNT))
+        except ValueError as e:
+            logger.error("invalid stats_top_count: {}".format(e))
+            return -1
+        if not groups:
+            groups = [g.strip() for g in str(get_option('stats_top_groups',
+                STATS_TOP_GROUPS)).split(',') if g.strip()]
+
+        top = StatsTop(get_types(groups))
+        view = diagnose()
+
+        def top_loop():
+            now = time.monotonic()
+            ans = comm.execute('get_statistics', {'statistics': groups})
+            if not isinstance(ans, dict):
+                return False
+            top.update(now, ans)
+
+            print("{}OpenSIPS Statistics Top".format(" " * 25))
+            print("{}-----------------------".format(" " * 25))
+            print("{} statistics, ranked by {} change\n".format(
+                len(top.names), "absolute" if order == "abs" else
+                "relative"))
+            print("{:<44} {:<7} {:>16} {:>14} {:>9}".format("STATISTIC",
+                "TYPE", "VALUE", "CHANGE/s", "CHANGE%"))
+            slots = top.top(count, order)
+            if top.rates is None:
+                print("(collecting samples...)")
+            elif not slots:
+                print("(no statistic changed)")
+            for slot in slots:
+                name = top.names[slot]
+                prev = top.prev[slot]
+                print("{:<44} {:<7} {:>16g} {:>+14.1f} {:>9}".format(
+                    name, top.types.get(name, ""), top.values[slot],
+                    top.rates[slot], "{:+.1f}%".format((top.values[slot] -
+                        prev) / abs(prev) * 100) if prev else "-"))
+            view.print_diag_footer()
+            return True
+
+        view.run_view(top_loop)
+
+    def do_info(self, params):
+        path = self.get_file(params)
+        series = SeriesFile.open(path)
+        if series is None:
+            return -1
+        print("File: {} ({})".format(path,
+            human_size(os.path.getsize(path))))
+        print("Statistics: {} (room for {})".format(len(series.names),
+            series.max_series))
+        print("Samples: {} / {}, every {}s".format(series.rows,
+            series.capacity, series.interval))
+        if series.rows:
+            print("Recorded: {} - {}".format(format_time(series.time(0)),
+                format_time(series.time(series.rows - 1))))
+        series.close()
+
+    def do_replay(self, params):
+        params = params or []
+        path = self.get_file(params)
+        view_name = params[1] if len(params) > 1 else 'summary'
+        view = diagnose()
+        views = {
+            'summary': view.diagnosis_summary_loop,
+            'memory': view.diagnose_mem_loop,
+            }
+        if view_name not in views:
+            logger.error("cannot replay the '{}' view, only {}".format(
+                view_name, ", ".join(views.keys())))
+            return -1
+        try:
+            start = parse_time(params[2]) if len(params) > 2 else None
+            end = parse_time(params[3]) if len(params) > 3 else None
+        except ValueError as e:
+            logger.error("invalid time: {}".format(e))
+            return -1
+
+        series = SeriesFile.open(path)
+        if series is None:
+            return -1
+        first = series.find(start) if start is not None else 0
+        last = series.find(end) if end is not None else series.rows
+        if first >= last:
+            logger.error("no samples recorded in the given interval!")
+            series.close()
+            return -1
+
+        replay = StatsReplay(series, first, last)
+        view.execute = replay.execute
+        view.clock = lambda: series.time(replay.row)
+        loop = views[view_name]
+
+        def replay_loop():
+            print("Recorded at {} ({} / {})".format(
+                format_time(series.time(replay.row)),
+                replay.row - first + 1, last - first))
+            if not loop():
+                return False
+            return replay.next()
+
+        try:
+            view.run_view(replay_loop)
+        finally:
+            series.close()
+
@@ -18,16 +18,128 @@
 ##
 
 from datetime import datetime
-from time import time
+from time import time, perf_counter, sleep
+from collections import OrderedDict
+from array import array
+import os
+import re
+import mmap
+import errno
+import multiprocessing
 import random
+import selectors
 import socket
+import struct
+import zlib
 from opensipscli import comm
 from opensipscli.config import cfg
 from opensipscli.logger import logger
 from opensipscli.module import Module
+from opensipscli.pcap import PcapngWriter, is_capture, read_frames, decode_frame
+from opensipscli.sip import SIPMessage
+from opensipscli.units import parse_size
+from opensipscli.screen import Screen
 
 TRACE_BUFFER_SIZE = 65535
 
+# the pcapng file written when none is set, named after the time it is
+# created at
+TRACE_PCAP_FILE = '/tmp/opensips_trace_{}.pcapng'
+
+# commands that can be passed as the first parameter
+TRACE_COMMANDS = ["replay", "stats", "multi", "generate"]
+
+# filters that are interpreted by OpenSIPS in the trace_start command
+TRACE_SERVER_FILTERS = ["caller", "callee", "ip"]
+
+# options interpreted by the CLI and their default values; all of them can
+# also be provisioned in the config file, using the "trace_" prefix
+TRACE_OPTIONS = {
+    "filter": "",
+    "output": "terminal",
+    "pcap_file": "",
+    "pcap_rotate_size": "0",
+    "pcap_rotate_time": "0",
+    "group": "dialog",
+    "group_max_calls": "10000",
+    "group_max_messages": "100",
+    "group_max_memory": "64M",
+    "group_timeout": "30",
+    "ladder_dir": "",
+    "stats_window": "10",
+    "stats_top": "5",
+    "ring_trigger": "",
+    "ring_trigger_rate": "1",
+    "ring_size": "10000",
+    "ring_time": "0",
+    "ring_memory": "16M",
+    "ring_after": "5",
+    "ring_file": "/tmp/opensips_trace_ring.hep",
+    "calls_dir": "/tmp/opensips_trace_calls",
+    "calls_format": "hep",
+    "calls_max_files": "256",
+    "calls_buffer": "16K",
+    "calls_shards": "2",
+}
+
+# seconds to wait for late messages (i.e. ACKs) of a completed call
+TRACE_GROUP_LINGER = 2
+
+# minimum width of a column in the ladder diagrams
+TRACE_LADDER_WIDTH = 24
+
+# maximum number of distinct values counted each second for a statistic
+TRACE_STATS_MAX_KEYS = 1024
+
+# messages remembered for detecting retransmissions, and for how long
+TRACE_STATS_RETRANS_SIZE = 65536
+TRACE_STATS_RETRANS_TIME = 32
+
+# options of the traffic generator and their default values
+TRACE_GENERATE_OPTIONS = {
+    "target": "",
+    "transport": "tcp",
+    "rate": "0",
+    "duration": "10",
+    "count": "0",
+    "mix": "INVITE:15,100:15,180:15,200:25,ACK:10,BYE:10,486:5,503:5",
+    "size": "600",
+    "callids": "10000",
+}
+
+# number of messages built and sent at once by the traffic generator
+TRACE_GENERATE_BATCH = 64
+
+# seconds the receiver waits for late UDP messages after the generator ends
+TRACE_GENERATE_LINGER = 0.5
+
+# length of the Call-IDs generated
+TRACE_GENERATE_CALLID_LEN = 16
+
+TRACE_GENERATE_SDP = "\r\n".join([
+    "v=0",
+    "o=- 1 1 IN IP4 10.0.0.1",
+    "s=-",
+    "c=IN IP4 10.0.0.1",
+    "t=0 0",
+    "m=audio 10000 RTP/AVP 0 8 101",
+    "a=rtpmap:101 telephone-event/8000",
+    ""])
+
+TRACE_SIP_REASONS = {
+    100: "Trying",
+    180: "Ringing",
+    183: "Session Progress",
+    200: "OK",
+    404: "Not Found",
+    408: "Request Timeout",
+    480: "Temporarily Unavailable",
+    486: "Busy Here",
+    487: "Request Terminated",
+    500: "Server Internal Error",
+    503: "Service Unavailable",
+}
+
 '''
 find out more information here:
 * https://github.com/sipcapture/HEP/blob/master/docs/HEP3NetworkProtocolSpecification_REV26.pdf
@@ -51,6 +163,12 @@ protocol_ids = {
     num:name[8:] for name,num in vars(socket).items() if name.startswith("IPPROTO")
 }
 
+protocol_type_ids = { name:num for num,name in protocol_types.items() }
+
+def hep_chunk(type_id, payload):
+    """builds a generic (vendor 0) HEPv3 chunk"""
+    return struct.pack("!HHH", 0, type_id, len(payload) + 6) + payload
+
 class HEPpacketException(Exception):
     pass
 
@@ -60,17 +178,20 @@ class HEPpacket(object):
         self.payloads = payloads
         self.family = socket.AF_INET
         self.protocol = "UNKNOWN"
+        self.ip_proto = socket.IPPROTO_UDP
+        self.type = "UNKNOWN"
         self.src_addr = None
         self.dst_addr = None
         self.src_port = None
         self.dst_port = None
         self.data = None
         self.correlation = None
-        self.ts = time()
-        self.tms = datetime.now().microsecond
+        self.ts = None
+        self.tms = None
+        self.sip = None
 
     def __str__(self):
-        time_str = "{}.{}".format(
+        time_str = "{}.{:06d}".format(
                 self.ts,
                 self.tms)
         protocol_str = " {}/{}".format(
@@ -94,26 +215,77 @@ class HEPpacket(object):
                 logger.color(logger.CYAN, protocol_str + ip_str) + \
                 "\n" + data_str
 
+    def encode(self):
+        """returns the packet in the HEPv3 wire format"""
+        if not self.payloads:
+            chunks = [hep_chunk(0x0001, bytes([self.family])),
+                    hep_chunk(0x0002, bytes([self.ip_proto]))]
+            if self.src_addr is not None and self.dst_addr is not None:
+                addr_type = 0x0003 if len(self.src_addr) == 4 else 0x0005
+                chunks.append(hep_chunk(addr_type, self.src_addr))
+                chunks.append(hep_chunk(addr_type + 1, self.dst_addr))
+            chunks.append(hep_chunk(0x0007, struct.pack("!H",
+                self.src_port or 0)))
+            chunks.append(hep_chunk(0x0008, struct.pack("!H",
+                self.dst_port or 0)))
+            chunks.append(hep_chunk(0x0009, struct.pack("!I", int(self.ts))))
+            chunks.append(hep_chunk(0x000a, struct.pack("!I", self.tms)))
+            chunks.append(hep_chunk(0x000b, bytes([
+                protocol_type_ids.get(self.type, 0)])))
+            chunks.append(hep_chunk(0x000c, struct.pack("!I", 0)))
+            if self.correlation:
+                chunks.append(hep_chunk(0x0011, self.correlation))
+            if self.data:
+                chunks.append(hep_chunk(0x000f, self.data))
+            self.payloads = b''.join(chunks)
+        return b'HEP3' + struct.pack("!H", len(self.payloads) + 6) + \
+                self.payloads
+
+    def get_sip(self):
+        """returns a (lazily parsed) SIP message, if the packet carries one"""
+        if self.sip is None and self.type == "SIP" and self.data:
+            self.sip = SIPMessage(self.data)
+        return self.sip
+
+    def get_callid(self):
+        """returns the Call-ID of the message, or its correlation id"""
+        sip = self.get_sip()
+        if sip is not None:
+            callid = sip.get_callid()
+            if callid:
+                return callid
+        if self.correlation:
+            return self.correlation.decode(errors="replace")
+        return None
+
+    def get_src(self):
+        return format_address(self.family, self.src_addr, self.src_port)
+
+    def get_dst(self):
+        return format_address(self.family, self.dst_addr, self.dst_port)
+
     def parse(self):
-        length = len(self.payloads)
         payloads = self.payloads
-        while length > 0:
-            if length < 6:
-                logger.error("payload too small {}".format(length))
-                return None
-            chunk_vendor_id = int.from_bytes(payloads[0:2],
-                    byteorder="big", signed=False)
-            chunk_type_id = int.from_bytes(payloads[2:4],
-                    byteorder="big", signed=False)
-            chunk_len = int.from_bytes(payloads[4:6],
-                    byteorder="big", signed=False)
-            if chunk_len < 6:
-                logger.error("chunk too small {}".format(chunk_len))
-                return None
-            payload = payloads[6:chunk_len]
-            payloads = payloads[chunk_len:]
-            length = length - chunk_len
-            self.push_chunk(chunk_vendor_id, chunk_type_id, payload)
+        length = len(payloads)
+        offset = 0
+        try:
+            while offset < length:
+                if length - offset < 6:
+                    logger.error("payload too small {}".format(length - offset))
+                    return None
+                chunk_vendor_id, chunk_type_id, chunk_len = \
+                        struct.unpack_from("!HHH", payloads, offset)
+                if chunk_len < 6:
+                    logger.error("chunk too small {}".format(chunk_len))
+                    return None
+                self.push_chunk(chunk_vendor_id, chunk_type_id,
+                        payloads[offset + 6:offset + chunk_len])
+                offset += chunk_len
+        finally:
+            if self.ts is None:
+                now = datetime.now()
+                self.ts = int(now.timestamp())
+                self.tms = now.microsecond
 
     def push_chunk(self, vendor_id, type_id, payload):
 
@@ -127,6 +299,7 @@ class HEPpacket(object):
         elif type_id == 0x0002:
             if len(payload) != 1:
                 raise HEPpacketException
+            self.ip_proto = payload[0]
             if not payload[0] in protocol_ids:
                 self.protocol = str(payload[0])
             else:
@@ -173,44 +346,1285 @@ class HEPpacket(object):
         else:
             logger.warning("unhandled payload type {}".format(type_id))
 
+class TraceFilterException(Exception):
+    pass
+
+TRACE_FILTER_TOKENS = re.compile(r"""\s*(?:
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*') |
+    (?P<op>==|!=|=~|!~|<=|>=|<|>) |
+    (?P<paren>[()]) |
+    (?P<word>[^\s()"'<>=!~]+))""", re.VERBOSE)
+
+def sip_field(getter):
+    """builds a filter field accessor out of a SIP message getter"""
+    def get(packet):
+        sip = packet.get_sip()
+        return None if sip is None else getter(sip)
+    return get
+
+def ip_field(addr):
+    def get(packet):
+        try:
+            return socket.inet_ntop(packet.family, getattr(packet, addr))
+        except (ValueError, OSError, TypeError):
+            return None
+    return get
+
+# filter fields: (evaluation cost, accessor, numeric)
+TRACE_FILTER_FIELDS = {
+    "type": (0, lambda p: p.type, False),
+    "proto": (0, lambda p: p.protocol, False),
+    "src": (0, ip_field("src_addr"), False),
+    "dst": (0, ip_field("dst_addr"), False),
+    "src_port": (0, lambda p: p.src_port, True),
+    "dst_port": (0, lambda p: p.dst_port, True),
+    "method": (1, sip_field(SIPMessage.get_method), False),
+    "status": (1, sip_field(SIPMessage.get_status), True),
+    "ruri": (1, sip_field(SIPMessage.get_ruri), False),
+    "callid": (2, sip_field(SIPMessage.get_callid), False),
+    "body": (3, sip_field(lambda sip: sip.get_body().decode(
+        errors="replace")), False),
+}
+
+class TraceFilterCompiler(object):
+    """
+    Compiles a filter expression, i.e.
+        method == INVITE and hdr.User-Agent =~ "^Poly" or status >= 500
+    into a predicate that is evaluated for each traced message
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = []
+        pos = 0
+        while pos < len(expression):
+            match = TRACE_FILTER_TOKENS.match(expression, pos)
+            if not match:
+                if not expression[pos:].strip():
+                    break
+                raise TraceFilterException("invalid filter at '{}'".format(
+                    expression[pos:]))
+            pos = match.end()
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == "string":
+                value = re.sub(r'\\(.)', r'\1', value[1:-1])
+            self.tokens.append((kind, value))
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else \
+                (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise TraceFilterException("unexpected end of filter")
+        self.pos += 1
+        return token
+
+    def compile(self):
+        if not self.tokens:
+            return None
+        cost, pred = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise TraceFilterException("unexpected '{}' in filter".format(
+                self.peek()[1]))
+        return pred
+
+    def parse_list(self, keyword, parse):
+        operands = [parse()]
+        while self.peek() == ("word", keyword):
+            self.next()
+            operands.append(parse())
+        if len(operands) == 1:
+            return operands[0]
+        # evaluate the cheapest operands first, the result is the same
+        operands.sort(key=lambda o: o[0])
+        preds = [o[1] for o in operands]
+        pred = preds[0]
+        for other in preds[1:]:
+            if keyword == "and":
+                pred = (lambda a, b: lambda p: a(p) and b(p))(pred, other)
+            else:
+                pred = (lambda a, b: lambda p: a(p) or b(p))(pred, other)
+        return operands[-1][0], pred
+
+    def parse_or(self):
+        return self.parse_list("or", self.parse_and)
+
+    def parse_and(self):
+        return self.parse_list("and", self.parse_not)
+
+    def parse_not(self):
+        token = self.peek()
+        if token == ("word", "not"):
+            self.next()
+            cost, pred = self.parse_not()
+            return cost, lambda p: not pred(p)
+        if token == ("paren", "("):
+            self.next()
+            result = self.parse_or()
+            if self.next() != ("paren", ")"):
+                raise TraceFilterException("missing ')' in filter")
+            return result
+        return self.parse_comparison()
+
+    def get_field(self, name):
+        if name.lower().startswith("hdr."):
+            header = name[4:]
+            return 2, sip_field(lambda sip: sip.get_header(header)), False
+        if name not in TRACE_FILTER_FIELDS:
+            raise TraceFilterException("unknown filter field '{}'".format(
+                name))
+        return TRACE_FILTER_FIELDS[name]
+
+    def parse_comparison(self):
+        kind, name = self.next()
+        if kind != "word":
+            raise TraceFilterException("expected a field, got '{}'".format(
+                name))
+        cost, get, numeric = self.get_field(name)
+        if self.peek()[0] != "op":
+            # only check whether the field exists
+            return cost, lambda p: get(p) is not None
+        op = self.next()[1]
+        kind, value = self.next()
+        if kind not in ["word", "string"]:
+            raise TraceFilterException("expected a value, got '{}'".format(
+                value))
+        return cost, self.build_comparison(get, numeric, op, value)
+
+    def build_comparison(self, get, numeric, op, value):
+        if op in ["=~", "!~"]:
+            try:
+                search = re.compile(value).search
+            except re.error as e:
+                raise TraceFilterException("invalid regex '{}': {}".format(
+                    value, e))
+            def match(p):
+                v = get(p)
+                return v is not None and search(str(v)) is not None
+            if op == "=~":
+                return match
+            return lambda p: not match(p)
+
+        if numeric or op not in ["==", "!="]:
+            try:
+                value = int(value)
+            except ValueError:
+                if numeric:
+                    raise TraceFilterException("'{}' is not a number".format(
+                        value))
+                raise TraceFilterException("'{}' requires a number".format(op))
+            def get_number(p):
+                try:
+                    return int(get(p))
+                except (ValueError, TypeError):
+                    return None
+            field = get_number
+        else:
+            field = get
+
+        if op == "==":
+            return lambda p: field(p) == value
+        if op == "!=":
+            return lambda p: field(p) != value
+        def compare(p):
+            v = field(p)
+            if v is None:
+                return False
+            if op == "<":
+                return v < value
+            if op == "<=":
+                return v <= value
+            if op == ">":
+                return v > value
+            return v >= value
+        return compare
+
+def compile_filter(expression):
+    """compiles a filter expression into a predicate; None matches all"""
+    return TraceFilterCompiler(expression).compile()
+
+def format_address(family, addr, port):
+    if addr is None:
+        return "?"
+    try:
+        ip = socket.inet_ntop(family, addr)
+    except (ValueError, OSError):
+        return "?"
+    if family == socket.AF_INET6:
+        ip = "[{}]".format(ip)
+    return "{}:{}".format(ip, port)
+
+def network_packet(ts, tms, family, proto, src, dst, sport, dport, data):
+    """builds a SIP packet out of a message captured from the network"""
+    packet = HEPpacket(b'')
+    packet.ts = ts
+    packet.tms = tms
+    packet.family = family
+    packet.ip_proto = proto
+    packet.protocol = protocol_ids.get(proto, str(proto))
+    packet.type = "SIP"
+    packet.src_addr = src
+    packet.dst_addr = dst
+    packet.src_port = sport
+    packet.dst_port = dport
+    packet.data = data
+    return packet
+
+def is_sip(data):
+    """checks whether a buffer starts with a SIP request or reply"""
+    first_line = data[:data.find(b'\r\n')]
+    return first_line.startswith(b'SIP/2.0 ') or \
+            first_line.endswith(b' SIP/2.0')
+
+def call_file_name(callid):
+    """
+    returns a name of a file that can safely store a call; the hash of the
+    Call-ID tells apart the ones that only differ by the characters replaced
+    """
+    return "{}_{:08x}".format(re.sub(r'[^A-Za-z0-9_.@-]', '_', callid)[:200],
+            zlib.crc32(callid.encode(errors="surrogateescape")))
+
+class TraceSink(object):
+    """
+    An output where the traced messages are pushed to
+    """
+
+    def push(self, packet):
+        pass
+
+    def tick(self, now):
+        """called periodically, even when there is no traffic"""
+        pass
+
+    def close(self):
+        pass
+
+class TraceTerminalSink(TraceSink):
+    """
+    Prints the traced messages in the terminal, labeled with the name of
+    their trace, if any
+    """
+
+    def __init__(self, name=None):
+        self.label = None
+        if name is not None:
+            self.label = logger.color(logger.GREEN, "[{}] ".format(name))
+
+    def push(self, packet):
+        if self.label is None:
+            print(packet)
+        else:
+            print(self.label + str(packet))
+
+class TracePcapSink(TraceSink):
+    """
+    Writes the traced messages in a pcapng file
+    """
+
+    def __init__(self, path=None, rotate_size=0, rotate_time=0):
+        if not path:
+            path = TRACE_PCAP_FILE.format(
+                    datetime.now().strftime('%Y%m%d_%H%M%S'))
+        self.writer = PcapngWriter(path, rotate_size, rotate_time)
+        self.writer.open(int(time()))
+        self.skipped = 0
+
+    def push(self, packet):
+        if packet.data is None or packet.src_addr is None or \
+                packet.dst_addr is None:
+            # logs and other messages do not have any network information
+            self.skipped += 1
+            return
+        self.writer.write(int(packet.ts), packet.tms, packet.family,
+                packet.ip_proto, packet.src_addr, packet.dst_addr,
+                packet.src_port or 0, packet.dst_port or 0, packet.data)
+
+    def close(self):
+        self.writer.close()
+        print("{} packets written in {}{}".format(self.writer.packets,
+            self.writer.file_name if not self.writer.index else
+            "{} files".format(self.writer.index),
+            " ({} non-network packets skipped)".format(self.skipped)
+                if self.skipped else ""))
+
+class TraceGroup(object):
+    """
+    The messages of a dialog (or transaction) that are traced together
+    """
+
+    __slots__ = ["key", "callid", "start", "last", "messages", "dropped",
+            "size", "initial", "complete"]
+
+    def __init__(self, key, callid, ts):
+        self.key = key
+        self.callid = callid
+        self.start = ts
+        self.last = ts
+        self.messages = []
+        self.dropped = 0
+        self.size = 0
+        self.initial = None
+        self.complete = False
+
+def render_ladder(group, status):
+    """draws the messages of a group as a ladder diagram"""
+    endpoints = []
+    for msg in group.messages:
+        for ep in msg[1:3]:
+            if ep is not None and ep not in endpoints:
+                endpoints.append(ep)
+    width = max([TRACE_LADDER_WIDTH] + [len(ep) + 2 for ep in endpoints])
+    centers = [i * width + width // 2 for i in range(len(endpoints))]
+
+    lines = ["Call-ID: {} [{} messages{}, {:.3f}s, {}]".format(
+        group.callid, len(group.messages) + group.dropped,
+        " ({} not shown)".format(group.dropped) if group.dropped else "",
+        group.last - group.start, status)]
+    lines.append((" " * 10 + "".join(ep.center(width)
+        for ep in endpoints)).rstrip())
+    for ts, src, dst, label, _ in group.messages:
+        prefix = "{:>9.3f} ".format(ts - group.start)
+        if src is None:
+            # a log or another non-SIP message
+            lines.append(prefix + "  " + label)
+            continue
+        cells = [" "] * (width * len(endpoints))
+        for c in centers:
+            cells[c] = "|"
+        s = centers[endpoints.index(src)]
+        d = centers[endpoints.index(dst)]
+        lo, hi = min(s, d), max(s, d)
+        if lo == hi:
+            text = " " + label
+            cells[lo + 1:lo + 1 + len(text)] = text
+        else:
+            for c in range(lo + 1, hi):
+                cells[c] = "-"
+            if s < d:
+                cells[hi - 1] = ">"
+            else:
+                cells[lo + 1] = "<"
+            text = " {} ".format(label[:max(hi - lo - 5, 1)])
+            start = lo + 1 + (hi - lo - 1 - len(text)) // 2
+            cells[start:start + len(text)] = text
+        lines.append(prefix + "".join(cells).rstrip())
+    return "\n".join(lines) + "\n"
+
+class TraceLadderSink(TraceSink):
+    """
+    Correlates the traced messages by their Call-ID (or HEP correlation id)
+    and outputs each completed dialog or transaction as a ladder diagram
+    """
+
+    def __init__(self, group="dialog", max_calls=10000, max_messages=100,
+            max_memory=64 * 1024 * 1024, timeout=30, directory=None):
+        self.group = group
+        self.max_calls = max_calls
+        self.max_messages = max_messages
+        self.max_memory = max_memory
+        self.timeout = timeout
+        self.directory = directory
+        # each ladder is written at once, so the files are not buffered
+        self.writer = TraceCallsSink(directory, buffer_size=0, shards=0,
+                fmt="txt") if directory else None
+        # active groups, the least recently used first
+        self.calls = OrderedDict()
+        # completed groups, waiting for late messages
+        self.lingering = OrderedDict()
+        # recently output groups, to ignore their retransmissions
+        self.finished = OrderedDict()
+        self.memory = 0
+
+    def get_key(self, packet):
+        callid = packet.get_callid()
+        if callid is None or self.group != "transaction":
+            return callid, callid
+        sip = packet.get_sip()
+        if sip is None:
+            return None, None
+        cseq, method = sip.get_cseq()
+        if method == "ACK":
+            method = "INVITE"
+        return "{} {} {}".format(callid, cseq, method), callid
+
+    def push(self, packet):
+        key, callid = self.get_key(packet)
+        if key is None:
+            return
+        ts = packet.ts + packet.tms / 1000000
+        group = self.calls.get(key)
+        if group is None:
+            if key in self.finished:
+                return
+            group = TraceGroup(key, callid, ts)
+            self.calls[key] = group
+        else:
+            self.calls.move_to_end(key)
+        group.last = ts
+
+        sip = packet.get_sip()
+        if len(group.messages) >= self.max_messages:
+            group.dropped += 1
+        else:
+            if sip is not None:
+                msg = (ts, packet.get_src(), packet.get_dst(),
+                        sip.describe(), packet.data if self.writer else None)
+            else:
+                msg = (ts, None, None, "{}: {}".format(packet.type,
+                    (packet.data or b'').decode(errors="replace").strip()),
+                    None)
+            size = 128 + len(msg[3]) + (len(msg[4]) if msg[4] else 0)
+            group.messages.append(msg)
+            group.size += size
+            self.memory += size
+
+        if sip is not None:
+            self.update_state(group, sip, ts)
+        self.expire(ts)
+
+    def update_state(self, group, sip, ts):
+        cseq, method = sip.get_cseq()
+        if sip.is_request():
+            if group.initial is None:
+                group.initial = (cseq, sip.get_method())
+        elif not group.complete and (sip.get_status() or 0) >= 200:
+            if self.group == "transaction" or method == "BYE":
+                group.complete = True
+            elif group.initial == (cseq, method) and \
+                    (method != "INVITE" or sip.get_status() >= 300):
+                group.complete = True
+        if group.complete:
+            self.lingering[group.key] = ts
+            self.lingering.move_to_end(group.key)
+
+    def expire(self, now):
+        while len(self.calls) > self.max_calls or \
+                self.memory > self.max_memory:
+            self.remove(next(iter(self.calls)), "evicted")
+        while self.lingering:
+            key, ts = next(iter(self.lingering.items()))
+            if now - ts < TRACE_GROUP_LINGER:
+                break
+            self.remove(key, "completed")
+        while self.calls:
+            group = next(iter(self.calls.values()))
+            if now - group.last < self.timeout:
+                break
+            self.remove(group.key, "timed out")
+
+    def remove(self, key, status):
+        group = self.calls.pop(key)
+        self.lingering.pop(key, None)
+        self.memory -= group.size
+        self.finished[key] = True
+        if len(self.finished) > self.max_calls:
+            self.finished.popitem(last=False)
+        self.output(group, "completed" if group.complete else status)
+
+    def output(self, group, status):
+        ladder = render_ladder(group, status)
+        if self.writer is None:
+            print(ladder)
+            return
+        data = [ladder.encode()]
+        for msg in group.messages:
+            if msg[4] is not None:
+                data.append("\n{} -> {}\n".format(msg[1], msg[2]).encode())
+                data.append(msg[4])
+        data.append(b"\n")
+        self.writer.write(group.callid, b"".join(data))
+
+    def tick(self, now):
+        self.expire(now)
+
+    def close(self):
+        while self.calls:
+            self.remove(next(iter(self.calls)), "incomplete")
+        if self.writer is not None:
+            self.writer.close_files()
+
+class TraceStatsSink(TraceSink):
+    """
+    Counts the traced messages per method, status class, source and
+    destination, over a sliding window of one-second buckets, and redraws
+    a summary table every second
+    """
+
+    COLUMNS = ["Method", "Status", "Source", "Destination"]
+
+    def __init__(self, window=10, top=5):
+        self.window = window
+        self.top = top
+        # each bucket holds the total, retransmitted and per column counters
+        self.buckets = [[0, 0, {}, {}, {}, {}] for _ in range(window)]
+        self.bucket_sec = [None] * window
+        self.last_sec = 0
+        self.retrans = OrderedDict()
+        self.next_refresh = 0
+        self.screen = Screen()
+
+    def count(self, counters, key):
+        if key in counters:
+            counters[key] += 1
+        elif len(counters) < TRACE_STATS_MAX_KEYS:
+            counters[key] = 1
+        else:
+            counters[None] = counters.get(None, 0) + 1
+
+    def push(self, packet):
+        sip = packet.get_sip()
+        if sip is None:
+            return
+        sec = int(packet.ts)
+        if sec > self.last_sec:
+            self.last_sec = sec
+        elif sec <= self.last_sec - self.window:
+            # too late for the window
+            return
+        idx = sec % self.window
+        bucket = self.buckets[idx]
+        if self.bucket_sec[idx] != sec:
+            self.bucket_sec[idx] = sec
+            bucket[0] = bucket[1] = 0
+            for counters in bucket[2:]:
+                counters.clear()
+
+        bucket[0] += 1
+        # a retransmission is the very same message, from the same source
+        key = hash((packet.src_addr, packet.src_port, packet.data))
+        seen = self.retrans.pop(key, None)
+        if seen is not None and sec - seen < TRACE_STATS_RETRANS_TIME:
+            bucket[1] += 1
+        self.retrans[key] = sec
+        if len(self.retrans) > TRACE_STATS_RETRANS_SIZE:
+            self.retrans.popitem(last=False)
+
+        if sip.is_request():
+            self.count(bucket[2], sip.get_method())
+        elif sip.get_status() is not None:
+            self.count(bucket[3], sip.get_status() // 100)
+        self.count(bucket[4], (packet.family, packet.src_addr))
+        self.count(bucket[5], (packet.family, packet.dst_addr))
+
+        now = time()
+        if now >= self.next_refresh:
+            self.refresh(now)
+
+    def format_key(self, column, key):
+        if key is None:
+            return "<other>"
+        if column == 1:
+            return "{}xx".format(key)
+        if column >= 2:
+            try:
+                return socket.inet_ntop(key[0], key[1])
+            except (ValueError, OSError, TypeError):
+                return "?"
+        return key
+
+    def render(self):
+        total = 0
+        retrans = 0
+        columns = [{} for _ in self.COLUMNS]
+        for idx, bucket in enumerate(self.buckets):
+            sec = self.bucket_sec[idx]
+            if sec is None or sec <= self.last_sec - self.window:
+                continue
+            total += bucket[0]
+            retrans += bucket[1]
+            for col, counters in enumerate(bucket[2:]):
+                for key, value in counters.items():
+                    columns[col][key] = columns[col].get(key, 0) + value
+
+        lines = ["SIP traffic over the last {} seconds: {:.1f} msg/s, "
+                "{:.1f} retransmissions/s".format(self.window,
+                    total / self.window, retrans / self.window), ""]
+        tops = []
+        for col, counters in enumerate(columns):
+            best = sorted(counters.items(), key=lambda kv: kv[1],
+                    reverse=True)[:self.top]
+            tops.append([(self.format_key(col, k), v / self.window)
+                for k, v in best])
+        for pair in [(0, 1), (2, 3)]:
+            lines.append("    ".join("{:<24} {:>10}".format(
+                self.COLUMNS[col], "msg/s") for col in pair))
+            for row in range(max(len(tops[col]) for col in pair)):
+                cells = []
+                for col in pair:
+                    if row < len(tops[col]):
+                        cells.append("{:<24} {:>10.1f}".format(
+                            tops[col][row][0][:24], tops[col][row][1]))
+                    else:
+                        cells.append(" " * 35)
+                lines.append("    ".join(cells).rstrip())
+            lines.append("")
+        return "\n".join(lines)
+
+    def refresh(self, now):
+        self.next_refresh = now + 1
+        self.screen.render("{}\n\n{}(press Ctrl-c to exit)\n".format(
+            self.render(), '\t' * 5))
+
+    def tick(self, now):
+        if now >= self.next_refresh:
+            self.refresh(now)
+
+    def close(self):
+        self.screen.render(self.render() + "\n")
+        self.screen.close()
+
+class TraceCallsSink(TraceSink):
+    """
+    Writes the messages of each call in a separate file, named after its
+    Call-ID; only a limited number of files are kept open, the least
+    recently used one being flushed and closed when a new one is needed
+    """
+
+    def __init__(self, directory, max_files=256, buffer_size=16384,
+            shards=2, fmt="hep"):
+        self.directory = directory
+        self.max_files = max_files
+        self.buffer_size = buffer_size
+        self.shards = shards
+        self.fmt = fmt
+        self.files = OrderedDict()
+        self.dirs = set()
+        self.calls = set()
+        self.messages = 0
+        self.skipped = 0
+        self.opened = 0
+
+    def get_path(self, callid):
+        """
+        calls are spread in a tree of directories, based on the hash of their
+        Call-ID, so that none of them ends up with millions of files
+        """
+        digest = "{:08x}".format(zlib.crc32(callid.encode()))
+        shard = os.path.join(self.directory,
+                *[digest[2 * i:2 * i + 2] for i in range(self.shards)])
+        if shard not in self.dirs:
+            os.makedirs(shard, exist_ok=True)
+            self.dirs.add(shard)
+        return os.path.join(shard, call_file_name(callid) + "." + self.fmt)
+
+    def get_file(self, callid):
+        f = self.files.get(callid)
+        if f is not None:
+            self.files.move_to_end(callid)
+            return f
+        while len(self.files) >= self.max_files:
+            self.files.popitem(last=False)[1].close()
+        path = self.get_path(callid)
+        try:
+            f = open(path, "ab", buffering=self.buffer_size)
+        except OSError as e:
+            if e.errno != errno.EMFILE or not self.files:
+                raise
+            # out of descriptors - release half of the files and retry
+            for _ in range((len(self.files) + 1) // 2):
+                self.files.popitem(last=False)[1].close()
+            f = open(path, "ab", buffering=self.buffer_size)
+        self.files[callid] = f
+        self.opened += 1
+        self.calls.add(callid)
+        return f
+
+    def write(self, callid, data):
+        """appends data to the file of a call; returns False on errors"""
+        try:
+            self.get_file(callid).write(data)
+        except OSError as e:
+            logger.error("cannot write call {}: {}".format(callid, e))
+            return False
+        return True
+
+    def push(self, packet):
+        callid = packet.get_callid()
+        if not callid:
+            self.skipped += 1
+            return
+        if self.fmt == "hep":
+            data = packet.encode()
+        else:
+            data = "{}.{:06d} {}/{} {} -> {}\n".format(packet.ts, packet.tms,
+                    packet.protocol, packet.type, packet.get_src(),
+                    packet.get_dst()).encode()
+            if packet.data:
+                data += packet.data + b"\n"
+            data += b"\n"
+        if not self.write(callid, data):
+            self.skipped += 1
+            return
+        self.messages += 1
+
+    def close_files(self):
+        while self.files:
+            self.files.popitem()[1].close()
+
+    def close(self):
+        self.close_files()
+        print("Wrote {} messages of {} calls in {} ({} files opened{})".format(
+            self.messages, len(self.calls), self.directory, self.opened,
+            ", {} messages skipped".format(self.skipped)
+                if self.skipped else ""))
+
+class TraceRingSink(TraceSink):
+    """
+    Keeps the last traced messages in a preallocated ring buffer, without
+    outputting anything, until a trigger matches; then the messages around
+    the trigger are dumped in a HEP file, that can be later replayed. The
+    ring is kept after a dump, so that a later trigger still has the
+    messages before it, only the ones already dumped being skipped
+    """
+
+    def __init__(self, trigger, rate=1, size=10000, seconds=0,
+            memory=16 * 1024 * 1024, after=5, path=None):
+        self.trigger = trigger
+        self.rate = rate
+        self.size = size
+        self.seconds = seconds
+        self.after = after
+        self.path = path
+        # the raw packets are stored back to back in a circular buffer
+        self.buffer = bytearray(memory)
+        self.wpos = 0
+        # while each slot records where a packet starts, its length and time
+        self.offsets = array('q', [0]) * size
+        self.lengths = array('l', [0]) * size
+        self.times = array('d', [0.0]) * size
+        self.tail = 0
+        self.count = 0
+        # packets stored so far, and how many of them were already dumped
+        self.stored = 0
+        self.dumped = 0
+        self.oversized = 0
+        self.rate_sec = None
+        self.rate_count = 0
+        self.triggered = None
+        self.dumps = 0
+
+    def evict(self):
+        self.tail = (self.tail + 1) % self.size
+        self.count -= 1
+
+    def store(self, raw, ts):
+        length = len(raw)
+        if length > len(self.buffer):
+            if not self.oversized:
+                logger.warning("dropping messages larger than the ring "
+                        "({} bytes)".format(len(self.buffer)))
+            self.oversized += 1
+            return
+        if self.count == self.size:
+            self.evict()
+        start = self.wpos
+        if start + length > len(self.buffer):
+            # wrap around, dropping the packets at the end of the buffer
+            while self.count and self.offsets[self.tail] >= start:
+                self.evict()
+            start = 0
+        end = start + length
+        while self.count and self.offsets[self.tail] < end and \
+                self.offsets[self.tail] + self.lengths[self.tail] > start:
+            self.evict()
+        self.buffer[start:end] = raw
+        self.wpos = end
+        slot = (self.tail + self.count) % self.size
+        self.offsets[slot] = start
+        self.lengths[slot] = length
+        self.times[slot] = ts
+        self.count += 1
+        self.stored += 1
+
+    def expire(self, now):
+        if self.seconds:
+            while self.count and self.times[self.tail] < now - self.seconds:
+                self.evict()
+
+    def push(self, packet):
+        ts = packet.ts + packet.tms / 1000000
+        self.store(packet.encode(), ts)
+        if self.triggered is None:
+            self.expire(ts)
+            if self.trigger(packet):
+                sec = int(ts)
+                if sec != self.rate_sec:
+                    self.rate_sec = sec
+                    self.rate_count = 0
+                self.rate_count += 1
+                if self.rate_count >= self.rate:
+                    self.triggered = ts
+                    print("Trigger matched at {}, dumping the messages in "
+                            "{} seconds".format(datetime.fromtimestamp(ts),
+                                self.after))
+        elif ts - self.triggered >= self.after:
+            self.dump()
+
+    def dump(self):
+        root, ext = os.path.splitext(self.path)
+        name = "{}_{:03d}{}".format(root, self.dumps, ext)
+        # skip the messages still in the ring that a previous dump wrote
+        skip = max(self.dumped - (self.stored - self.count), 0)
+        try:
+            with open(name, "wb") as f:
+                for i in range(skip, self.count):
+                    slot = (self.tail + i) % self.size
+                    offset = self.offsets[slot]
+                    f.write(self.buffer[offset:offset + self.lengths[slot]])
+            print("Dumped {} messages in {}".format(self.count - skip, name))
+        except OSError as e:
+            logger.error("cannot dump messages in {}: {}".format(name, e))
+        self.dumps += 1
+        self.dumped = self.stored
+        self.triggered = None
+        self.rate_sec = None
+
+    def tick(self, now):
+        if self.triggered is not None and now - self.triggered >= self.after:
+            self.dump()
+
+    def close(self):
+        if self.triggered is not None:
+            self.dump()
+        if self.oversized:
+            logger.warning("{} messages larger than the ring were dropped".
+                    format(self.oversized))
+
+class TraceGenerator(object):
+    """
+    Synthesizes HEPv3 packets carrying SIP messages, with a given mix of
+    methods and response codes, message size and number of distinct Call-IDs
+    """
+
+    def __init__(self, mix, size=500, callids=1000, seed=None):
+        self.random = random.Random(seed)
+        self.callids = callids
+        self.kinds = []
+        self.weights = []
+        self.templates = {}
+        self.prefixes = {}
+        for kind, weight in mix:
+            self.kinds.append(kind)
+            self.weights.append(weight)
+            self.templates[kind] = self.build_message(kind, size)
+            self.prefixes[kind] = self.build_prefix(isinstance(kind, str))
+
+    def build_message(self, kind, size):
+        """
+        builds the SIP message template of a method or a response code,
+        padded up to size; the Call-ID is filled in for each message
+        """
+        if isinstance(kind, str):
+            first = "{} sip:bob@example.com SIP/2.0".format(kind)
+            method = kind
+        else:
+            first = "SIP/2.0 {} {}".format(kind,
+                    TRACE_SIP_REASONS.get(kind, "Unknown"))
+            method = "INVITE"
+        headers = [
+            first,
+            "Via: SIP/2.0/UDP 10.0.0.1:5060;branch=z9hG4bK%s",
+            "From: <sip:alice@example.com>;tag=%s",
+            "To: <sip:bob@example.com>",
+            "Call-ID: %s",
+            "CSeq: {} {}".format(2 if method == "BYE" else 1, method),
+        ]
+        if isinstance(kind, str):
+            headers.append("Max-Forwards: 70")
+        headers.append("User-Agent: opensips-cli")
+        body = ""
+        if kind == "INVITE" or kind == 200:
+            headers.append("Content-Type: application/sdp")
+            body = TRACE_GENERATE_SDP
+
+        def render(padding):
+            lines = list(headers)
+            if padding > 0:
+                lines.append("X-Padding: " + "x" * padding)
+            lines += ["Content-Length: {}".format(len(body)), "", body]
+            return "\r\n".join(lines)
+
+        message = render(0)
+        # each of the 3 placeholders is replaced by a Call-ID
+        length = len(message) + 3 * (TRACE_GENERATE_CALLID_LEN - 2)
+        # the padding header adds its name and a line terminator
+        return render(size - length - 13).encode()
+
+    def build_prefix(self, request):
+        """builds the HEP chunks that are the same for all the messages"""
+        src = socket.inet_aton("10.0.0.1")
+        dst = socket.inet_aton("10.0.0.2")
+        if not request:
+            src, dst = dst, src
+        return hep_chunk(0x0001, bytes([socket.AF_INET])) + \
+                hep_chunk(0x0002, bytes([socket.IPPROTO_UDP])) + \
+                hep_chunk(0x0003, src) + hep_chunk(0x0004, dst) + \
+                hep_chunk(0x0007, struct.pack("!H", 5060)) + \
+                hep_chunk(0x0008, struct.pack("!H", 5060)) + \
+                hep_chunk(0x000b, bytes([protocol_type_ids["SIP"]])) + \
+                hep_chunk(0x000c, struct.pack("!I", 0))
+
+    def packets(self, count):
+        """returns a list of count random HEPv3 packets"""
+        now = time()
+        timestamp = hep_chunk(0x0009, struct.pack("!I", int(now))) + \
+                hep_chunk(0x000a, struct.pack("!I",
+                    int((now - int(now)) * 1000000)))
+        packets = []
+        for kind in self.random.choices(self.kinds, self.weights, k=count):
+            callid = b"%016x" % self.random.randrange(self.callids)
+            data = self.templates[kind] % (callid, callid, callid)
+            payloads = self.prefixes[kind] + timestamp + \
+                    struct.pack("!HHH", 0, 0x000f, len(data) + 6) + data
+            packets.append(b'HEP3' + struct.pack("!H", len(payloads) + 6) +
+                    payloads)
+        return packets
+
+class TraceSubscription(object):
+    """
+    A set of client options (filter and outputs) that the traced messages
+    are dispatched to; a name is only used when tracing several sets at once
+    """
+
+    def __init__(self, name=None, options=None):
+        self.name = name
+        self.options = options or {}
+        self.filter = None
+        self.sinks = []
+
+    def get_option(self, name):
+        if name in self.options:
+            return self.options[name]
+        if cfg.exists("trace_" + name):
+            return cfg.get("trace_" + name)
+        return TRACE_OPTIONS[name]
+
+    def build_filter(self):
+        try:
+            self.filter = compile_filter(self.get_option("filter"))
+        except TraceFilterException as e:
+            logger.error("cannot compile filter: {}".format(e))
+            return False
+        return True
+
+    def build_sinks(self):
+        sinks = []
+        for output in self.get_option("output").split(","):
+            output = output.strip()
+            if output == "terminal":
+                sinks.append(TraceTerminalSink(self.name))
+            elif output == "pcap":
+                try:
+                    rotate_size = parse_size(
+                            self.get_option("pcap_rotate_size"))
+                    rotate_time = int(self.get_option("pcap_rotate_time"))
+                except ValueError:
+                    logger.error("invalid pcap rotation settings!")
+                    return None
+                try:
+                    sinks.append(TracePcapSink(self.get_option("pcap_file"),
+                            rotate_size, rotate_time))
+                except OSError as e:
+                    logger.error("cannot write pcap file: {}".format(e))
+                    return None
+            elif output == "ladder":
+                if self.get_option("group") not in ["dialog", "transaction"]:
+                    logger.error("calls can only be grouped by dialog " \
+                            "or transaction!")
+                    return None
+                try:
+                    sinks.append(TraceLadderSink(self.get_option("group"),
+                        int(self.get_option("group_max_calls")),
+                        int(self.get_option("group_max_messages")),
+                        parse_size(self.get_option("group_max_memory")),
+                        float(self.get_option("group_timeout")),
+                        self.get_option("ladder_dir")))
+                except ValueError:
+                    logger.error("invalid call grouping settings!")
+                    return None
+            elif output == "stats":
+                try:
+                    window = int(self.get_option("stats_window"))
+                    top = int(self.get_option("stats_top"))
+                except ValueError:
+                    window = 0
+                if window < 1:
+                    logger.error("invalid statistics settings!")
+                    return None
+                sinks.append(TraceStatsSink(window, top))
+            elif output == "ring":
+                try:
+                    trigger = compile_filter(self.get_option("ring_trigger"))
+                except TraceFilterException as e:
+                    logger.error("cannot compile trigger: {}".format(e))
+                    return None
+                if trigger is None:
+                    logger.error("no trigger specified for the ring output!")
+                    return None
+                try:
+                    sinks.append(TraceRingSink(trigger,
+                        int(self.get_option("ring_trigger_rate")),
+                        int(self.get_option("ring_size")),
+                        float(self.get_option("ring_time")),
+                        parse_size(self.get_option("ring_memory")),
+                        float(self.get_option("ring_after")),
+                        self.get_option("ring_file")))
+                except ValueError:
+                    logger.error("invalid ring settings!")
+                    return None
+            elif output == "calls":
+                if self.get_option("calls_format") not in ["hep", "txt"]:
+                    logger.error("calls can only be written as hep or txt!")
+                    return None
+                try:
+                    max_files = int(self.get_option("calls_max_files"))
+                    buffer_size = parse_size(self.get_option("calls_buffer"))
+                    shards = int(self.get_option("calls_shards"))
+                except ValueError:
+                    max_files = 0
+                if max_files < 1 or shards < 0 or shards > 4:
+                    logger.error("invalid calls settings!")
+                    return None
+                sinks.append(TraceCallsSink(self.get_option("calls_dir"),
+                    max_files, buffer_size, shards,
+                    self.get_option("calls_format")))
+            elif output != "none":
+                logger.error("unknown trace output '{}'!".format(output))
+                return None
+        return sinks
+
+    def build(self):
+        if not self.build_filter():
+            return False
+        self.sinks = self.build_sinks()
+        return self.sinks is not None
+
+    def push(self, packet):
+        if self.filter is not None and not self.filter(packet):
+            return
+        for sink in self.sinks:
+            sink.push(packet)
+
+    def tick(self, now):
+        for sink in self.sinks:
+            sink.tick(now)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+
+
 class trace(Module):
 
-    def __print_hep(self, packet):
-        # this works as a HEP parser
-        logger.debug("initial packet size is {}".format(len(packet)))
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.subscriptions = []
+        self.parsed_packets = 0
+        self.parsed_bytes = 0
+
+    def parse_params(self, params):
+        """stores the CLI options and returns the OpenSIPS filters"""
+        self.parsed_packets = 0
+        self.parsed_bytes = 0
+        options = {}
+        filters = []
+        for param in params:
+            name = param.split("=", 1)[0]
+            if name in TRACE_OPTIONS and "=" in param:
+                options[name] = param.split("=", 1)[1]
+            else:
+                filters.append(param)
+        self.subscriptions = [TraceSubscription(None, options)]
+        return filters
+
+    def parse_multi_params(self, params):
+        """
+        parses the parameters of several named traces, specified as
+        name.key=value (the ones without a name apply to all traces); returns
+        a list of (OpenSIPS filters, subscriptions) tuples, one for each
+        distinct set of OpenSIPS filters
+        """
+        self.parsed_packets = 0
+        self.parsed_bytes = 0
+        common = ({}, [])
+        named = OrderedDict()
+        for param in params:
+            key = param.split("=", 1)[0]
+            name = None
+            if "." in key:
+                name, key = key.split(".", 1)
+            if "=" not in param or name == "" or \
+                    (key not in TRACE_OPTIONS and
+                        key not in TRACE_SERVER_FILTERS):
+                logger.error("invalid trace parameter '{}'!".format(param))
+                return None
+            options, filters = common if name is None else \
+                    named.setdefault(name, ({}, []))
+            value = param.split("=", 1)[1]
+            if key in TRACE_OPTIONS:
+                options[key] = value
+            else:
+                filters.append("{}={}".format(key, value))
+        if not named:
+            logger.error("no named trace specified!")
+            return None
+
+        traces = OrderedDict()
+        self.subscriptions = []
+        for name, (options, filters) in named.items():
+            sub_options = dict(common[0])
+            sub_options.update(options)
+            subscription = TraceSubscription(name, sub_options)
+            self.subscriptions.append(subscription)
+            # traces with the same OpenSIPS filters, in any order, share a
+            # single trace_start
+            filters = tuple(sorted(set(common[1] + filters)))
+            traces.setdefault(filters, []).append(subscription)
+        return [(list(filters), subscriptions)
+                for filters, subscriptions in traces.items()]
+
+    def build_subscriptions(self):
+        for subscription in self.subscriptions:
+            if not subscription.build():
+                self.close_subscriptions()
+                return False
+        return True
+
+    def close_subscriptions(self):
+        for subscription in self.subscriptions:
+            subscription.close()
+
+    def push_packet(self, packet, subscriptions):
+        self.parsed_packets += 1
+        for subscription in subscriptions:
+            subscription.push(packet)
 
-        while len(packet) > 0:
-            if len(packet) < 4:
-                return packet
+    def tick_subscriptions(self):
+        now = time()
+        for subscription in self.subscriptions:
+            subscription.tick(now)
+
+    def __parse_hep(self, packet, subscriptions, offset=0):
+        # this works as a HEP parser; returns the offset of the first byte
+        # that has not been parsed yet, or None if the stream is corrupted
+        end = len(packet)
+        while offset < end:
+            if end - offset < 6:
+                return offset
             # currently only HEPv3 is accepted
-            if packet[0:4] != b'HEP3':
-                logger.warning("packet not HEPv3: [{}]".format(packet[0:4]))
+            if packet[offset:offset + 4] != b'HEP3':
+                logger.warning("packet not HEPv3: [{}]".format(
+                    packet[offset:offset + 4]))
+                return None
+            length = int.from_bytes(packet[offset + 4:offset + 6],
+                    byteorder="big", signed=False)
+            if length < 6:
+                logger.warning("invalid HEP packet length {}".format(length))
                 return None
-            length = int.from_bytes(packet[4:6], byteorder="big", signed=False)
-            if length > len(packet):
+            if offset + length > end:
                 logger.debug("partial packet: {} out of {}".
-                        format(len(packet), length))
+                        format(end - offset, length))
                 # wait for entire packet to parse it
-                return packet
-            logger.debug("packet size is {}".format(length))
+                return offset
             # skip the header
-            hep_packet = HEPpacket(packet[6:length])
+            hep_packet = HEPpacket(bytes(packet[offset + 6:offset + length]))
             try:
                 hep_packet.parse()
             except HEPpacketException:
                 return None
-            packet = packet[length:]
-            print(hep_packet)
+            offset += length
+            self.parsed_bytes += length
+            self.push_packet(hep_packet, subscriptions)
+
+        return offset
+
+    def __replay_capture(self, capture):
+        # HEP over TCP may span across multiple segments
+        streams = {}
+        for ts, tms, linktype, frame in read_frames(capture):
+            decoded = decode_frame(linktype, frame)
+            if decoded is None:
+                continue
+            family, proto, src, dst, sport, dport, payload = decoded
+            if proto == socket.IPPROTO_TCP:
+                flow = (src, sport, dst, dport)
+                if flow in streams:
+                    payload = streams.pop(flow) + payload
+            if not payload:
+                continue
+            if payload[:4] == b'HEP3':
+                offset = self.__parse_hep(payload, self.subscriptions)
+                if offset is not None and offset < len(payload) and \
+                        proto == socket.IPPROTO_TCP:
+                    streams[flow] = payload[offset:]
+            elif is_sip(payload):
+                self.parsed_bytes += len(payload)
+                self.push_packet(network_packet(ts, tms, family, proto,
+                    src, dst, sport, dport, payload), self.subscriptions)
+        for flow, payload in streams.items():
+            logger.warning("truncated HEP packet of {} bytes at the end of "
+                    "{}:{} -> {}:{}".format(len(payload), flow[0], flow[1],
+                        flow[2], flow[3]))
+
+    def trace_replay(self, params):
+        if not params:
+            logger.error("no capture file to replay!")
+            return -1
+        replay_file = params[0]
+        filters = self.parse_params(params[1:])
+        if filters:
+            logger.warning("OpenSIPS filters are ignored when replaying: {}".
+                    format(", ".join(filters)))
+
+        try:
+            with open(replay_file, "rb") as f:
+                capture = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            logger.error("cannot read capture {}: {}".format(replay_file, e))
+            return -1
+
+        with capture:
+            if capture[:4] != b'HEP3' and not is_capture(capture):
+                logger.error("unknown format of capture {}".format(replay_file))
+                return -1
+
+            if not self.build_subscriptions():
+                return -1
+
+            start = perf_counter()
+            try:
+                if capture[:4] == b'HEP3':
+                    offset = self.__parse_hep(capture, self.subscriptions)
+                    if offset is not None and offset < len(capture):
+                        logger.warning("truncated HEP packet at offset {}".
+                                format(offset))
+                else:
+                    self.__replay_capture(capture)
+            except KeyboardInterrupt:
+                print('^C')
+            finally:
+                elapsed = perf_counter() - start
+                self.close_subscriptions()
 
-        return packet
+        elapsed = max(elapsed, 1e-6)
+        print("Replayed {} messages ({:.1f} MB) in {:.3f} seconds: "
+                "{:.0f} messages/s, {:.1f} MB/s".format(
+                    self.parsed_packets, self.parsed_bytes / 1048576, elapsed,
+                    self.parsed_packets / elapsed,
+                    self.parsed_bytes / 1048576 / elapsed))
 
     def __complete__(self, command, text, line, begidx, endidx):
-        filters = [ "caller", "callee", "ip" ]
+        filters = TRACE_SERVER_FILTERS + list(TRACE_OPTIONS)
 
         # remove the filters already used
         filters = [f for f in filters if line.find(f + "=") == -1]
         if not command:
-            return filters
+            return TRACE_COMMANDS + filters
 
         if (not text or text == "") and line[-1] == "=":
             return [""]
@@ -218,6 +1632,9 @@ class trace(Module):
         ret = [f for f in filters if (f.startswith(text) and line.find(f + "=") == -1)]
         if len(ret) == 1 :
             ret[0] = ret[0] + "="
+        if len(line.split()) == 2 and line[-1] != " ":
+            # the first parameter may also be a command
+            ret = [c for c in TRACE_COMMANDS if c.startswith(text)] + ret
         return ret
 
     def __get_methods__(self):
@@ -225,7 +1642,16 @@ class trace(Module):
 
     def do_trace(self, params):
 
-        filters = []
+        if params and params[0] == "replay":
+            return self.trace_replay(params[1:])
+        if params and params[0] == "multi":
+            return self.trace_multi(params[1:])
+        if params and params[0] == "generate":
+            return self.trace_generate(params[1:])
+        if params and params[0] == "stats":
+            params = params[1:] + ["output=stats"]
+
+        filters = self.parse_params([])
 
         if params is None:
             caller_f = input("Caller filter: ")
@@ -244,51 +1670,289 @@ class trace(Module):
                     return False
                 filters = None
         else:
-            filters = params
+            filters = self.parse_params(params)
+
+        return self.collect([(filters, self.subscriptions)])
+
+    def generate_receive(self, sock, proto, pipe):
+        """
+        parses the generated traffic received on sock, just like the traced
+        messages, and reports the number of messages parsed through pipe
+        """
+        if not self.build_subscriptions():
+            pipe.send(False)
+            return
+        pipe.send(True)
+        start = end = None
+        try:
+            if proto == socket.IPPROTO_TCP:
+                conn, _ = sock.accept()
+                start = perf_counter()
+                remaining = bytearray()
+                while True:
+                    data = conn.recv(TRACE_BUFFER_SIZE)
+                    if not data:
+                        break
+                    remaining += data
+                    offset = self.__parse_hep(remaining, self.subscriptions)
+                    if offset is None:
+                        break
+                    del remaining[:offset]
+                end = perf_counter()
+                conn.close()
+            else:
+                sock.settimeout(TRACE_GENERATE_LINGER)
+                while True:
+                    try:
+                        data = sock.recv(TRACE_BUFFER_SIZE)
+                    except socket.timeout:
+                        # stop once the generator is done and nothing is left
+                        if pipe.poll():
+                            break
+                        continue
+                    if start is None:
+                        start = perf_counter()
+                    self.__parse_hep(data, self.subscriptions)
+                    end = perf_counter()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            self.close_subscriptions()
+        elapsed = end - start if start is not None else 0
+        pipe.send((self.parsed_packets, self.parsed_bytes, elapsed))
+
+    def trace_generate(self, params):
+        options = dict(TRACE_GENERATE_OPTIONS)
+        receiver_params = []
+        for param in params:
+            name = param.split("=", 1)[0]
+            if name in TRACE_GENERATE_OPTIONS and "=" in param:
+                options[name] = param.split("=", 1)[1]
+            else:
+                receiver_params.append(param)
+        filters = self.parse_params(receiver_params)
+        if filters:
+            logger.warning("OpenSIPS filters are ignored when generating: {}".
+                    format(", ".join(filters)))
+        self.subscriptions[0].options.setdefault("output", "none")
+
+        try:
+            mix = []
+            for entry in options["mix"].split(","):
+                kind, weight = entry.strip().split(":")
+                weight = float(weight)
+                if not 0 <= weight < float("inf"):
+                    raise ValueError("invalid weight {}".format(weight))
+                mix.append((int(kind) if kind.isdigit() else kind.upper(),
+                    weight))
+            if sum(weight for _, weight in mix) <= 0:
+                raise ValueError("no message to generate")
+            rate = float(options["rate"])
+            duration = float(options["duration"])
+            count = int(options["count"])
+            generator = TraceGenerator(mix, int(options["size"]),
+                    int(options["callids"]))
+        except ValueError:
+            logger.error("invalid traffic generation settings!")
+            return False
+        if options["transport"] == "tcp":
+            proto = socket.IPPROTO_TCP
+            sock_type = socket.SOCK_STREAM
+        elif options["transport"] == "udp":
+            proto = socket.IPPROTO_UDP
+            sock_type = socket.SOCK_DGRAM
+        else:
+            logger.error("unknown transport '{}'!".format(options["transport"]))
+            return False
+
+        receiver = None
+        if options["target"]:
+            host, _, port = options["target"].rpartition(":")
+            try:
+                target = (host, int(port))
+            except ValueError:
+                logger.error("invalid target '{}'!".format(options["target"]))
+                return False
+        else:
+            # parse the traffic in a separate process, using all the outputs
+            # and filters specified, to measure the throughput of the tracer
+            sock = socket.socket(socket.AF_INET, sock_type)
+            sock.bind(("127.0.0.1", 0))
+            if proto == socket.IPPROTO_TCP:
+                sock.listen(1)
+            target = sock.getsockname()
+            context = multiprocessing.get_context("fork")
+            pipe, receiver_pipe = context.Pipe()
+            receiver = context.Process(target=self.generate_receive,
+                    args=(sock, proto, receiver_pipe))
+            receiver.start()
+            sock.close()
+            if not pipe.recv():
+                receiver.join()
+                return False
+
+        sent = 0
+        sent_bytes = 0
+        errors = 0
+        out = socket.socket(socket.AF_INET, sock_type)
+        start = perf_counter()
+        try:
+            if proto == socket.IPPROTO_TCP:
+                out.connect(target)
+            while True:
+                elapsed = perf_counter() - start
+                if count and sent >= count or not count and elapsed >= duration:
+                    break
+                if rate:
+                    delay = sent / rate - elapsed
+                    if delay > 0:
+                        sleep(delay)
+                batch = TRACE_GENERATE_BATCH
+                if count:
+                    batch = min(batch, count - sent)
+                packets = generator.packets(batch)
+                if proto == socket.IPPROTO_TCP:
+                    out.sendall(b''.join(packets))
+                else:
+                    for packet in packets:
+                        try:
+                            out.sendto(packet, target)
+                        except OSError:
+                            errors += 1
+                sent += len(packets)
+                sent_bytes += sum(len(packet) for packet in packets)
+        except KeyboardInterrupt:
+            print('^C')
+        except OSError as e:
+            logger.error("cannot send traffic to {}:{}: {}".format(
+                target[0], target[1], e))
+        finally:
+            elapsed = max(perf_counter() - start, 1e-6)
+            out.close()
+
+        print("Sent {} messages ({:.1f} MB) over {} in {:.3f} seconds: "
+                "{:.0f} messages/s{}".format(sent, sent_bytes / 1048576,
+                    options["transport"].upper(), elapsed, sent / elapsed,
+                    " (target {:.0f} messages/s)".format(rate) if rate else ""))
+        if errors:
+            print("Failed to send {} messages".format(errors))
+        if receiver is None:
+            return True
+
+        pipe.send(True)
+        try:
+            received, received_bytes, received_elapsed = pipe.recv()
+        except (EOFError, KeyboardInterrupt):
+            receiver.join()
+            return False
+        receiver.join()
+        received_elapsed = max(received_elapsed, 1e-6)
+        dropped = sent - errors - received
+        print("Parsed {} messages ({:.1f} MB) in {:.3f} seconds: "
+                "{:.0f} messages/s, {} dropped ({:.2f}%)".format(received,
+                    received_bytes / 1048576, received_elapsed,
+                    received / received_elapsed, dropped,
+                    100 * dropped / max(sent, 1)))
+        return True
+
+    def trace_multi(self, params):
+        traces = self.parse_multi_params(params)
+        if traces is None:
+            return False
+        return self.collect(traces)
+
+    def collect(self, traces):
+        """
+        registers a trace_start for each (OpenSIPS filters, subscriptions)
+        tuple, each of them towards a different listening socket, so that the
+        messages received are dispatched to the subscriptions of their trace
+        """
+        if not self.build_subscriptions():
+            return False
+        if not any(isinstance(sink, TraceTerminalSink)
+                for subscription in self.subscriptions
+                for sink in subscription.sinks):
+            print("Tracing in the background (press Ctrl-c to stop)")
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         if cfg.exists("trace_listen_ip"):
             trace_ip = cfg.get("trace_listen_ip")
         else:
             trace_ip = "127.0.0.1"
         if cfg.exists("trace_listen_port"):
-            trace_port = cfg.get("trace_listen_port")
+            trace_port = int(cfg.get("trace_listen_port"))
         else:
             trace_port = 0
-        s.bind((trace_ip, int(trace_port)))
-        if trace_port == 0:
-            trace_port = s.getsockname()[1]
-        s.listen(1)
-        conn = None
-        trace_name = "opensips-cli.{}".format(random.randint(0, 65536))
-        trace_socket = "hep:{}:{};transport=tcp;version=3".format(
-                trace_ip, trace_port)
-        args = {
-            'id': trace_name,
-            'uri': trace_socket,
-        }
-        if filters:
-            args['filters'] = filters
-
-        logger.debug("filters are {}".format(filters))
-        trace_started = comm.execute('trace_start', args)
-        if not trace_started:
-            return False
 
+        sel = selectors.DefaultSelector()
+        started = []
         try:
-            conn, addr = s.accept()
-            logger.debug("New TCP connection from {}:{}".
-                    format(addr[0], addr[1]))
-            remaining = b''
+            for filters, subscriptions in traces:
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sel.register(s, selectors.EVENT_READ, (None, subscriptions))
+                s.bind((trace_ip, trace_port))
+                s.listen(1)
+                # the configured port can only be used by the first trace
+                trace_port = 0
+                trace_name = "opensips-cli.{}".format(
+                        random.randint(0, 65536))
+                trace_socket = "hep:{}:{};transport=tcp;version=3".format(
+                        trace_ip, s.getsockname()[1])
+                args = {
+                    'id': trace_name,
+                    'uri': trace_socket,
+                }
+                if filters:
+                    args['filters'] = filters
+
+                logger.debug("filters of {} are {}".format(trace_name,
+                    filters))
+                trace_started = comm.execute('trace_start', args)
+                if not trace_started:
+                    return False
+                started.append(trace_name)
+
+            connections = 0
+            last_tick = time()
             while True:
-                data = conn.recv(TRACE_BUFFER_SIZE)
-                if not data:
-                    break
-                remaining = self.__print_hep(remaining + data)
-                if remaining is None:
-                    break
+                events = sel.select(1)
+                for key, _ in events:
+                    remaining, subscriptions = key.data
+                    if remaining is None:
+                        conn, addr = key.fileobj.accept()
+                        logger.debug("New TCP connection from {}:{}".
+                                format(addr[0], addr[1]))
+                        sel.register(conn, selectors.EVENT_READ,
+                                (bytearray(), subscriptions))
+                        connections += 1
+                        continue
+                    data = key.fileobj.recv(TRACE_BUFFER_SIZE)
+                    offset = None
+                    if data:
+                        remaining += data
+                        offset = self.__parse_hep(remaining, subscriptions)
+                    if offset is None:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                        connections -= 1
+                        if connections == 0:
+                            return True
+                        continue
+                    del remaining[:offset]
+                if not events or time() - last_tick >= 1:
+                    self.tick_subscriptions()
+                    last_tick = time()
         except KeyboardInterrupt:
-            comm.execute('trace_stop', {'id' : trace_name }, True)
-            if conn is not None:
-                conn.close()
+            pass
+        except OSError as e:
+            logger.error("cannot receive traced messages: {}".format(e))
+            return False
+        finally:
+            for trace_name in started:
+                comm.execute('trace_stop', {'id' : trace_name }, True)
+            for key in list(sel.get_map().values()):
+                key.fileobj.close()
+            sel.close()
+            self.close_subscriptions()
+        return True
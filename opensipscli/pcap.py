@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+pcap.py - reads and writes captured traffic in the pcap/pcapng formats
+
+find out more information here:
+* https://www.ietf.org/archive/id/draft-tuexen-opsawg-pcapng-05.html
+"""
+
+import os
+import sys
+import socket
+import struct
+from array import array
+from collections import OrderedDict
+from opensipscli.logger import logger
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+# raw IPv4/IPv6 frames, no link layer header
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# pcap magic: (byte order, timestamp units per second)
+PCAP_MAGICS = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),
+}
+
+PCAP_SNAPLEN = 262144
+PCAP_BUFFER_SIZE = 1024 * 1024
+
+# maximum number of TCP flows we keep sequence numbers for
+PCAP_MAX_TCP_FLOWS = 65536
+
+def inet_checksum(data, initial=0):
+    """computes the internet (RFC 1071) checksum of a buffer"""
+    if len(data) % 2:
+        data = data + b'\0'
+    words = array('H', data)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    total = initial + sum(words)
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+class PcapFrameBuilder(object):
+    """
+    Rebuilds the IP and UDP/TCP headers of a captured message
+    """
+
+    def __init__(self):
+        self.ip_id = 0
+        self.tcp_seq = OrderedDict()
+
+    def build(self, family, proto, src, dst, sport, dport, payload):
+        if proto == socket.IPPROTO_TCP:
+            l4 = self.build_tcp(src, dst, sport, dport, payload)
+        else:
+            # anything that is not TCP is displayed as UDP
+            proto = socket.IPPROTO_UDP
+            l4 = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+
+        if family == socket.AF_INET6:
+            pseudo = src + dst + struct.pack("!IxxxB", len(l4), proto)
+            l4 = self.set_checksum(l4, proto, pseudo)
+            return struct.pack("!IHBB", 0x60000000, len(l4), proto, 64) + \
+                    src + dst + l4
+
+        if proto == socket.IPPROTO_TCP:
+            pseudo = src + dst + struct.pack("!xBH", proto, len(l4))
+            l4 = self.set_checksum(l4, proto, pseudo)
+        self.ip_id = (self.ip_id + 1) & 0xffff
+        hdr = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(l4),
+                self.ip_id, 0x4000, 64, proto, 0, src, dst)
+        return hdr[:10] + struct.pack("!H", inet_checksum(hdr)) + \
+                hdr[12:] + l4
+
+    def set_checksum(self, l4, proto, pseudo):
+        csum = inet_checksum(pseudo + l4)
+        if proto == socket.IPPROTO_UDP:
+            # a zero UDP checksum means "no checksum"
+            csum = csum or 0xffff
+            off = 6
+        else:
+            off = 16
+        return l4[:off] + struct.pack("!H", csum) + l4[off + 2:]
+
+    def build_tcp(self, src, dst, sport, dport, payload):
+        flow = (src, sport, dst, dport)
+        seq = self.tcp_seq.pop(flow, 1)
+        self.tcp_seq[flow] = (seq + len(payload)) & 0xffffffff
+        if len(self.tcp_seq) > PCAP_MAX_TCP_FLOWS:
+            self.tcp_seq.popitem(last=False)
+        # PSH|ACK, 5 words of header
+        return struct.pack("!HHIIBBHHH", sport, dport, seq, 0,
+                5 << 4, 0x18, 65535, 0, 0) + payload
+
+class PcapngWriter(object):
+    """
+    Streams raw IP frames to a pcapng file, optionally rotating it by size
+    (in bytes) and/or by time (in seconds)
+    """
+
+    def __init__(self, path, rotate_size=0, rotate_time=0,
+            buffer_size=PCAP_BUFFER_SIZE):
+        self.path = path
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.buffer_size = buffer_size
+        self.builder = PcapFrameBuilder()
+        self.index = 0
+        self.file = None
+        self.file_name = None
+        self.file_size = 0
+        self.file_start = None
+        self.packets = 0
+
+    def next_file_name(self):
+        if not self.rotate_size and not self.rotate_time:
+            return self.path
+        root, ext = os.path.splitext(self.path)
+        name = "{}_{:05d}{}".format(root, self.index, ext)
+        self.index += 1
+        return name
+
+    def open(self, ts):
+        self.close()
+        self.file_name = self.next_file_name()
+        logger.debug("writing capture to {}".format(self.file_name))
+        self.file = open(self.file_name, "wb", buffering=self.buffer_size)
+        shb = struct.pack("=IIIHHq", PCAPNG_SHB, 28,
+                PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1) + struct.pack("=I", 28)
+        idb = struct.pack("=IIHHII", PCAPNG_IDB, 20,
+                LINKTYPE_RAW, 0, PCAP_SNAPLEN, 20)
+        self.file.write(shb + idb)
+        self.file_size = len(shb) + len(idb)
+        self.file_start = ts
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write_frame(self, ts, tus, frame):
+        """writes an already built IP frame, timestamped at ts.tus"""
+        if self.file is None:
+            self.open(ts)
+        elif (self.rotate_size and self.file_size >= self.rotate_size) or \
+                (self.rotate_time and ts - self.file_start >= self.rotate_time):
+            self.open(ts)
+
+        tstamp = ts * 1000000 + tus
+        length = len(frame)
+        pad = -length % 4
+        block_len = 32 + length + pad
+        self.file.write(struct.pack("=IIIIIII", PCAPNG_EPB, block_len, 0,
+                    tstamp >> 32, tstamp & 0xffffffff, length, length) +
+                frame + b'\0' * pad + struct.pack("=I", block_len))
+        self.file_size += block_len
+        self.packets += 1
+
+    def write(self, ts, tus, family, proto, src, dst, sport, dport, payload):
+        """writes a message, rebuilding its IP and transport headers"""
+        self.write_frame(ts, tus, self.builder.build(family, proto,
+            src, dst, sport, dport, payload))
+
+def is_capture(buf):
+    """checks whether a buffer holds a pcap or a pcapng capture"""
+    return buf[:4] in PCAP_MAGICS or buf[:4] == b'\x0a\x0d\x0d\x0a'
+
+def read_frames(buf):
+    """
+    iterates through the frames of a pcap or pcapng buffer, returning for each
+    of them a (seconds, microseconds, linktype, frame) tuple
+    """
+    if buf[:4] in PCAP_MAGICS:
+        return read_pcap_frames(buf)
+    return read_pcapng_frames(buf)
+
+def read_pcap_frames(buf):
+    endian, units = PCAP_MAGICS[buf[:4]]
+    linktype = struct.unpack_from(endian + "I", buf, 20)[0] & 0xffff
+    record = struct.Struct(endian + "IIII")
+    offset = 24
+    end = len(buf)
+    while offset + 16 <= end:
+        sec, frac, caplen, _ = record.unpack_from(buf, offset)
+        offset += 16
+        if offset + caplen > end:
+            logger.warning("truncated pcap record at offset {}".format(offset))
+            break
+        yield sec, frac * 1000000 // units, linktype, \
+                buf[offset:offset + caplen]
+        offset += caplen
+
+def read_pcapng_idb(buf, offset, block_len, endian):
+    """returns the linktype and timestamp units of an interface"""
+    linktype = struct.unpack_from(endian + "H", buf, offset + 8)[0]
+    units = 1000000
+    opt = offset + 16
+    end = offset + block_len - 4
+    while opt + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", buf, opt)
+        if code == 0:
+            break
+        if code == 9 and length == 1:
+            # if_tsresol
+            resol = buf[opt + 4]
+            units = 2 ** (resol & 0x7f) if resol & 0x80 else 10 ** resol
+        opt += 4 + length + (-length % 4)
+    return linktype, units
+
+def read_pcapng_frames(buf):
+    endian = "<"
+    interfaces = []
+    offset = 0
+    end = len(buf)
+    while offset + 12 <= end:
+        if buf[offset:offset + 4] == b'\x0a\x0d\x0d\x0a':
+            # a new section, which may have a different byte order
+            endian = "<" if struct.unpack_from("<I", buf, offset + 8)[0] == \
+                    PCAPNG_BYTE_ORDER_MAGIC else ">"
+            interfaces = []
+        block_type, block_len = struct.unpack_from(endian + "II", buf, offset)
+        if block_len < 12 or offset + block_len > end:
+            logger.warning("truncated pcapng block at offset {}".format(offset))
+            break
+        if block_type == PCAPNG_IDB:
+            interfaces.append(read_pcapng_idb(buf, offset, block_len, endian))
+        elif block_type == PCAPNG_EPB:
+            iface, ts_high, ts_low, caplen = \
+                    struct.unpack_from(endian + "IIII", buf, offset + 8)
+            if iface >= len(interfaces):
+                logger.warning("pcapng packet at offset {} refers to unknown "
+                        "interface {}".format(offset, iface))
+                offset += block_len
+                continue
+            linktype, units = interfaces[iface]
+            tstamp = (ts_high << 32) | ts_low
+            yield tstamp // units, (tstamp % units) * 1000000 // units, \
+                    linktype, buf[offset + 28:offset + 28 + caplen]
+        elif block_type == PCAPNG_SPB and interfaces:
+            length = struct.unpack_from(endian + "I", buf, offset + 8)[0]
+            length = min(length, block_len - 16)
+            yield 0, 0, interfaces[0][0], buf[offset + 12:offset + 12 + length]
+        offset += block_len
+
+def decode_frame(linktype, frame):
+    """
+    decodes an UDP or TCP frame and returns a (family, proto, src, dst, sport,
+    dport, payload) tuple, or None if the frame cannot be decoded
+    """
+    try:
+        if linktype == LINKTYPE_ETHERNET:
+            ethertype = struct.unpack_from("!H", frame, 12)[0]
+            off = 14
+            # skip any VLAN tags
+            while ethertype in (0x8100, 0x88a8):
+                ethertype = struct.unpack_from("!H", frame, off + 2)[0]
+                off += 4
+        elif linktype == LINKTYPE_LINUX_SLL:
+            off = 16
+        elif linktype == LINKTYPE_LINUX_SLL2:
+            off = 20
+        elif linktype == LINKTYPE_NULL:
+            off = 4
+        elif linktype == LINKTYPE_RAW:
+            off = 0
+        else:
+            return None
+
+        version = frame[off] >> 4
+        if version == 4:
+            hdr_len = (frame[off] & 0x0f) * 4
+            total_len, frag = struct.unpack_from("!HxxH", frame, off + 2)
+            if frag & 0x3fff:
+                # fragments are not reassembled
+                return None
+            family = socket.AF_INET
+            proto = frame[off + 9]
+            src = bytes(frame[off + 12:off + 16])
+            dst = bytes(frame[off + 16:off + 20])
+            l4 = off + hdr_len
+            end = off + total_len
+        elif version == 6:
+            family = socket.AF_INET6
+            proto = frame[off + 6]
+            src = bytes(frame[off + 8:off + 24])
+            dst = bytes(frame[off + 24:off + 40])
+            l4 = off + 40
+            end = l4 + struct.unpack_from("!H", frame, off + 4)[0]
+        else:
+            return None
+
+        sport, dport = struct.unpack_from("!HH", frame, l4)
+        if proto == socket.IPPROTO_UDP:
+            payload = frame[l4 + 8:end]
+        elif proto == socket.IPPROTO_TCP:
+            payload = frame[l4 + (frame[l4 + 12] >> 4) * 4:end]
+        else:
+            return None
+    except (IndexError, struct.error):
+        return None
+
+    return family, proto, src, dst, sport, dport, bytes(payload)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+procstat.py - samples the CPU usage and context switches of processes
+"""
+
+import os
+import time
+from collections import namedtuple
+
+try:
+    import psutil
+    have_psutil = True
+except:
+    have_psutil = False
+
+try:
+    CLK_TCK = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    CLK_TCK = 100
+
+# initial sizes of the buffers the /proc files are read in; they only grow
+# if a file does not fit
+PROC_STAT_BUFFER_SIZE = 1024
+PROC_STATUS_BUFFER_SIZE = 4096
+PROC_VOLUNTARY = b"\nvoluntary_ctxt_switches:"
+PROC_INVOLUNTARY = b"\nnonvoluntary_ctxt_switches:"
+
+# cpu, user, system: percents of a CPU used since the previous sample;
+# voluntary, involuntary: context switches per second - voluntary ones are
+# due to the process blocking (i.e. on I/O), involuntary ones to it being
+# preempted; state: R (running), S (sleeping), D (waiting on disk I/O) etc.
+ProcessUsage = namedtuple('ProcessUsage', ['cpu', 'user', 'system',
+    'voluntary', 'involuntary', 'state'])
+
+def find_int(buf, name, end):
+    """returns the integer following name in buf, or None if not found"""
+    pos = buf.find(name, 0, end)
+    if pos < 0:
+        return None
+    pos += len(name)
+    eol = buf.find(b"\n", pos, end)
+    return int(buf[pos:end if eol < 0 else eol])
+
+class ProcessSampler(object):
+    """
+    Samples the CPU times and context switches of a list of processes,
+    reading their /proc files into reusable buffers, and turns the
+    differences between two samples into rates; psutil is only used where
+    /proc is not available
+    """
+
+    def __init__(self):
+        self.stat_buf = bytearray(PROC_STAT_BUFFER_SIZE)
+        self.status_buf = bytearray(PROC_STATUS_BUFFER_SIZE)
+        self.use_proc = os.path.exists("/proc/self/stat")
+        self.psutil_procs = {}
+        self.pids = None
+        self.prev = None
+        self.prev_time = None
+
+    def available(self):
+        return self.use_proc or have_psutil
+
+    def read_file(self, path, buf):
+        """
+        reads a file in buf, replaced by a larger one if the file does not
+        fit, returning the size read along with the buffer used
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            while True:
+                size = os.preadv(fd, [buf], 0)
+                if size < len(buf):
+                    return size, buf
+                buf = bytearray(len(buf) * 2)
+        finally:
+            os.close(fd)
+
+    def read_proc(self, pid):
+        size, self.stat_buf = self.read_file("/proc/{}/stat".format(pid),
+                self.stat_buf)
+        buf = self.stat_buf
+        # the name of the process, in parentheses, may contain anything
+        fields = buf[buf.rfind(b")", 0, size) + 2:size].split(None, 13)
+        size, self.status_buf = self.read_file("/proc/{}/status".format(pid),
+                self.status_buf)
+        return (int(fields[11]) / CLK_TCK, int(fields[12]) / CLK_TCK,
+                find_int(self.status_buf, PROC_VOLUNTARY, size),
+                find_int(self.status_buf, PROC_INVOLUNTARY, size),
+                chr(fields[0][0]))
+
+    def read_psutil(self, pid):
+        proc = self.psutil_procs.get(pid)
+        if proc is None:
+            proc = psutil.Process(pid)
+            self.psutil_procs[pid] = proc
+        with proc.oneshot():
+            times = proc.cpu_times()
+            switches = proc.num_ctx_switches()
+            state = proc.status()
+        return (times.user, times.system, switches.voluntary,
+                switches.involuntary, state[:1].upper())
+
+    def read(self, pid):
+        """returns (user time, system time, voluntary, involuntary, state)"""
+        try:
+            if self.use_proc:
+                return self.read_proc(pid)
+            if have_psutil:
+                return self.read_psutil(pid)
+        except Exception:
+            # the process is gone, i.e. OpenSIPS was restarted
+            self.psutil_procs.pop(pid, None)
+        return None
+
+    def sample(self, pids):
+        """
+        samples all the processes in pids, returning the usage of each of
+        them since the previous sample, or None if not known (yet)
+        """
+        now = time.monotonic()
+        values = [self.read(pid) for pid in pids]
+        prev, prev_time = self.prev, self.prev_time
+        if pids != self.pids:
+            # a new set of processes - nothing to compare against
+            prev = None
+            self.pids = list(pids)
+        self.prev, self.prev_time = values, now
+        if prev is None or now <= prev_time:
+            return {pid: None for pid in pids}
+
+        elapsed = now - prev_time
+        usage = {}
+        for pid, cur, old in zip(pids, values, prev):
+            if cur is None or old is None:
+                usage[pid] = None
+                continue
+            user = (cur[0] - old[0]) / elapsed * 100
+            system = (cur[1] - old[1]) / elapsed * 100
+            switches = [None if cur[i] is None or old[i] is None else
+                    (cur[i] - old[i]) / elapsed for i in (2, 3)]
+            usage[pid] = ProcessUsage(user + system, user, system,
+                    switches[0], switches[1], cur[4])
+        return usage
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+rules.py - alerting rules, evaluated over a window of OpenSIPS statistics
+
+A rule is given on a line of its own, as:
+
+    name: condition [for DURATION] [severity SEVERITY]
+
+where the condition is an expression over statistics (e.g. core:rcv_requests,
+standing for their current value), numbers, durations (e.g. 30s, 5m, 1h),
+the + - * / arithmetic operators, comparisons, and/or/not, and the
+functions:
+* rate(stat[, window]) - increase per second of a counter over the window
+  (or since the previous sample)
+* delta(stat[, window]) - increase of a counter over the window (or since
+  the previous sample)
+* avg(stat, window), min(stat, window), max(stat, window) - of the values
+  sampled during the window
+
+A rule fires once its condition holds for at least DURATION, and resolves
+as soon as it no longer does.  A condition that cannot be evaluated (i.e.
+missing statistics, not enough samples, divisions by zero) leaves the rule
+in its current state.
+"""
+
+import ast
+import re
+import json
+import math
+import time
+import queue
+import threading
+import urllib.request
+from bisect import bisect_left
+from opensipscli.logger import logger
+
+# statistic names contain a colon, e.g. core:rcv_requests or pkmem:1-free_size
+RULE_STATISTIC = re.compile(r"(?<![\w.])[A-Za-z_]\w*:[\w.-]*\w")
+RULE_DURATION = re.compile(r"(?<![\w.])(\d+(?:\.\d+)?)([smh])\b")
+RULE_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+RULE_NAME = re.compile(r"^\w[\w.-]*$")
+RULE_LINE = re.compile(r"^(?P<cond>.*?)(?:\s+for\s+(?P<for>\S+))?"
+        r"(?:\s+severity\s+(?P<severity>\w+))?\s*$")
+RULE_SEVERITIES = ["NOTICE", "WARNING", "CRITICAL"]
+RULE_DEFAULT_SEVERITY = "WARNING"
+# functions: whether they need a window
+RULE_FUNCTIONS = {'rate': False, 'delta': False, 'avg': True, 'min': True,
+        'max': True}
+RULE_ALLOWED_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or,
+        ast.UnaryOp, ast.Not, ast.USub, ast.UAdd, ast.BinOp, ast.Add,
+        ast.Sub, ast.Mult, ast.Div, ast.Compare, ast.Gt, ast.GtE, ast.Lt,
+        ast.LtE, ast.Eq, ast.NotEq, ast.Call, ast.Name, ast.Load,
+        ast.Constant)
+# placeholder the statistics are replaced with, while parsing
+RULE_STAT_PREFIX = "_stat"
+
+ALERT_TIMEOUT = 5
+
+class RuleError(Exception):
+    pass
+
+class RuleUnknown(Exception):
+    """raised while evaluating a condition that needs a missing value"""
+    pass
+
+def known(function):
+    """
+    wraps a function of the conditions, so that a missing value makes the
+    whole condition unknown, instead of being taken as false by and/or/not
+    """
+    def get(*args):
+        value = function(*args)
+        if value is None:
+            raise RuleUnknown()
+        return value
+    return get
+
+def parse_duration(value):
+    """parses a duration, i.e. 30, 30s, 5m or 1h, into seconds"""
+    match = RULE_DURATION.fullmatch(value)
+    if match:
+        return float(match.group(1)) * RULE_DURATION_UNITS[match.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        raise RuleError("invalid duration '{}'".format(value))
+
+class StatsWindow(object):
+    """
+    The samples of the statistics used by the rules, shared by all of them:
+    each statistic gets a slot in a table built when the rules are compiled,
+    and each sample appends one value to the array of each slot
+    """
+
+    def __init__(self, names, keep):
+        self.names = names
+        self.keep = keep
+        self.times = []
+        self.values = [[] for _ in names]
+        # window -> index of its first sample, for the current sample
+        self.starts = {}
+
+    def update(self, ts, stats):
+        nan = math.nan
+        self.times.append(ts)
+        for name, values in zip(self.names, self.values):
+            try:
+                values.append(float(stats.get(name, nan)))
+            except (TypeError, ValueError):
+                values.append(nan)
+        # trim in batches, so that each sample costs the same, on average
+        if len(self.times) > 2 * self.keep:
+            extra = len(self.times) - self.keep
+            del self.times[:extra]
+            for values in self.values:
+                del values[:extra]
+        self.starts = {}
+
+    def start(self, window):
+        """
+        returns the index of the first sample of a window ending with the
+        current sample, or the previous sample if no window is given
+        """
+        index = self.starts.get(window)
+        if index is None:
+            if window is None:
+                index = len(self.times) - 2
+            else:
+                # tolerate some jitter of the sampling times
+                index = bisect_left(self.times,
+                        self.times[-1] - window * 1.01)
+            index = self.starts[window] = max(index, 0)
+        return index
+
+    def last(self, stat):
+        value = self.values[stat][-1]
+        return None if value != value else value
+
+    def delta(self, stat, window=None):
+        start = self.start(window)
+        if start >= len(self.times) - 1:
+            return None
+        values = self.values[stat]
+        diff = values[-1] - values[start]
+        # a counter going back (i.e. OpenSIPS restarted) tells nothing
+        if diff != diff or diff < 0:
+            return None
+        return diff
+
+    def rate(self, stat, window=None):
+        diff = self.delta(stat, window)
+        if diff is None:
+            return None
+        return diff / (self.times[-1] - self.times[self.start(window)])
+
+    def sampled(self, stat, window):
+        return [v for v in self.values[stat][self.start(window):] if v == v]
+
+    def avg(self, stat, window):
+        values = self.sampled(stat, window)
+        return sum(values) / len(values) if values else None
+
+    def min(self, stat, window):
+        values = self.sampled(stat, window)
+        return min(values) if values else None
+
+    def max(self, stat, window):
+        values = self.sampled(stat, window)
+        return max(values) if values else None
+
+class RuleCompiler(ast.NodeTransformer):
+    """
+    checks the syntax tree of a condition, turning each statistic used as a
+    value into a call to last(), and collecting the windows used
+    """
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.windows = set()
+
+    def generic_visit(self, node):
+        if not isinstance(node, RULE_ALLOWED_NODES):
+            raise RuleError("rule {}: {} not allowed".format(self.rule,
+                type(node).__name__))
+        return super().generic_visit(node)
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, (int, float)) or \
+                isinstance(node.value, bool):
+            raise RuleError("rule {}: only numbers are allowed".format(
+                self.rule))
+        return node
+
+    def visit_Name(self, node):
+        if not node.id.startswith(RULE_STAT_PREFIX):
+            raise RuleError("rule {}: unknown name '{}'".format(self.rule,
+                node.id))
+        return ast.copy_location(ast.Call(func=ast.Name(id='last',
+            ctx=ast.Load()), args=[node], keywords=[]), node)
+
+    def visit_Call(self, node):
+        name = node.func.id if isinstance(node.func, ast.Name) else None
+        if name not in RULE_FUNCTIONS or node.keywords:
+            raise RuleError("rule {}: unknown function".format(self.rule))
+        needs_window = RULE_FUNCTIONS[name]
+        if not node.args or len(node.args) > 2 or \
+                (needs_window and len(node.args) != 2) or \
+                not isinstance(node.args[0], ast.Name) or \
+                not node.args[0].id.startswith(RULE_STAT_PREFIX):
+            raise RuleError("rule {}: {}() takes a statistic{}".format(
+                self.rule, name, ", then a window" if needs_window else
+                " and, optionally, a window"))
+        if len(node.args) == 2:
+            window = node.args[1]
+            if not isinstance(window, ast.Constant) or \
+                    not isinstance(window.value, (int, float)) or \
+                    window.value <= 0:
+                raise RuleError("rule {}: the window of {}() must be a "
+                        "positive duration".format(self.rule, name))
+            self.windows.add(window.value)
+        return node
+
+class Rule(object):
+    def __init__(self, name, condition, duration, severity, code, value_code):
+        self.name = name
+        self.condition = condition
+        self.duration = duration
+        self.severity = severity
+        self.code = code
+        # the left side of the comparison, if the condition is one
+        self.value_code = value_code
+        self.pending_since = None
+        self.firing = False
+
+class RulesPlan(object):
+    """
+    The rules, compiled once: the statistics they need, fetched all at once,
+    the window they are sampled in, and the code of each condition
+    """
+
+    def __init__(self, text, interval):
+        self.interval = interval
+        self.rules = []
+        stats = {}
+        windows = set()
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            self.rules.append(self.compile_rule(line, stats, windows))
+        if not self.rules:
+            raise RuleError("no rules defined")
+        self.statistics = sorted(stats, key=stats.get)
+        longest = max(windows, default=0)
+        self.window = StatsWindow(self.statistics,
+                int(longest / interval) + 2)
+        window = self.window
+        self.env = {'__builtins__': {}, 'last': known(window.last),
+                'rate': known(window.rate), 'delta': known(window.delta),
+                'avg': known(window.avg), 'min': known(window.min),
+                'max': known(window.max)}
+        for name, index in stats.items():
+            self.env[RULE_STAT_PREFIX + str(index)] = index
+
+    def compile_rule(self, line, stats, windows):
+        name, _, rest = line.partition(':')
+        name = name.strip()
+        if not RULE_NAME.match(name):
+            raise RuleError("invalid rule '{}'".format(line))
+        match = RULE_LINE.match(rest.strip())
+        severity = (match.group('severity') or RULE_DEFAULT_SEVERITY).upper()
+        if severity not in RULE_SEVERITIES:
+            raise RuleError("rule {}: unknown severity '{}'".format(name,
+                severity))
+        duration = parse_duration(match.group('for')) \
+                if match.group('for') else 0
+        condition = match.group('cond').strip()
+
+        def replace_stat(m):
+            index = stats.setdefault(m.group(0), len(stats))
+            return RULE_STAT_PREFIX + str(index)
+        expr = RULE_STATISTIC.sub(replace_stat, condition)
+        expr = RULE_DURATION.sub(lambda m: str(float(m.group(1)) *
+            RULE_DURATION_UNITS[m.group(2)]), expr)
+        try:
+            tree = ast.parse(expr, mode='eval')
+        except SyntaxError:
+            raise RuleError("rule {}: invalid condition '{}'".format(name,
+                condition))
+        compiler = RuleCompiler(name)
+        tree = ast.fix_missing_locations(compiler.visit(tree))
+        windows.update(compiler.windows)
+        code = compile(tree, "<rule {}>".format(name), 'eval')
+        value_code = None
+        if isinstance(tree.body, ast.Compare) and len(tree.body.ops) == 1:
+            value_code = compile(ast.Expression(tree.body.left),
+                    "<rule {}>".format(name), 'eval')
+        return Rule(name, condition, duration, severity, code, value_code)
+
+    def get_fetched(self):
+        """returns the statistics to be fetched, as get_statistics wants them"""
+        return sorted(set(name.split(':', 1)[1] for name in self.statistics))
+
+    def evaluate(self, ts, stats):
+        """
+        adds a sample of the statistics, then evaluates all the rules,
+        returning the alerts raised or resolved
+        """
+        self.window.update(ts, stats)
+        env = self.env
+        alerts = []
+        for rule in self.rules:
+            try:
+                result = eval(rule.code, env)
+            except (RuleUnknown, TypeError, ZeroDivisionError):
+                # not enough data to tell
+                continue
+            if result:
+                if rule.pending_since is None:
+                    rule.pending_since = ts
+                if not rule.firing and ts - rule.pending_since >= \
+                        rule.duration:
+                    rule.firing = True
+                    alerts.append(self.make_alert(rule, ts, "firing"))
+            else:
+                rule.pending_since = None
+                if rule.firing:
+                    rule.firing = False
+                    alerts.append(self.make_alert(rule, ts, "resolved"))
+        return alerts
+
+    def make_alert(self, rule, ts, state):
+        alert = {'time': ts, 'rule': rule.name, 'severity': rule.severity,
+                'state': state, 'condition': rule.condition}
+        if rule.value_code is not None:
+            try:
+                alert['value'] = eval(rule.value_code, self.env)
+            except (RuleUnknown, TypeError, ZeroDivisionError):
+                pass
+        return alert
+
+class AlertOutputs(object):
+    """
+    Sends the alerts to stdout, appends them to files, as JSON lines, or
+    posts them to HTTP webhooks; the webhooks are posted to by a thread of
+    their own, so a slow one never delays the evaluation of the rules
+    """
+
+    def __init__(self, specs):
+        self.stdout = False
+        self.files = []
+        self.webhooks = []
+        for spec in specs:
+            if spec == 'stdout':
+                self.stdout = True
+            elif spec.startswith('file:'):
+                self.files.append(open(spec[5:], 'a'))
+            elif spec.startswith('http://') or spec.startswith('https://'):
+                self.webhooks.append(spec)
+            else:
+                self.close()
+                raise RuleError("unknown alert output '{}'".format(spec))
+        self.queue = None
+        if self.webhooks:
+            self.queue = queue.Queue()
+            thread = threading.Thread(target=self.post_loop, daemon=True)
+            thread.start()
+
+    def send(self, alert):
+        if self.stdout:
+            print("{} {} {} {}: {}{}".format(
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                    time.localtime(alert['time'])),
+                alert['severity'], alert['rule'], alert['state'],
+                alert['condition'], "" if 'value' not in alert else
+                " (value: {:g})".format(alert['value'])), flush=True)
+        line = None
+        for f in self.files:
+            if line is None:
+                line = json.dumps(alert) + "\n"
+            f.write(line)
+            f.flush()
+        if self.queue is not None:
+            self.queue.put(alert)
+
+    def post_loop(self):
+        failed = set()
+        while True:
+            alert = self.queue.get()
+            if alert is None:
+                return
+            body = json.dumps(alert).encode()
+            for url in self.webhooks:
+                request = urllib.request.Request(url, body,
+                        {'Content-Type': 'application/json'})
+                try:
+                    urllib.request.urlopen(request,
+                            timeout=ALERT_TIMEOUT).read()
+                    failed.discard(url)
+                except Exception as e:
+                    if url not in failed:
+                        logger.warning("cannot post alert to {}: {}".format(
+                            url, e))
+                        failed.add(url)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+        if self.queue is not None:
+            self.queue.put(None)
+            self.queue = None
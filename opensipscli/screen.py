@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+screen.py - flicker-free redrawing of full screen views on a terminal
+"""
+
+import shutil
+import sys
+
+CLEAR_SEQ = "\033[H\033[2J"
+CLEAR_EOL_SEQ = "\033[K"
+CLEAR_EOS_SEQ = "\033[J"
+HIDE_CURSOR_SEQ = "\033[?25l"
+SHOW_CURSOR_SEQ = "\033[?25h"
+MOVE_SEQ = "\033[{};{}H"
+
+class Screen(object):
+    """
+    Draws successive frames of text on a terminal, remembering the last one
+    drawn: only the lines that changed are rewritten, starting with their
+    first changed column, so a mostly static view costs just a few bytes per
+    frame and the terminal is never cleared in between
+    """
+
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.tty = self.out.isatty()
+        self.lines = None
+        self.size = None
+
+    def get_size(self):
+        size = shutil.get_terminal_size()
+        return size.columns, size.lines
+
+    def render(self, text):
+        """draws a frame, given as the text the view would have printed"""
+        if not self.tty:
+            # nothing to redraw in place, so just print the frames
+            self.out.write(text)
+            self.out.flush()
+            return
+
+        columns, rows = self.get_size()
+        lines = [line.expandtabs()[:columns] for line in
+                text.rstrip("\n").split("\n")[:rows]]
+
+        output = []
+        if self.lines is None or self.size != (columns, rows):
+            output.append(HIDE_CURSOR_SEQ + CLEAR_SEQ)
+            output.append("\n".join(lines))
+        else:
+            old = self.lines
+            for row, line in enumerate(lines):
+                prev = old[row] if row < len(old) else ""
+                if line == prev:
+                    continue
+                col = 0
+                end = min(len(line), len(prev))
+                while col < end and line[col] == prev[col]:
+                    col += 1
+                output.append(MOVE_SEQ.format(row + 1, col + 1))
+                output.append(line[col:])
+                if len(line) < len(prev):
+                    output.append(CLEAR_EOL_SEQ)
+            if len(lines) < len(old):
+                output.append(MOVE_SEQ.format(len(lines) + 1, 1))
+                output.append(CLEAR_EOS_SEQ)
+
+        self.lines = lines
+        self.size = (columns, rows)
+        if output:
+            self.out.write("".join(output))
+            self.out.flush()
+
+    def close(self):
+        """leaves the cursor, visible again, after the last frame drawn"""
+        if not self.tty or self.lines is None:
+            return
+        self.out.write(MOVE_SEQ.format(len(self.lines), 1) + "\n" +
+                SHOW_CURSOR_SEQ)
+        self.out.flush()
+        self.lines = None
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+series.py - stores time series of statistics in a memory-mapped, columnar file
+
+The file has a fixed size, given by its retention, and is made of:
+* a header, holding the geometry of the file and the rows it contains
+* a dictionary, the JSON encoded names of the series and the details of the
+  recorded OpenSIPS processes
+* a column of timestamps, followed by one column for each series, all of
+  them arrays of 64 bit floats, with one slot for each row
+
+The rows are stored in a ring: once all the slots are used, each new row
+overwrites the oldest one.  Missing values are stored as NaN.
+"""
+
+import os
+import json
+import math
+import mmap
+import struct
+from opensipscli.logger import logger
+
+SERIES_MAGIC = b"OSTS"
+SERIES_VERSION = 1
+# magic, version, interval, capacity (rows), maximum number of series,
+# number of series, dictionary size, first row, number of rows
+SERIES_HEADER = struct.Struct("<4sIdIIIIQQ")
+SERIES_HEADER_SIZE = 64
+SERIES_VALUE_SIZE = 8
+SERIES_ALIGN = 4096
+# room reserved in the dictionary for each series name
+SERIES_NAME_SIZE = 64
+# room reserved in the dictionary for the details of each process
+SERIES_PROCESS_SIZE = 128
+SERIES_MIN_DICT_SIZE = 16384
+
+def align(size, alignment=SERIES_ALIGN):
+    return (size + alignment - 1) // alignment * alignment
+
+class SeriesFile(object):
+    """
+    A file of statistics series, opened through open() or create()
+    """
+
+    def __init__(self, path, f, mm, writable):
+        self.path = path
+        self.file = f
+        self.mm = mm
+        self.writable = writable
+        (_, _, self.interval, self.capacity, self.max_series,
+                used, self.dict_size, self.first,
+                self.rows) = SERIES_HEADER.unpack_from(mm, 0)
+        self.data_offset = align(SERIES_HEADER_SIZE + self.dict_size)
+        self.data = memoryview(mm)[self.data_offset:self.data_offset +
+                (self.max_series + 1) * self.capacity *
+                SERIES_VALUE_SIZE].cast('d')
+        meta = json.loads(bytes(mm[SERIES_HEADER_SIZE:
+            SERIES_HEADER_SIZE + self.dict_size]).decode())
+        self.names = meta["series"][:used]
+        self.processes = meta.get("processes", [])
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    @classmethod
+    def create(cls, path, names, interval, retention, processes=None):
+        """
+        creates a file of at most retention bytes, with room for the given
+        series and as many new ones as half of them (at least 64)
+        """
+        max_series = len(names) + max(len(names) // 2, 64)
+        processes = processes or []
+        dict_size = align(max(SERIES_NAME_SIZE * max_series +
+            SERIES_PROCESS_SIZE * 2 * len(processes), SERIES_MIN_DICT_SIZE))
+        data_offset = align(SERIES_HEADER_SIZE + dict_size)
+        capacity = (retention - data_offset) // \
+                ((max_series + 1) * SERIES_VALUE_SIZE)
+        if capacity < 2:
+            logger.error("retention of {} bytes is too small for {} "
+                    "series!".format(retention, len(names)))
+            return None
+        size = data_offset + (max_series + 1) * capacity * SERIES_VALUE_SIZE
+        try:
+            f = open(path, "w+b")
+            f.truncate(size)
+            mm = mmap.mmap(f.fileno(), size)
+        except OSError as e:
+            logger.error("cannot create {}: {}".format(path, e))
+            return None
+        SERIES_HEADER.pack_into(mm, 0, SERIES_MAGIC, SERIES_VERSION,
+                interval, capacity, max_series, 0, dict_size, 0, 0)
+        mm[SERIES_HEADER_SIZE:SERIES_HEADER_SIZE + dict_size] = \
+                json.dumps({"series": []}).encode().ljust(dict_size)
+        series = cls(path, f, mm, True)
+        series.add_names(names)
+        series.set_processes(processes)
+        return series
+
+    @classmethod
+    def open(cls, path, writable=False):
+        try:
+            f = open(path, "r+b" if writable else "rb")
+            size = os.fstat(f.fileno()).st_size
+            if size < SERIES_HEADER_SIZE or \
+                    f.read(len(SERIES_MAGIC)) != SERIES_MAGIC:
+                logger.error("{} is not a statistics file!".format(path))
+                f.close()
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE
+                    if writable else mmap.ACCESS_READ)
+        except OSError as e:
+            logger.error("cannot open {}: {}".format(path, e))
+            return None
+        version = SERIES_HEADER.unpack_from(mm, 0)[1]
+        if version != SERIES_VERSION:
+            logger.error("unsupported version {} of {}".format(version, path))
+            mm.close()
+            f.close()
+            return None
+        return cls(path, f, mm, writable)
+
+    def write_header(self):
+        SERIES_HEADER.pack_into(self.mm, 0, SERIES_MAGIC, SERIES_VERSION,
+                self.interval, self.capacity, self.max_series,
+                len(self.names), self.dict_size, self.first, self.rows)
+
+    def write_dictionary(self):
+        meta = json.dumps({"series": self.names,
+            "processes": self.processes}).encode()
+        if len(meta) > self.dict_size:
+            return False
+        self.mm[SERIES_HEADER_SIZE:SERIES_HEADER_SIZE + self.dict_size] = \
+                meta.ljust(self.dict_size)
+        return True
+
+    def add_names(self, names):
+        """
+        adds new series, returning the names there was no room left for;
+        their columns only hold values for the rows added from now on
+        """
+        nan = math.nan
+        dropped = []
+        used = len(self.names)
+        for name in names:
+            if name in self.index:
+                continue
+            if len(self.names) >= self.max_series:
+                dropped.append(name)
+                continue
+            base = (len(self.names) + 1) * self.capacity
+            # the slots of a column never used are all zero - mark the
+            # values of the rows already stored as missing
+            for row in range(self.rows):
+                self.data[base + (self.first + row) % self.capacity] = nan
+            self.index[name] = len(self.names)
+            self.names.append(name)
+        if not self.write_dictionary():
+            # the names are too long to fit in the dictionary
+            for name in self.names[used:]:
+                del self.index[name]
+                dropped.append(name)
+            del self.names[used:]
+        self.write_header()
+        return dropped
+
+    def set_processes(self, processes):
+        """records the details of the OpenSIPS processes"""
+        old = self.processes
+        self.processes = processes
+        if not self.write_dictionary():
+            self.processes = old
+            return False
+        return True
+
+    def append(self, ts, values):
+        """
+        appends a row of values, given as a {name: value} dictionary, and
+        returns the names there was no room for
+        """
+        dropped = []
+        new = [name for name in values if name not in self.index]
+        if new:
+            dropped = self.add_names(new)
+        capacity = self.capacity
+        if self.rows < capacity:
+            slot = (self.first + self.rows) % capacity
+        else:
+            slot = self.first
+        row = [math.nan] * len(self.names)
+        index = self.index
+        for name, value in values.items():
+            col = index.get(name)
+            if col is not None:
+                row[col] = value
+        data = self.data
+        data[slot] = ts
+        pos = capacity + slot
+        for value in row:
+            data[pos] = value
+            pos += capacity
+        # only account the row once all its values are stored
+        if self.rows < capacity:
+            self.rows += 1
+        else:
+            self.first = (self.first + 1) % capacity
+        self.write_header()
+        return dropped
+
+    def time(self, row):
+        """returns the timestamp of a row, the oldest one being row 0"""
+        return self.data[(self.first + row) % self.capacity]
+
+    def find(self, ts):
+        """returns the first row recorded at, or after ts"""
+        lo, hi = 0, self.rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time(mid) < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def column(self, col, start, end):
+        """returns the values of column col, from row start to row end"""
+        if start >= end:
+            return []
+        base = col * self.capacity
+        first = (self.first + start) % self.capacity
+        last = first + end - start
+        if last <= self.capacity:
+            return self.data[base + first:base + last].tolist()
+        return self.data[base + first:base + self.capacity].tolist() + \
+                self.data[base:base + last - self.capacity].tolist()
+
+    def times(self, start=0, end=None):
+        return self.column(0, start, self.rows if end is None else end)
+
+    def series(self, name, start=0, end=None):
+        """returns the values of a series, NaN where they are missing"""
+        return self.column(self.index[name] + 1, start,
+                self.rows if end is None else end)
+
+    def row(self, row, cols=None):
+        """
+        returns the values of a row as a {name: value} dictionary, optionally
+        only for some of the columns, skipping the missing ones
+        """
+        capacity = self.capacity
+        slot = (self.first + row) % capacity
+        data = self.data
+        names = self.names
+        ret = {}
+        for col in (range(len(names)) if cols is None else cols):
+            value = data[(col + 1) * capacity + slot]
+            if value == value:
+                ret[names[col]] = value
+        return ret
+
+    def flush(self):
+        if self.writable:
+            self.mm.flush()
+
+    def close(self):
+        if self.mm is None:
+            return
+        self.flush()
+        self.data.release()
+        self.mm.close()
+        self.file.close()
+        self.mm = None
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+sip.py - lightweight, lazy parsing of raw SIP messages
+"""
+
+# RFC 3261 compact header forms
+SIP_COMPACT_HEADERS = {
+    "i": "call-id",
+    "m": "contact",
+    "e": "content-encoding",
+    "l": "content-length",
+    "c": "content-type",
+    "f": "from",
+    "s": "subject",
+    "k": "supported",
+    "t": "to",
+    "v": "via",
+    "o": "event",
+    "r": "refer-to",
+    "b": "referred-by",
+    "u": "allow-events",
+    "x": "session-expires",
+}
+
+# the first byte of a line that continues the previous header
+SIP_FOLDING = (b' ', b'\t')
+
+class SIPMessage(object):
+    """
+    A view over a raw SIP message: the first line is only parsed when needed,
+    and headers are scanned up to the first one that is looked for
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.parsed_first_line = False
+        self.method = None
+        self.ruri = None
+        self.status = None
+        self.reason = None
+        self.headers = {}
+        self.pos = None
+        self.body_pos = None
+        # the header a folded line continues, kept across scans
+        self.last_header = None
+
+    def parse_first_line(self):
+        self.parsed_first_line = True
+        end = self.data.find(b'\r\n')
+        if end < 0:
+            end = len(self.data)
+        self.pos = end + 2
+        first = self.data[:end].decode(errors="replace").split(" ", 2)
+        if len(first) < 2:
+            return
+        if first[0] == "SIP/2.0":
+            try:
+                self.status = int(first[1])
+            except ValueError:
+                return
+            self.reason = first[2] if len(first) > 2 else ""
+        else:
+            self.method = first[0]
+            self.ruri = first[1]
+
+    def is_request(self):
+        if not self.parsed_first_line:
+            self.parse_first_line()
+        return self.method is not None
+
+    def get_method(self):
+        if not self.parsed_first_line:
+            self.parse_first_line()
+        return self.method
+
+    def get_ruri(self):
+        if not self.parsed_first_line:
+            self.parse_first_line()
+        return self.ruri
+
+    def get_status(self):
+        if not self.parsed_first_line:
+            self.parse_first_line()
+        return self.status
+
+    def get_reason(self):
+        if not self.parsed_first_line:
+            self.parse_first_line()
+        return self.reason
+
+    def parse_headers(self, name=None):
+        """
+        scans the headers until the one called name (already lowercased) is
+        found, or until all of them are parsed if name is None
+        """
+        if not self.parsed_first_line:
+            self.parse_first_line()
+        data = self.data
+        while self.body_pos is None:
+            if self.pos >= len(data):
+                self.body_pos = len(data)
+                break
+            end = data.find(b'\r\n', self.pos)
+            if end < 0:
+                end = len(data)
+            if end == self.pos:
+                # empty line - end of headers
+                self.body_pos = end + 2
+                break
+            line = data[self.pos:end]
+            self.pos = end + 2
+            if line[:1] in SIP_FOLDING:
+                # folded header, continuing the previous one
+                if self.last_header is not None:
+                    self.headers[self.last_header][-1] += " " + \
+                            line.strip().decode(errors="replace")
+                    if self.last_header == name and \
+                            data[self.pos:self.pos + 1] not in SIP_FOLDING:
+                        break
+                continue
+            sep = line.find(b':')
+            if sep < 0:
+                continue
+            hdr = line[:sep].strip().decode(errors="replace").lower()
+            hdr = SIP_COMPACT_HEADERS.get(hdr, hdr)
+            value = line[sep + 1:].strip().decode(errors="replace")
+            if hdr in self.headers:
+                self.headers[hdr].append(value)
+            else:
+                self.headers[hdr] = [value]
+            self.last_header = hdr
+            if hdr == name and data[self.pos:self.pos + 1] not in SIP_FOLDING:
+                # unless folded, the header is complete
+                break
+
+    def get_header(self, name):
+        """returns the first value of a header, or None if not present"""
+        name = name.lower()
+        name = SIP_COMPACT_HEADERS.get(name, name)
+        if name not in self.headers and self.body_pos is None:
+            self.parse_headers(name)
+        values = self.headers.get(name)
+        return values[0] if values else None
+
+    def get_headers(self, name):
+        """returns all the values of a header"""
+        name = name.lower()
+        name = SIP_COMPACT_HEADERS.get(name, name)
+        if self.body_pos is None:
+            self.parse_headers()
+        return self.headers.get(name, [])
+
+    def get_body(self):
+        if self.body_pos is None:
+            self.parse_headers()
+        return self.data[self.body_pos:]
+
+    def get_callid(self):
+        return self.get_header("call-id")
+
+    def get_cseq(self):
+        """returns the CSeq as a (number, method) tuple"""
+        cseq = self.get_header("cseq")
+        if not cseq:
+            return None, None
+        cseq = cseq.split()
+        try:
+            return int(cseq[0]), (cseq[1] if len(cseq) > 1 else None)
+        except ValueError:
+            return None, None
+
+    def describe(self):
+        """summarizes the message in a short description"""
+        if self.is_request():
+            return self.method
+        if self.get_status() is None:
+            return "???"
+        return "{} {}".format(self.status, self.reason).strip()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+sketch.py - bounded memory aggregations over streams of values
+"""
+
+import heapq
+from collections import deque
+
+class TopK(object):
+    """
+    Keeps the k largest values of a stream, along with their items, in a
+    min-heap: a new value only costs a comparison with the smallest one kept
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        # breaks the ties between equal values, so items are never compared
+        self.seq = 0
+
+    def push(self, value, item):
+        if len(self.heap) < self.k:
+            self.seq += 1
+            heapq.heappush(self.heap, (value, self.seq, item))
+        elif self.heap and value > self.heap[0][0]:
+            self.seq += 1
+            heapq.heapreplace(self.heap, (value, self.seq, item))
+
+    def items(self):
+        """returns the (value, item) tuples kept, the largest first"""
+        return [(value, item) for value, _, item in
+                sorted(self.heap, key=lambda e: e[0], reverse=True)]
+
+    def __len__(self):
+        return len(self.heap)
+
+class SpaceSaving(object):
+    """
+    Approximates the most frequent items of a stream using at most size
+    counters (the Space-Saving algorithm): when all the counters are used, a
+    new item replaces the least frequent one and inherits its count, which
+    is kept as the maximum overestimation of the new item's count
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.counters = {}
+        # one (count, item) entry for each counter; since counts only grow,
+        # entries may be stale, and are only refreshed when popped
+        self.heap = []
+
+    def add(self, item, count=1):
+        """counts an item; returns the item it replaced, if any"""
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += count
+            return None
+        if len(self.counters) < self.size:
+            self.counters[item] = [count, 0]
+            heapq.heappush(self.heap, (count, item))
+            return None
+        while True:
+            min_count, min_item = heapq.heappop(self.heap)
+            current = self.counters[min_item][0]
+            if current == min_count:
+                break
+            heapq.heappush(self.heap, (current, min_item))
+        del self.counters[min_item]
+        self.counters[item] = [min_count + count, min_count]
+        heapq.heappush(self.heap, (min_count + count, item))
+        return min_item
+
+    def top(self, n):
+        """returns the n most frequent (count, error, item) tuples"""
+        return [(c[0], c[1], item) for item, c in heapq.nlargest(n,
+            self.counters.items(), key=lambda e: e[1][0])]
+
+    def __len__(self):
+        return len(self.counters)
+
+class LogHistogram(object):
+    """
+    A histogram of positive integer values (i.e. durations), with buckets
+    whose width grows with the values, so that any quantile is estimated
+    within a relative error of 2 ** -sub_bits, using a bounded number of
+    buckets; histograms with the same precision can be merged
+    """
+
+    def __init__(self, sub_bits=5):
+        self.sub_bits = sub_bits
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        linear = 1 << (self.sub_bits + 1)
+        if value < linear:
+            return value
+        shift = value.bit_length() - self.sub_bits - 1
+        return (shift << self.sub_bits) + (value >> shift)
+
+    def value(self, index):
+        """returns the value in the middle of a bucket"""
+        sub_count = 1 << self.sub_bits
+        if index < 2 * sub_count:
+            return index
+        shift = (index - sub_count) >> self.sub_bits
+        sub = index - (shift << self.sub_bits)
+        return (sub << shift) + (1 << (shift - 1))
+
+    def add(self, value, count=1):
+        value = max(int(value), 0)
+        index = self.index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def quantiles(self, qs):
+        """returns the estimated value of each of the qs quantiles"""
+        if not self.count:
+            return [0 for q in qs]
+        ranks = [max(1, int(q * self.count + 0.5)) for q in qs]
+        values = [None] * len(qs)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            for i, rank in enumerate(ranks):
+                if values[i] is None and seen >= rank:
+                    values[i] = min(self.value(index), self.max)
+        return values
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+class SlidingHistogram(object):
+    """
+    LogHistograms of the values added during the last few seconds: values
+    are added to the histogram of the current time slot, and the slots of a
+    window are merged when the window is queried
+    """
+
+    def __init__(self, seconds=60, slot_time=1, sub_bits=5):
+        self.slot_time = slot_time
+        self.sub_bits = sub_bits
+        self.slots = [None] * max(1, int(seconds / slot_time))
+        self.epochs = [None] * len(self.slots)
+
+    def add(self, value, now):
+        epoch = int(now // self.slot_time)
+        i = epoch % len(self.slots)
+        if self.epochs[i] != epoch:
+            self.slots[i] = LogHistogram(self.sub_bits)
+            self.epochs[i] = epoch
+        self.slots[i].add(value)
+
+    def window(self, seconds, now):
+        """returns a LogHistogram of the values added in the last seconds"""
+        merged = LogHistogram(self.sub_bits)
+        epoch = int(now // self.slot_time)
+        first = epoch - min(len(self.slots), max(1,
+            int(seconds / self.slot_time))) + 1
+        for i, slot in enumerate(self.slots):
+            if slot is not None and first <= self.epochs[i] <= epoch:
+                merged.merge(slot)
+        return merged
+
+class SlidingRegression(object):
+    """
+    Fits a line, by least squares, through the (x, y) samples added during
+    the last seconds (x being the time): the sums the fit needs are updated
+    as samples come and go, so adding one costs O(1).  The sums are kept
+    relative to the oldest sample, and recomputed once all the samples they
+    were accumulated over were evicted, so rounding errors do not build up.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = deque()
+        self.evicted = 0
+        self.rebase()
+
+    def rebase(self):
+        if self.samples:
+            self.base_x, self.base_y = self.samples[0]
+        else:
+            self.base_x = self.base_y = None
+        self.n = self.sx = self.sy = self.sxx = self.sxy = self.syy = 0.0
+        self.evicted = 0
+        for x, y in self.samples:
+            self.accumulate(x, y, 1)
+
+    def accumulate(self, x, y, sign):
+        dx = x - self.base_x
+        dy = y - self.base_y
+        self.n += sign
+        self.sx += sign * dx
+        self.sy += sign * dy
+        self.sxx += sign * dx * dx
+        self.sxy += sign * dx * dy
+        self.syy += sign * dy * dy
+
+    def add(self, x, y):
+        if self.base_x is None:
+            self.base_x, self.base_y = x, y
+        self.samples.append((x, y))
+        self.accumulate(x, y, 1)
+        samples = self.samples
+        while samples[0][0] < x - self.seconds:
+            old_x, old_y = samples.popleft()
+            self.accumulate(old_x, old_y, -1)
+            self.evicted += 1
+        if self.evicted >= len(samples):
+            self.rebase()
+
+    def fit(self):
+        """
+        returns the slope of the line, along with its coefficient of
+        determination (how well it fits, from 0 to 1), or None if the
+        samples do not span any time
+        """
+        n = self.n
+        if n < 2:
+            return None
+        sxx = self.sxx - self.sx * self.sx / n
+        if sxx <= 0:
+            return None
+        sxy = self.sxy - self.sx * self.sy / n
+        syy = self.syy - self.sy * self.sy / n
+        r2 = sxy * sxy / (sxx * syy) if syy > 0 else 0.0
+        return sxy / sxx, min(r2, 1.0)
+
+    def span(self):
+        """returns the time between the oldest and the newest samples"""
+        if not self.samples:
+            return 0
+        return self.samples[-1][0] - self.samples[0][0]
+
+    def __len__(self):
+        return len(self.samples)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+sockets.py - samples the queues of the listening sockets, out of /proc/net
+"""
+
+import os
+import sys
+import socket
+from collections import namedtuple
+from functools import lru_cache
+
+# the files sampled, for each protocol
+SOCKET_FILES = {
+    'udp': ['/proc/net/udp', '/proc/net/udp6'],
+    'tcp': ['/proc/net/tcp', '/proc/net/tcp6'],
+}
+# states of the listening sockets: unconnected UDP and listening TCP ones
+SOCKET_LISTEN_STATES = {'udp': '07', 'tcp': '0A'}
+SOCKET_ANY_ADDRESSES = ['00000000', '0' * 32]
+# the system wide counters of the connections dropped by TCP listeners
+SOCKET_NETSTAT_FILE = '/proc/net/netstat'
+SOCKET_LISTEN_DROPS = 'ListenDrops'
+
+# recv_queue: bytes waiting to be read, or, for TCP, connections waiting to
+# be accepted; send_queue: bytes waiting to be sent; drops: datagrams
+# dropped so far (UDP only), new_drops: the ones dropped since the previous
+# sample
+SocketQueue = namedtuple('SocketQueue', ['recv_queue', 'send_queue',
+    'drops', 'new_drops', 'inode'])
+
+def parse_listener(listener):
+    """
+    splits a listener, e.g. udp:127.0.0.1:5060 or udp:[::1]:5060, into its
+    (protocol, address, port)
+    """
+    proto, _, rest = listener.partition(':')
+    address, _, port = rest.rpartition(':')
+    return proto, address.strip('[]'), int(port)
+
+@lru_cache(maxsize=256)
+def encode_address(address, port):
+    """
+    encodes an address the way /proc/net shows it: each 32 bit word of the
+    address is printed as a native integer, followed by the port, in hex
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    packed = socket.inet_pton(family, address)
+    if sys.byteorder == 'little':
+        packed = b"".join(packed[i:i + 4][::-1]
+                for i in range(0, len(packed), 4))
+    return "{}:{:04X}".format(packed.hex().upper(), port)
+
+def decode_address(key):
+    """turns an encoded address back into a readable address:port"""
+    address, _, port = key.partition(':')
+    packed = bytes.fromhex(address)
+    if sys.byteorder == 'little':
+        packed = b"".join(packed[i:i + 4][::-1]
+                for i in range(0, len(packed), 4))
+    if len(packed) == 4:
+        return "{}:{}".format(socket.inet_ntop(socket.AF_INET, packed),
+                int(port, 16))
+    return "[{}]:{}".format(socket.inet_ntop(socket.AF_INET6, packed),
+            int(port, 16))
+
+class SocketSampler(object):
+    """
+    Reads the listening sockets of the system once per sample, indexing
+    their queues by their encoded (address, port), so that looking up each
+    OpenSIPS listener costs a single dictionary access
+    """
+
+    def __init__(self, protos=('udp', 'tcp')):
+        self.protos = protos
+        # protocol -> encoded address -> (rx_queue, tx_queue, drops, inode)
+        self.sockets = {proto: {} for proto in protos}
+        self.prev_drops = {proto: {} for proto in protos}
+        # (connections dropped by all the TCP listeners, since the previous
+        # sample); /proc/net/tcp has no counters of its own
+        self.listen_drops = (None, None)
+
+    def sample_listen_drops(self):
+        try:
+            with open(SOCKET_NETSTAT_FILE) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            self.listen_drops = (None, None)
+            return
+        # pairs of lines: the names of the counters, then their values
+        for names, values in zip(lines[::2], lines[1::2]):
+            if not names.startswith("TcpExt:"):
+                continue
+            names = names.split()
+            if SOCKET_LISTEN_DROPS not in names:
+                break
+            drops = int(values.split()[names.index(SOCKET_LISTEN_DROPS)])
+            prev = self.listen_drops[0]
+            self.listen_drops = (drops,
+                    None if prev is None else max(drops - prev, 0))
+            return
+        self.listen_drops = (None, None)
+
+    def sample(self):
+        for proto in self.protos:
+            state = SOCKET_LISTEN_STATES[proto]
+            sockets = {}
+            for path in SOCKET_FILES[proto]:
+                try:
+                    with open(path) as f:
+                        lines = f.read().splitlines()[1:]
+                except OSError:
+                    # i.e. IPv6 is disabled
+                    continue
+                for line in lines:
+                    fields = line.split()
+                    if len(fields) < 10 or fields[3] != state:
+                        continue
+                    tx_queue, _, rx_queue = fields[4].partition(':')
+                    sockets[fields[1]] = (int(rx_queue, 16),
+                            int(tx_queue, 16),
+                            int(fields[12]) if proto == 'udp' and
+                                len(fields) > 12 else None,
+                            int(fields[9]))
+            old = self.sockets[proto]
+            self.prev_drops[proto] = {key: value[2] for key, value in
+                    old.items()}
+            self.sockets[proto] = sockets
+        if 'tcp' in self.protos:
+            self.sample_listen_drops()
+
+    def get(self, proto, address, port):
+        """
+        returns the queues of the socket listening on address and port, or
+        on the same port of any address, or None if no such socket is found
+        """
+        try:
+            key = encode_address(address, port)
+        except (OSError, ValueError):
+            return None
+        sockets = self.sockets[proto]
+        entry = sockets.get(key)
+        if entry is None:
+            for any_address in SOCKET_ANY_ADDRESSES:
+                key = "{}:{:04X}".format(any_address, port)
+                entry = sockets.get(key)
+                if entry is not None:
+                    break
+            else:
+                return None
+        return self.make_queue(proto, key, entry)
+
+    def get_listener(self, listener):
+        """returns the queues of an OpenSIPS listener, e.g. udp:1.2.3.4:5060"""
+        try:
+            proto, address, port = parse_listener(listener)
+        except ValueError:
+            return None
+        if proto not in self.sockets:
+            return None
+        return self.get(proto, address, port)
+
+    def get_inodes(self, proto, inodes):
+        """returns the (encoded address, queues) of the sockets in inodes"""
+        return [(key, self.make_queue(proto, key, entry)) for key, entry in
+                self.sockets[proto].items() if entry[3] in inodes]
+
+    def make_queue(self, proto, key, entry):
+        rx_queue, tx_queue, drops, inode = entry
+        prev = self.prev_drops[proto].get(key)
+        new_drops = None if drops is None or prev is None \
+                else max(drops - prev, 0)
+        return SocketQueue(rx_queue, tx_queue, drops, new_drops, inode)
+
+def get_socket_inodes(pid):
+    """returns the inodes of the sockets a process has open"""
+    inodes = set()
+    fd_dir = "/proc/{}/fd".format(pid)
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return None
+    for fd in fds:
+        try:
+            link = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if link.startswith("socket:["):
+            inodes.add(int(link[8:-1]))
+    return inodes
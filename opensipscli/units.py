@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+##
+## This file is part of OpenSIPS CLI
+## (see https://github.com/OpenSIPS/opensips-cli).
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+units.py - parsing and printing of the sizes used by the modules
+"""
+
+def parse_size(value):
+    """converts a size such as 512K, 100M or 2G in bytes"""
+    units = { "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3 }
+    value = str(value).strip().upper()
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+def human_size(bytes, units=(' bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB')):
+    """ Returns a human readable string reprentation of bytes"""
+    return "{:.1f}".format(bytes) + units[0] \
+            if bytes < 1024 else human_size(bytes / 1024, units[1:])